@@ -0,0 +1,85 @@
+"""
+Memory allocated while serving keep-alive requests.
+
+Reports the time taken per request, the memory retained per request,
+the peak memory allocated while serving a keep-alive connection
+(memory that is freed again between requests, but that the allocator
+and garbage collector still have to deal with) and the size of the
+per-request objects.
+
+Memory retained per request is the difference between
+tracemalloc snapshots taken before and after serving NUM_REQUESTS,
+divided by NUM_REQUESTS. The garbage collector is disabled while
+measuring, so reference cycles left behind by each request (the
+garbage collector's work) are counted too.
+
+    python -m benchmarks.allocations
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from benchmarks.utils import FakeConnection, keepalive_requests, make_worker
+from scotchwsgi.request import WSGIRequest
+from scotchwsgi.response import WSGIResponseHeaders, WSGIResponseWriter
+
+NUM_REQUESTS = 1000
+NUM_TOP_LINES = 5
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def main():
+    worker = make_worker()
+    request_bytes = keepalive_requests(NUM_REQUESTS)
+
+    # Warm up
+    worker._handle_connection(FakeConnection(request_bytes), None)
+
+    tracemalloc.start()
+    conn = FakeConnection(request_bytes)
+    gc.collect()
+    gc.disable()
+    try:
+        start_snapshot = tracemalloc.take_snapshot()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        worker._handle_connection(conn, None)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        end_snapshot = tracemalloc.take_snapshot()
+    finally:
+        gc.enable()
+        tracemalloc.stop()
+
+    snapshot_filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = end_snapshot.filter_traces(snapshot_filters).compare_to(
+        start_snapshot.filter_traces(snapshot_filters), 'lineno')
+    size_per_request = sum(stat.size_diff for stat in stats) / NUM_REQUESTS
+    blocks_per_request = sum(stat.count_diff for stat in stats) / NUM_REQUESTS
+
+    conn = FakeConnection(request_bytes)
+    start = time.perf_counter()
+    worker._handle_connection(conn, None)
+    elapsed = time.perf_counter() - start
+
+    print("Requests:                %d" % NUM_REQUESTS)
+    print("Time per request:        %.1fus" % (elapsed / NUM_REQUESTS * 1e6))
+    print("Retained per request:    %.1f bytes in %.1f blocks" % (size_per_request, blocks_per_request))
+    for stat in stats[:NUM_TOP_LINES]:
+        frame = stat.traceback[0]
+        print("    %.1f bytes in %.1f blocks: %s:%d" % (
+            stat.size_diff / NUM_REQUESTS, stat.count_diff / NUM_REQUESTS, frame.filename, frame.lineno))
+    print("Peak connection memory:  %d bytes" % (peak_memory - start_memory))
+
+    request = WSGIRequest('GET', '/', '', 'HTTP/1.1', {}, b'')
+    response_headers = WSGIResponseHeaders([], [])
+    response_writer = WSGIResponseWriter(None)
+    print("WSGIRequest size:        %d bytes" % object_size(request))
+    print("WSGIResponseHeaders size: %d bytes" % object_size(response_headers))
+    print("WSGIResponseWriter size: %d bytes" % object_size(response_writer))
+
+if __name__ == '__main__':
+    main()
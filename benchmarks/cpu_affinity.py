@@ -0,0 +1,126 @@
+"""
+Throughput and tail latency with and without pinning workers to CPUs,
+measured against a real server with one worker per CPU.
+
+    python -m benchmarks.cpu_affinity [INTERFACE]
+
+Pinning pays off when workers would otherwise migrate between CPUs,
+i.e. with several workers busy at once, so the load comes from one
+client process per CPU. Given a network interface, a third run pins
+workers to the CPUs handling its receive queues (the load still comes
+over loopback, so this only shows the placement overhead there).
+"""
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+DURATION = 5
+HOST = '127.0.0.1'
+PORT = 8766
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NUM_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+def app(environ, start_response):
+    # Enough work per request for CPU caches to matter
+    body = ("%x" % sum(i * i for i in range(2000))).encode() * 16
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+def start_server(*options):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, 'bin', 'scotchwsgi'),
+            'benchmarks.cpu_affinity',
+            '--host', HOST,
+            '--port', str(PORT),
+            '--min_workers', str(NUM_CPUS),
+            '--max_workers', str(NUM_CPUS),
+        ] + list(options),
+        cwd=ROOT,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, PORT)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    # Let the workers start up
+    time.sleep(1)
+
+    return server
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+def read_response(sock, buf):
+    while b"\r\n\r\n" not in buf:
+        buf += sock.recv(65536)
+    head, body = buf.split(b"\r\n\r\n", 1)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    while len(body) < length:
+        body += sock.recv(65536)
+    return body[length:]
+
+def run_client(deadline, results):
+    request = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    sock = socket.create_connection((HOST, PORT))
+    latencies = []
+    buf = b""
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        sock.sendall(request)
+        buf = read_response(sock, buf)
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+    results.put(latencies)
+
+def measure(label, options):
+    server = start_server(*options)
+    try:
+        results = multiprocessing.Queue()
+        deadline = time.monotonic() + DURATION
+        clients = [
+            multiprocessing.Process(target=run_client, args=(deadline, results))
+            for _ in range(NUM_CPUS)
+        ]
+        for client in clients:
+            client.start()
+        latencies = sorted(
+            latency
+            for _ in clients
+            for latency in results.get()
+        )
+        for client in clients:
+            client.join()
+    finally:
+        stop_server(server)
+
+    print("%-30s %8.0f requests/s  p50 %6.3fms  p99 %6.3fms  p99.9 %6.3fms" % (
+        label,
+        len(latencies) / DURATION,
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3,
+        latencies[int(len(latencies) * 0.999)] * 1e3,
+    ))
+
+def main():
+    print("%d workers and clients" % NUM_CPUS)
+    measure("unpinned", [])
+    measure("--cpu_affinity auto", ['--cpu_affinity', 'auto'])
+    if len(sys.argv) > 1:
+        measure(
+            "--cpu_affinity_interface %s" % sys.argv[1],
+            ['--cpu_affinity', 'auto', '--cpu_affinity_interface', sys.argv[1]],
+        )
+
+if __name__ == '__main__':
+    main()
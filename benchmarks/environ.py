@@ -0,0 +1,86 @@
+"""
+Time taken to build the WSGI environ for requests with few and many
+headers.
+
+    python -m benchmarks.environ
+"""
+import time
+
+from benchmarks.utils import make_worker
+from scotchwsgi.request import WSGIRequest
+
+NUM_REQUESTS = 20000
+NUM_RUNS = 5
+
+BROWSER_HEADERS = {
+    'host': 'www.example.com',
+    'user-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0',
+    'accept': 'text/css,*/*;q=0.1',
+    'accept-language': 'en-GB,en;q=0.5',
+    'accept-encoding': 'gzip, deflate, br',
+    'referer': 'https://www.example.com/',
+    'cookie': 'session=abcdef0123456789; theme=dark; tracking=1',
+    'connection': 'keep-alive',
+    'if-none-match': '"5f3c-1a2b3c"',
+}
+
+# What a request looks like by the time it has been through a CDN and
+# a load balancer
+CDN_HEADERS = dict(BROWSER_HEADERS, **{
+    'cdn-loop': 'cloudflare',
+    'cf-connecting-ip': '203.0.113.7',
+    'cf-ipcountry': 'GB',
+    'cf-ray': '8a1b2c3d4e5f6a7b-LHR',
+    'cf-visitor': '{"scheme":"https"}',
+    'true-client-ip': '203.0.113.7',
+    'x-forwarded-for': '203.0.113.7, 198.51.100.1',
+    'x-forwarded-proto': 'https',
+    'x-forwarded-host': 'www.example.com',
+    'x-forwarded-port': '443',
+    'x-real-ip': '203.0.113.7',
+    'x-request-id': '0f8fad5b-d9cb-469f-a165-70867728950e',
+    'x-amzn-trace-id': 'Root=1-67891233-abcdef012345678912345678',
+    'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+    'tracestate': 'congo=t61rcWkgMzE',
+    'via': '1.1 varnish, 1.1 google',
+    'sec-ch-ua': '"Chromium";v="118", "Not=A?Brand";v="99"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Linux"',
+    'sec-fetch-dest': 'document',
+    'sec-fetch-mode': 'navigate',
+    'sec-fetch-site': 'none',
+    'sec-fetch-user': '?1',
+    'upgrade-insecure-requests': '1',
+    'cache-control': 'max-age=0',
+    'pragma': 'no-cache',
+    'dnt': '1',
+    'origin': 'https://www.example.com',
+    'priority': 'u=0, i',
+    'x-client-version': '4.2.1',
+    'x-device-id': 'c2f0e7a4-5d2b-4bbf-9c1e-3b5a7e9d1f02',
+    'x-session-id': 'a1b2c3d4e5f6',
+    'content-type': 'application/json',
+    'content-length': '0',
+})
+
+REQUESTS = {
+    'small': {'host': 'localhost'},
+    'browser': BROWSER_HEADERS,
+    'cdn': CDN_HEADERS,
+}
+
+def time_environ(worker, headers):
+    request = WSGIRequest('GET', '/path', 'a=1', 'HTTP/1.1', headers, b'')
+    start = time.perf_counter()
+    for _ in range(NUM_REQUESTS):
+        worker._get_environ(request)
+    return (time.perf_counter() - start) / NUM_REQUESTS
+
+def main():
+    worker = make_worker()
+    for request_name, headers in REQUESTS.items():
+        seconds = min(time_environ(worker, headers) for _ in range(NUM_RUNS))
+        print("%-8s %3d headers %8.2fus/environ" % (request_name, len(headers), seconds * 1e6))
+
+if __name__ == '__main__':
+    main()
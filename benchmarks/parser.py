@@ -0,0 +1,67 @@
+"""
+Request parsing speed of each available parser backend.
+
+    python -m benchmarks.parser
+"""
+import time
+from io import BufferedReader, BytesIO
+
+from scotchwsgi.parser import PARSERS, httptools
+from scotchwsgi.request import WSGIRequest
+
+NUM_REQUESTS = 20000
+
+REQUESTS = {
+    'small': (
+        b"GET /path?a=1 HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"\r\n"
+    ),
+    'browser': (
+        b"GET /static/css/site.css?v=123 HTTP/1.1\r\n"
+        b"Host: www.example.com\r\n"
+        b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0\r\n"
+        b"Accept: text/css,*/*;q=0.1\r\n"
+        b"Accept-Language: en-GB,en;q=0.5\r\n"
+        b"Accept-Encoding: gzip, deflate, br\r\n"
+        b"Referer: https://www.example.com/\r\n"
+        b"Cookie: session=abcdef0123456789; theme=dark; tracking=1\r\n"
+        b"Connection: keep-alive\r\n"
+        b"Sec-Fetch-Dest: style\r\n"
+        b"Sec-Fetch-Mode: no-cors\r\n"
+        b"Sec-Fetch-Site: same-origin\r\n"
+        b"If-None-Match: \"5f3c-1a2b3c\"\r\n"
+        b"\r\n"
+    ),
+}
+
+def time_parser(parser, request_bytes):
+    reader = BufferedReader(BytesIO(request_bytes * NUM_REQUESTS))
+    start = time.perf_counter()
+    for _ in range(NUM_REQUESTS):
+        WSGIRequest.from_reader(reader, parser=parser)
+    return (time.perf_counter() - start) / NUM_REQUESTS
+
+def main():
+    if httptools is None:
+        print("httptools is not installed, only the python parser will be measured")
+
+    for request_name, request_bytes in REQUESTS.items():
+        results = {}
+        for parser_name, parser_class in PARSERS.items():
+            try:
+                parser = parser_class()
+            except ImportError:
+                continue
+            results[parser_name] = time_parser(parser, request_bytes)
+
+        for parser_name, seconds in results.items():
+            print("%-8s %-10s %6.2fus/request  (%.2fx python)" % (
+                request_name,
+                parser_name,
+                seconds * 1e6,
+                results['python'] / seconds,
+            ))
+
+if __name__ == '__main__':
+    main()
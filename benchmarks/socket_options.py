@@ -0,0 +1,141 @@
+"""
+Latency effect of each socket option, measured against a real server.
+
+    python -m benchmarks.socket_options
+
+TCP_DEFER_ACCEPT and TCP_FASTOPEN only apply to new connections and
+SO_SNDBUF/SO_RCVBUF mostly to large responses, so each option is
+measured with the workload it affects.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+NUM_REQUESTS = 200
+NUM_LARGE_REQUESTS = 20
+LARGE_BODY = b"x" * (4 * 1024 * 1024)
+HOST = '127.0.0.1'
+PORT = 8765
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/large':
+        start_response('200 OK', [('Content-Length', str(len(LARGE_BODY)))])
+        return [LARGE_BODY]
+
+    # Two separately flushed chunks, as an application streaming its
+    # output would send them
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b"Hello ", b"", b"world!\n"]
+
+def start_server(*options):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, 'bin', 'scotchwsgi'),
+            'benchmarks.socket_options',
+            '--host', HOST,
+            '--port', str(PORT),
+        ] + list(options),
+        cwd=ROOT,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, PORT)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    # Let the worker start up
+    time.sleep(1)
+
+    return server
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+def read_response(sock):
+    """
+    Read one response, which is chunked, has a Content-Length or
+    ends when the connection closes.
+    """
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(65536)
+    head, body = data.split(b"\r\n\r\n", 1)
+
+    if b"Transfer-Encoding: chunked" in head:
+        while not body.endswith(b"0\r\n\r\n"):
+            body += sock.recv(65536)
+    elif b"Content-Length: " in head:
+        length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+        while len(body) < length:
+            body += sock.recv(65536)
+    else:
+        while sock.recv(65536):
+            pass
+
+def time_keepalive(path='/', num_requests=NUM_REQUESTS):
+    request = ("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path).encode()
+    sock = socket.create_connection((HOST, PORT))
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        sock.sendall(request)
+        read_response(sock)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return elapsed / num_requests
+
+def time_new_connections(fastopen=False):
+    request = b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+    start = time.perf_counter()
+    for _ in range(NUM_REQUESTS):
+        if fastopen:
+            # Send the request with the SYN
+            sock = socket.socket()
+            sock.sendto(request, socket.MSG_FASTOPEN, (HOST, PORT))
+        else:
+            sock = socket.create_connection((HOST, PORT))
+            sock.sendall(request)
+        read_response(sock)
+        sock.close()
+    return (time.perf_counter() - start) / NUM_REQUESTS
+
+def measure(label, options, timer):
+    server = start_server(*options)
+    try:
+        seconds = timer()
+    finally:
+        stop_server(server)
+    print("%-40s %8.3fms/request" % (label, seconds * 1e3))
+
+def main():
+    measure("keep-alive, --no-tcp_nodelay", ['--no-tcp_nodelay'], time_keepalive)
+    measure("keep-alive, --tcp_nodelay", ['--tcp_nodelay'], time_keepalive)
+
+    measure("new connections", [], time_new_connections)
+    if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+        measure("new connections, --defer_accept 5", ['--defer_accept', '5'], time_new_connections)
+    if hasattr(socket, 'MSG_FASTOPEN'):
+        measure(
+            "new connections, --fastopen 128",
+            ['--fastopen', '128'],
+            lambda: time_new_connections(fastopen=True),
+        )
+
+    large = lambda: time_keepalive('/large', NUM_LARGE_REQUESTS)
+    measure("4MB responses", [], large)
+    measure(
+        "4MB responses, 1MB socket buffers",
+        ['--send_buffer_size', str(1024 * 1024), '--receive_buffer_size', str(1024 * 1024)],
+        large,
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Overhead of tracing requests, with and without exporting spans.
+
+    python -m benchmarks.tracing
+
+Exported spans are written to a temporary file, and the time taken to
+encode and write them is included.
+"""
+import os
+import tempfile
+import time
+
+from benchmarks.utils import FakeConnection, keepalive_requests, make_worker
+
+NUM_REQUESTS = 5000
+NUM_RUNS = 5
+REQUEST = (
+    b"GET /path?a=1 HTTP/1.1\r\n"
+    b"Host: localhost\r\n"
+    b"traceparent: 00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01\r\n"
+    b"\r\n"
+)
+
+def time_requests(worker):
+    request_bytes = keepalive_requests(NUM_REQUESTS, REQUEST)
+    start = time.perf_counter()
+    worker._handle_connection(FakeConnection(request_bytes), None)
+    if worker.span_exporter is not None:
+        worker.span_exporter.flush()
+    return (time.perf_counter() - start) / NUM_REQUESTS
+
+def measure(label, worker, baseline=None):
+    seconds = min(time_requests(worker) for _ in range(NUM_RUNS))
+    if baseline is None:
+        print("%-24s %8.2fus/request" % (label, seconds * 1e6))
+    else:
+        print("%-24s %8.2fus/request  (+%.2fus)" % (label, seconds * 1e6, (seconds - baseline) * 1e6))
+    return seconds
+
+def main():
+    baseline = measure("no tracing", make_worker())
+    measure("--tracing", make_worker(tracing=True), baseline)
+
+    with tempfile.TemporaryDirectory() as directory:
+        worker = make_worker(trace_exporter='file:' + os.path.join(directory, 'spans.jsonl'))
+        measure("--trace_exporter file:", worker, baseline)
+        worker.span_exporter.close()
+
+if __name__ == '__main__':
+    main()
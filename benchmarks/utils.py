@@ -0,0 +1,66 @@
+import os
+from io import BufferedReader, BytesIO
+from unittest.mock import Mock, patch
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+from scotchwsgi.worker import WSGIWorker
+
+HOST = 'localhost'
+PORT = 0
+REQUEST_TIMEOUT = 10
+
+def hello_app(environ, start_response):
+    body = b"Hello world!\n"
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
+
+def make_worker(app=hello_app, **kwargs):
+    """
+    Create a worker serving ``app`` without a listening socket, for
+    feeding connections to ``_handle_connection`` directly.
+    """
+    sock = Mock(getsockname=lambda: (HOST, PORT))
+    with patch('scotchwsgi.worker.importlib.import_module', Mock(return_value=Mock(app=app))):
+        return WSGIWorker('.', sock, HOST, os.getpid(), REQUEST_TIMEOUT, **kwargs)
+
+class NullWriter(object):
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    """
+    A connection that reads ``request_bytes`` and discards whatever is
+    written to it.
+    """
+
+    def __init__(self, request_bytes):
+        self.request_bytes = request_bytes
+        self.output = NullWriter()
+
+    def makefile(self, mode, buffering=None):
+        if mode == 'rb':
+            return BufferedReader(BytesIO(self.request_bytes))
+        return self.output
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+def keepalive_requests(count, request=b"GET /path?a=1 HTTP/1.1\r\nHost: localhost\r\nUser-Agent: bench\r\nAccept: */*\r\n\r\n"):
+    return request * count
@@ -0,0 +1,154 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+AUTO = 'auto'
+
+SYS_CPU_PATH = '/sys/devices/system/cpu'
+SYS_NODE_PATH = '/sys/devices/system/node'
+SYS_NET_PATH = '/sys/class/net'
+PROC_INTERRUPTS_PATH = '/proc/interrupts'
+PROC_IRQ_PATH = '/proc/irq'
+
+def parse_cpu_list(value):
+    """
+    Parse a CPU list such as ``0-3,8`` into a sorted list of CPUs.
+    """
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not first.isdigit() or (sep and not last.isdigit()):
+            raise ValueError("Invalid CPU list: %s" % value)
+        cpus.update(range(int(first), int(last if sep else first) + 1))
+
+    if not cpus:
+        raise ValueError("Invalid CPU list: %s" % value)
+    return sorted(cpus)
+
+def parse_cpu_mask(value):
+    """
+    Parse a hexadecimal CPU mask such as ``00000000,0000000f``.
+    """
+    mask = int(value.replace(',', '') or '0', 16)
+    return [cpu for cpu in range(mask.bit_length()) if mask & (1 << cpu)]
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def order_cpus(cpus):
+    """
+    Order CPUs with every physical core before its hyperthread siblings,
+    so that the first workers don't share a core.
+    """
+    def sibling_rank(cpu):
+        siblings = _read(os.path.join(SYS_CPU_PATH, 'cpu%d' % cpu, 'topology', 'thread_siblings_list'))
+        try:
+            return parse_cpu_list(siblings).index(cpu)
+        except (AttributeError, ValueError):
+            return 0
+
+    return sorted(cpus, key=lambda cpu: (sibling_rank(cpu), cpu))
+
+def get_interface_cpus(interface):
+    """
+    Return the CPUs that handle ``interface``'s receive queues, in
+    queue order: those its interrupts are routed to, or failing that
+    those receive packet steering (RPS) uses.
+    """
+    cpus = []
+
+    interrupts = _read(PROC_INTERRUPTS_PATH) or ''
+    for line in interrupts.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or not fields[0].rstrip(':').isdigit():
+            continue
+        name = fields[-1]
+        if name != interface and not name.startswith(interface + '-'):
+            continue
+
+        irq_cpus = _read(os.path.join(PROC_IRQ_PATH, fields[0].rstrip(':'), 'smp_affinity_list'))
+        if irq_cpus:
+            _add_first_unused(cpus, parse_cpu_list(irq_cpus))
+
+    if not cpus:
+        queues_path = os.path.join(SYS_NET_PATH, interface, 'queues')
+        try:
+            queues = [queue for queue in os.listdir(queues_path) if queue.startswith('rx-')]
+        except OSError:
+            queues = []
+        for queue in sorted(queues, key=lambda queue: int(queue[3:])):
+            rps_cpus = _read(os.path.join(queues_path, queue, 'rps_cpus'))
+            if rps_cpus:
+                _add_first_unused(cpus, parse_cpu_mask(rps_cpus))
+
+    return cpus
+
+def _add_first_unused(cpus, candidates):
+    for cpu in candidates:
+        if cpu not in cpus:
+            cpus.append(cpu)
+            return
+
+def get_interface_node_cpus(interface):
+    """
+    Return the CPUs of the NUMA node ``interface`` is attached to.
+    """
+    node = _read(os.path.join(SYS_NET_PATH, interface, 'device', 'numa_node'))
+    if node is None or not node.isdigit():
+        return []
+
+    node_cpus = _read(os.path.join(SYS_NODE_PATH, 'node%s' % node, 'cpulist'))
+    return parse_cpu_list(node_cpus) if node_cpus else []
+
+def get_worker_cpu_sets(cpu_affinity, interface=None):
+    """
+    Return the sets of CPUs to pin workers to, worker ``i`` taking set
+    ``i`` modulo their number.
+
+    ``cpu_affinity`` is either ``'auto'``, giving each worker a CPU of
+    its own in turn, or a list of CPU lists. With ``'auto'``, the CPUs
+    can be limited to those handling ``interface``'s receive queues or,
+    if those are unknown, to the CPUs of its NUMA node.
+    """
+    if isinstance(cpu_affinity, str):
+        cpu_affinity = [cpu_affinity]
+    if list(cpu_affinity) != [AUTO]:
+        return [set(parse_cpu_list(cpu_list)) for cpu_list in cpu_affinity]
+
+    if hasattr(os, 'sched_getaffinity'):
+        available_cpus = sorted(os.sched_getaffinity(0))
+    else:
+        available_cpus = list(range(os.cpu_count() or 1))
+    cpus = []
+    if interface:
+        cpus = [cpu for cpu in get_interface_cpus(interface) if cpu in available_cpus]
+        if cpus:
+            # Already in queue order
+            return [{cpu} for cpu in cpus]
+
+        cpus = [cpu for cpu in get_interface_node_cpus(interface) if cpu in available_cpus]
+        if not cpus:
+            logger.warning("No receive queue or NUMA node found for %s, using every CPU", interface)
+
+    return [{cpu} for cpu in order_cpus(cpus or available_cpus)]
+
+def set_cpu_affinity(cpus):
+    """
+    Pin the current process to ``cpus``.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning("CPU affinity is not supported on this platform")
+        return
+
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning("Unable to set CPU affinity to %s: %s", sorted(cpus), e)
@@ -0,0 +1,103 @@
+import logging
+import math
+import time
+
+from scotchwsgi import const
+from scotchwsgi.listeners import get_accept_queue_length
+
+logger = logging.getLogger(__name__)
+
+class Autoscaler(object):
+    """
+    Decides how many workers should run, between ``min_workers`` and
+    ``max_workers``.
+
+    A worker's busy ratio is the fraction of time it had at least one
+    request in flight, as recorded in the :class:`Scoreboard`. Workers
+    are added when the average ratio rises above ``scale_up_ratio`` or
+    more than ``max_queue_length`` connections are waiting to be
+    accepted, and retired one at a time when it falls below
+    ``scale_down_ratio``. The gap between the two ratios, and waiting
+    ``cooldown`` seconds after each change, stop the count from
+    flapping.
+    """
+
+    def __init__(self, scoreboard, socks, min_workers, max_workers,
+                 scale_up_ratio=const.AUTOSCALE_UP_RATIO,
+                 scale_down_ratio=const.AUTOSCALE_DOWN_RATIO,
+                 cooldown=const.AUTOSCALE_COOLDOWN,
+                 max_queue_length=const.AUTOSCALE_MAX_QUEUE_LENGTH):
+        if not 0 < min_workers <= max_workers:
+            raise ValueError("Invalid worker range: %d to %d" % (min_workers, max_workers))
+        if scale_down_ratio >= scale_up_ratio:
+            raise ValueError("The scale down ratio must be below the scale up ratio")
+
+        self.scoreboard = scoreboard
+        self.socks = socks
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_ratio = scale_up_ratio
+        self.scale_down_ratio = scale_down_ratio
+        self.cooldown = cooldown
+        self.max_queue_length = max_queue_length
+        # Worker index -> (pid, busy time, time) when last measured
+        self.samples = {}
+        # Give the first workers time to start before judging them
+        self.last_scaled = time.monotonic()
+
+    def measure(self, num_workers, now=None):
+        """
+        Return the average busy ratio of the workers since the last
+        call, or ``None`` if none have been running that long.
+        """
+        if now is None:
+            now = time.time()
+
+        ratios = []
+        for index in range(num_workers):
+            pid, busy_time = self.scoreboard.get_busy_time(index, now)
+            previous = self.samples.get(index)
+            self.samples[index] = (pid, busy_time, now)
+
+            # A different PID is a replacement worker, with its own times
+            if pid and previous is not None and previous[0] == pid and now > previous[2]:
+                ratios.append((busy_time - previous[1]) / (now - previous[2]))
+
+        if not ratios:
+            return None
+        return sum(ratios) / len(ratios)
+
+    def get_queue_length(self):
+        lengths = [get_accept_queue_length(sock) for sock in self.socks]
+        return sum(length for length in lengths if length is not None)
+
+    def get_target(self, num_workers):
+        """
+        Return the number of workers that should be running, given that
+        ``num_workers`` are.
+        """
+        busy_ratio = self.measure(num_workers)
+        queue_length = self.get_queue_length()
+        if busy_ratio is None or time.monotonic() - self.last_scaled < self.cooldown:
+            return num_workers
+
+        target = num_workers
+        if busy_ratio > self.scale_up_ratio or queue_length > self.max_queue_length:
+            # Enough workers to bring the ratio back under the threshold,
+            # as traffic can rise faster than one worker per cooldown
+            target = max(num_workers + 1, math.ceil(num_workers * busy_ratio / self.scale_up_ratio))
+        elif busy_ratio < self.scale_down_ratio and not queue_length:
+            target = num_workers - 1
+
+        target = max(self.min_workers, min(self.max_workers, target))
+        if target != num_workers:
+            logger.info(
+                "Scaling from %d to %d workers (busy ratio %.2f, %d connections queued)",
+                num_workers,
+                target,
+                busy_ratio,
+                queue_length,
+            )
+            self.last_scaled = time.monotonic()
+
+        return target
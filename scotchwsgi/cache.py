@@ -0,0 +1,282 @@
+import logging
+import time
+from collections import OrderedDict
+
+import gevent
+import gevent.event
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_METHODS = ('GET', 'HEAD')
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+
+def make_cache_key(request, vary_headers):
+    """
+    Return the key identifying responses to ``request``, or ``None``
+    if they may not be shared with other clients.
+    """
+    if request.method not in CACHEABLE_METHODS or 'authorization' in request.headers:
+        return None
+
+    return (request.method, request.path, request.query) + tuple(
+        request.headers.get(header) for header in vary_headers
+    )
+
+def get_cache_policy(headers, vary_headers):
+    """
+    Return ``(shareable, max_age, public)`` for a response with
+    ``headers``.
+
+    A response is shareable if it may be sent to other clients making
+    the same request, and ``max_age`` is the number of seconds it may
+    be cached for (``None`` if not given). ``public`` is whether the
+    response was explicitly marked ``public``.
+    """
+    max_age = None
+    public = False
+    for header_name, header_value in headers:
+        header_name = header_name.lower()
+        if header_name == 'set-cookie':
+            return False, None, False
+        elif header_name == 'vary':
+            for vary_header in header_value.split(','):
+                if vary_header.strip().lower() not in vary_headers:
+                    return False, None, False
+        elif header_name == 'cache-control':
+            for directive in header_value.split(','):
+                name, _, value = directive.strip().partition('=')
+                name = name.lower()
+                if name in ('no-store', 'no-cache', 'private'):
+                    return False, None, False
+                elif name == 'public':
+                    public = True
+                elif name == 's-maxage' or (name == 'max-age' and max_age is None):
+                    try:
+                        max_age = int(value.strip('"'))
+                    except ValueError:
+                        return False, None, False
+
+    return True, max_age, public
+
+class CachedResponse(object):
+    __slots__ = ('status', 'headers', 'body', 'size', 'stored_at', 'expires_at')
+
+    def __init__(self, status, headers, body, max_age):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = len(body) + sum(len(name) + len(value) for name, value in headers)
+        self.stored_at = time.monotonic()
+        self.expires_at = self.stored_at + max_age
+
+    def get_headers(self):
+        age = int(time.monotonic() - self.stored_at)
+        return self.headers + [('Age', str(age))]
+
+class ResponseRecorder(object):
+    """
+    Wraps ``start_response`` to keep a copy of a response for the cache
+    or for identical requests waiting on it, giving up once the body is
+    larger than ``max_size``.
+    """
+
+    __slots__ = ('_start_response', 'max_size', 'status', 'headers', 'chunks', 'size', 'complete')
+
+    def __init__(self, start_response, max_size):
+        self._start_response = start_response
+        self.max_size = max_size
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.size = 0
+        # Set once the whole response has been sent
+        self.complete = False
+
+    def start_response(self, status, headers, exc_info=None):
+        write = self._start_response(status, headers, exc_info)
+        self.status = status
+        self.headers = headers
+
+        def recording_write(data):
+            self.record(data)
+            return write(data)
+
+        return recording_write
+
+    def record(self, data):
+        if self.chunks is None:
+            return
+
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.chunks = None
+        else:
+            self.chunks.append(data)
+
+    def get_response(self, vary_headers, max_age=0):
+        """
+        Return the recorded response, or ``None`` if it is incomplete
+        or may not be shared.
+
+        Only responses the application explicitly allowed to be shared
+        (with ``public``, ``max-age`` or ``s-maxage``) are returned. A
+        response without ``Cache-Control`` may be personalised in ways
+        the key doesn't cover.
+        """
+        if not self.complete or self.chunks is None or self.status is None:
+            return None
+
+        shareable, cache_max_age, public = get_cache_policy(self.headers, vary_headers)
+        if not shareable or (cache_max_age is None and not public):
+            return None
+
+        return CachedResponse(self.status, list(self.headers), b"".join(self.chunks), max_age)
+
+class ResponseCache(object):
+    """
+    Caches responses to GET and HEAD requests in memory, for as long as
+    the application's ``Cache-Control`` header allows.
+
+    Responses are keyed by method, path, query string and the request
+    headers named in ``vary_headers``. Once the cached responses take up
+    more than ``max_size`` bytes, the least recently used are evicted.
+    """
+
+    def __init__(self, max_size, vary_headers=()):
+        self.max_size = max_size
+        self.vary_headers = tuple(header.lower() for header in vary_headers)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, request):
+        """
+        Return ``(key, cached_response)`` for ``request``. The key is
+        ``None`` if the request can't be cached, and the response is
+        ``None`` if nothing (fresh) is cached for it.
+        """
+        key = make_cache_key(request, self.vary_headers)
+        if key is None:
+            return None, None
+
+        cached_response = self.entries.get(key)
+        if cached_response is not None:
+            if cached_response.expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return key, cached_response
+            self._remove(key)
+
+        self.misses += 1
+        return key, None
+
+    def store(self, key, recorder):
+        """
+        Cache the response kept by ``recorder``, if the application
+        allowed it.
+        """
+        if recorder.chunks is None or recorder.status is None:
+            return
+
+        try:
+            status_code = int(recorder.status.split(None, 1)[0])
+        except ValueError:
+            return
+        if status_code not in CACHEABLE_STATUSES:
+            return
+
+        max_age = self.get_max_age(recorder.headers)
+        if not max_age:
+            return
+
+        cached_response = CachedResponse(
+            recorder.status,
+            list(recorder.headers),
+            b"".join(recorder.chunks),
+            max_age,
+        )
+        if cached_response.size > self.max_size:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = cached_response
+        self.size += cached_response.size
+
+        while self.size > self.max_size:
+            oldest_key = next(iter(self.entries))
+            logger.debug("Evicting cached response %s", oldest_key)
+            self._remove(oldest_key)
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def get_max_age(self, headers):
+        """
+        Return the number of seconds a response with ``headers`` may be
+        cached for, or ``None`` if it may not be cached.
+        """
+        shareable, max_age, _ = get_cache_policy(headers, self.vary_headers)
+        return max_age if shareable else None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'size': self.size,
+        }
+
+class SingleFlight(object):
+    """
+    Lets only one greenlet at a time call the application for identical
+    requests. The others wait and are sent a copy of its response.
+
+    Requests are identical if they have the same key, as given by
+    :func:`make_cache_key`. Requests with a ``Cookie`` header are never
+    coalesced (unless it is one of ``vary_headers``), since the
+    response is likely to be for that user only.
+    """
+
+    def __init__(self, vary_headers=()):
+        self.vary_headers = tuple(header.lower() for header in vary_headers)
+        self.flights = {}
+        self.coalesced = 0
+
+    def make_key(self, request):
+        if 'cookie' in request.headers and 'cookie' not in self.vary_headers:
+            return None
+        return make_cache_key(request, self.vary_headers)
+
+    def join(self, key):
+        """
+        Return the result to wait for if a request for ``key`` is
+        already in flight. Otherwise the caller leads a new flight, and
+        ``None`` is returned.
+        """
+        in_flight = self.flights.get(key)
+        if in_flight is None:
+            self.flights[key] = gevent.event.AsyncResult()
+        return in_flight
+
+    def wait(self, in_flight, timeout=None):
+        """
+        Wait for the leader's response. ``None`` means it can't be
+        shared, and the application must be called after all.
+        """
+        try:
+            response = in_flight.get(timeout=timeout)
+        except gevent.Timeout:
+            return None
+
+        if response is not None:
+            self.coalesced += 1
+        return response
+
+    def finish(self, key, recorder):
+        """
+        Hand the response kept by ``recorder`` to the waiting requests.
+        """
+        response = recorder.get_response(self.vary_headers)
+        self.flights.pop(key).set(response)
@@ -1,2 +1,30 @@
 STR_ENCODING = 'latin-1'
 MAX_CONNECTIONS = 1000
+MAX_HEADER_SIZE = 65536
+MAX_HEADER_COUNT = 100
+MAX_CHUNK_SIZE_LINE = 1024
+STREAMING_CONTENT_TYPES = ('text/event-stream',)
+HEARTBEAT_INTERVAL = 15
+MAX_STREAMS = 10000
+SERVER_NAME = 'scotchwsgi'
+GRACEFUL_TIMEOUT = 30
+MEMORY_CHECK_INTERVAL = 10
+WORKER_RESTART_DELAY = 1
+MAX_SHARED_RESPONSE_SIZE = 1048576
+RATE_LIMIT_MAX_CLIENTS = 100000
+RATE_LIMIT_SWEEP_INTERVAL = 60
+AUTOSCALE_INTERVAL = 5
+AUTOSCALE_COOLDOWN = 30
+AUTOSCALE_UP_RATIO = 0.75
+AUTOSCALE_DOWN_RATIO = 0.25
+AUTOSCALE_MAX_QUEUE_LENGTH = 10
+SEND_TIMEOUT = 60
+HEADER_TIMEOUT = 5
+HEADER_MAX_TIMEOUT = 10
+HEADER_MIN_RATE = 500
+BODY_TIMEOUT = 10
+BODY_MIN_RATE = 500
+EVICTION_FREE_SLOTS = 10
+READINESS_FREE_SLOTS = 10
+TRACE_BATCH_SIZE = 100
+TRACE_FLUSH_INTERVAL = 1
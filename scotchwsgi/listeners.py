@@ -0,0 +1,172 @@
+import logging
+import os
+import stat
+import struct
+
+from gevent import socket
+
+logger = logging.getLogger(__name__)
+
+UNIX_PREFIX = 'unix:'
+
+# Hosts that bind a listener to every address, which don't name the server
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+
+# File descriptors passed by systemd socket activation start here
+SD_LISTEN_FDS_START = 3
+
+# For a listening socket, Linux gives the length of the accept queue as
+# tcpi_unacked and its maximum as tcpi_sacked, which follow the eight
+# single-byte fields and four 32-bit fields at the start of tcp_info
+TCP_INFO_QUEUE_FORMAT = struct.Struct('=8x16xII')
+
+def parse_bind(value):
+    """
+    Parse a ``HOST:PORT`` or ``unix:PATH`` string into an address for
+    :func:`create_listener`.
+    """
+    if value.startswith(UNIX_PREFIX):
+        return value[len(UNIX_PREFIX):]
+
+    host, sep, port = value.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid address: %s" % value)
+
+    return host.strip('[]'), int(port)
+
+def format_address(address):
+    if isinstance(address, (str, bytes)):
+        return '%s%s' % (UNIX_PREFIX, address)
+    host, port = address[:2]
+    return '%s:%d' % (host, port)
+
+def create_listener(address, backlog=None, unix_socket_mode=None):
+    """
+    Create a listening socket on ``address``, either a ``(host, port)``
+    tuple or the path of a Unix domain socket.
+    """
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX)
+        _remove_stale_unix_socket(address)
+        sock.bind(address)
+        if unix_socket_mode is not None:
+            os.chmod(address, unix_socket_mode)
+    else:
+        host, port = address
+        if ':' in host:
+            sock = socket.socket(socket.AF_INET6)
+        else:
+            sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+
+    if backlog:
+        sock.listen(backlog)
+    else:
+        sock.listen()
+
+    return sock
+
+def configure_listener(sock, defer_accept=None, fastopen=None, send_buffer_size=None,
+                       receive_buffer_size=None):
+    """
+    Apply socket options to a listening TCP socket. Connections
+    accepted from it inherit the buffer sizes.
+
+    ``defer_accept`` is the number of seconds the kernel waits for a
+    request before handing over a connection, and ``fastopen`` the
+    length of the TCP Fast Open queue. Both are skipped with a warning
+    where the platform lacks them.
+    """
+    if sock.family == socket.AF_UNIX:
+        return
+
+    if send_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+    if receive_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+
+    if defer_accept:
+        _set_tcp_option(sock, 'TCP_DEFER_ACCEPT', defer_accept)
+    if fastopen:
+        _set_tcp_option(sock, 'TCP_FASTOPEN', fastopen)
+
+def _set_tcp_option(sock, name, value):
+    option = getattr(socket, name, None)
+    if option is None:
+        logger.warning("%s is not supported on this platform", name)
+        return
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError as e:
+        logger.warning("Unable to set %s: %s", name, e)
+
+def _remove_stale_unix_socket(path):
+    # A socket left behind by a previous run would make bind() fail
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def get_systemd_listeners():
+    """
+    Return the sockets passed by systemd socket activation, if any.
+    """
+    try:
+        if int(os.environ.get('LISTEN_PID', '')) != os.getpid():
+            return []
+        listen_fds = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+
+    # Don't let child processes think the sockets are meant for them
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+
+    return [
+        socket.socket(fileno=fd)
+        for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + listen_fds)
+    ]
+
+def get_server_name(address, hostname):
+    """
+    Return the ``SERVER_NAME`` for a listener created on ``address``:
+    the host it was bound to, or ``hostname`` for Unix domain sockets
+    and listeners bound to every address.
+    """
+    if isinstance(address, str) or address[0] in WILDCARD_HOSTS:
+        return hostname
+    return address[0]
+
+def get_server_address(sock, hostname):
+    """
+    Return the ``(SERVER_NAME, SERVER_PORT)`` pair for connections
+    accepted on ``sock``.
+
+    Unix domain sockets have no port, which is given as ``''`` for the
+    worker to take from the Host header instead.
+    """
+    if sock.family == socket.AF_UNIX:
+        return hostname, ''
+
+    return hostname, str(sock.getsockname()[1])
+
+def get_accept_queue_length(sock):
+    """
+    Return the number of connections waiting to be accepted on
+    ``sock``, or ``None`` where that can't be measured.
+    """
+    if sock.family == socket.AF_UNIX or not hasattr(socket, 'TCP_INFO'):
+        return None
+
+    try:
+        tcp_info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_QUEUE_FORMAT.size)
+    except OSError:
+        return None
+    if len(tcp_info) < TCP_INFO_QUEUE_FORMAT.size:
+        return None
+
+    unacked, _ = TCP_INFO_QUEUE_FORMAT.unpack(tcp_info)
+    return unacked
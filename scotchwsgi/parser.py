@@ -0,0 +1,195 @@
+import logging
+
+from scotchwsgi import const
+from scotchwsgi.request import RequestHeaderFieldsTooLarge, WSGIRequest, read_line
+
+try:
+    import httptools
+except ImportError:
+    httptools = None
+
+logger = logging.getLogger(__name__)
+
+class PythonParser(object):
+    """
+    Parses the request line and headers in pure Python.
+    """
+
+    name = 'python'
+
+    def parse_head(self, reader, max_size=None, max_count=None):
+        """
+        Read the request line and headers from ``reader``, returning
+        ``(method, path, query, http_version, headers)``.
+        """
+        method, path, query, http_version = WSGIRequest.read_request_line(
+            reader,
+            max_size,
+        )
+
+        headers = WSGIRequest.read_headers(
+            reader,
+            max_size,
+            max_count,
+        )
+
+        return method, path, query, http_version, headers
+
+class HttptoolsParser(object):
+    """
+    Parses the request line and headers with httptools (the llhttp C
+    parser used by Node.js).
+
+    Only available when httptools is installed. It is faster than the
+    python parser for requests with many headers, but slower for small
+    ones.
+    """
+
+    name = 'httptools'
+
+    def __init__(self):
+        if httptools is None:
+            raise ImportError("httptools is not installed")
+
+        # Parsing is done without yielding to other greenlets, so one
+        # parser can be shared by every connection. It is replaced
+        # whenever a head is not followed by the end of a message
+        # (e.g. a body is expected), as it can't be reset otherwise.
+        self.protocol = _HttptoolsProtocol()
+        self.parser = httptools.HttpRequestParser(self.protocol)
+
+    @staticmethod
+    def read_head(reader, max_size=None):
+        # Most requests arrive with the whole head in the read buffer,
+        # in which case it can be taken in one go rather than line by line
+        peek = getattr(reader, 'peek', None)
+        if peek is not None:
+            buffered = peek(1)
+            end = buffered.find(b"\r\n\r\n")
+            if end != -1 and (max_size is None or end + 4 <= max_size):
+                return reader.read(end + 4)
+
+        lines = []
+        remaining_size = max_size
+        while True:
+            line = read_line(reader, remaining_size)
+            if remaining_size is not None:
+                remaining_size -= len(line)
+
+            lines.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+        if lines[-1] == b"":
+            # Connection closed after the head, terminate it ourselves
+            if len(lines) > 1 and not lines[-2].endswith(b"\n"):
+                lines[-1] = b"\r\n\r\n"
+            else:
+                lines[-1] = b"\r\n"
+
+        return b"".join(lines)
+
+    def parse_head(self, reader, max_size=None, max_count=None):
+        head = self.read_head(reader, max_size)
+        logger.info("Received request %s", head[:head.find(b"\r\n")])
+
+        protocol = self.protocol
+        parser = self.parser
+        protocol.reset()
+        try:
+            parser.feed_data(head)
+        except httptools.HttpParserUpgrade:
+            pass # headers are complete, the rest of the connection belongs to the app
+        except httptools.HttpParserError as e:
+            protocol.message_complete = False
+            raise ValueError("Invalid request: %s" % e)
+        finally:
+            if not protocol.message_complete:
+                self.protocol = _HttptoolsProtocol()
+                self.parser = httptools.HttpRequestParser(self.protocol)
+
+        if not protocol.headers_complete:
+            raise ValueError("Incomplete request: %r" % head)
+
+        if max_count is not None and protocol.header_count > max_count:
+            raise RequestHeaderFieldsTooLarge("More than %d headers received" % max_count)
+
+        request_uri = b"".join(protocol.url).decode(const.STR_ENCODING)
+        request_uri_split = request_uri.split('?', 1)
+        path = request_uri_split[0]
+        if len(request_uri_split) > 1:
+            query = request_uri_split[1]
+        else:
+            query = ''
+
+        logger.debug("Headers: %s", protocol.headers)
+
+        method = parser.get_method()
+        http_version = parser.get_http_version()
+        try:
+            method = _METHODS[method]
+        except KeyError:
+            method = method.decode(const.STR_ENCODING)
+        try:
+            http_version = _HTTP_VERSIONS[http_version]
+        except KeyError:
+            http_version = 'HTTP/%s' % http_version
+
+        return method, path, query, http_version, protocol.headers
+
+_METHODS = {
+    method.encode(const.STR_ENCODING): method
+    for method in ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH')
+}
+
+_HTTP_VERSIONS = {
+    '1.0': 'HTTP/1.0',
+    '1.1': 'HTTP/1.1',
+}
+
+class _HttptoolsProtocol(object):
+    __slots__ = ('url', 'headers', 'header_count', 'headers_complete', 'message_complete')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.url = []
+        self.headers = {}
+        self.header_count = 0
+        self.headers_complete = False
+        self.message_complete = False
+
+    def on_url(self, url):
+        self.url.append(url)
+
+    def on_header(self, name, value):
+        self.header_count += 1
+        self.headers[name.decode(const.STR_ENCODING).lower()] = value.decode(const.STR_ENCODING).strip()
+
+    def on_headers_complete(self):
+        self.headers_complete = True
+
+    def on_message_complete(self):
+        self.message_complete = True
+
+PARSERS = {
+    PythonParser.name: PythonParser,
+    HttptoolsParser.name: HttptoolsParser,
+}
+
+def get_parser(name='auto'):
+    """
+    Return a parser by name. ``'auto'`` is the python parser: httptools
+    is only faster for requests with many headers, and slower for the
+    small requests most traffic is made of.
+    """
+    if name == 'auto':
+        name = PythonParser.name
+
+    try:
+        parser_class = PARSERS[name]
+    except KeyError:
+        raise ValueError("Unknown parser: %s" % name)
+
+    return parser_class()
@@ -0,0 +1,271 @@
+import logging
+import re
+import uuid
+
+from scotchwsgi import const
+
+logger = logging.getLogger(__name__)
+
+# Range headers asking for more ranges than this are ignored, rather
+# than letting a client make many small requests out of one
+MAX_RANGES = 16
+
+RANGE_SPEC = re.compile(r'^(\d*)-(\d*)$', re.ASCII)
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(range_header, length):
+    """
+    Return the ``(start, stop)`` byte ranges a ``Range`` header asks
+    for out of a body of ``length`` bytes, in order and with
+    overlapping ranges merged.
+
+    ``None`` is returned if the header is invalid or asks for too many
+    ranges, in which case it should be ignored, and
+    :class:`RangeNotSatisfiable` raised if none of the ranges are
+    within the body.
+    """
+    unit, sep, range_set = range_header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    range_specs = range_set.split(',')
+    if len(range_specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for range_spec in range_specs:
+        range_spec = range_spec.strip()
+        if not range_spec:
+            continue
+
+        match = RANGE_SPEC.match(range_spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= length:
+                continue
+            stop = min(int(last) + 1, length) if last else length
+        elif last:
+            # The last N bytes
+            suffix_length = int(last)
+            if not suffix_length:
+                continue
+            start = max(length - suffix_length, 0)
+            stop = length
+        else:
+            return None
+
+        ranges.append((start, stop))
+
+    if not ranges:
+        raise RangeNotSatisfiable("None of %s is within %d bytes" % (range_header, length))
+
+    ranges.sort()
+    merged_ranges = [ranges[0]]
+    for start, stop in ranges[1:]:
+        last_start, last_stop = merged_ranges[-1]
+        if start <= last_stop:
+            merged_ranges[-1] = (last_start, max(stop, last_stop))
+        else:
+            merged_ranges.append((start, stop))
+
+    return merged_ranges
+
+def if_range_matches(if_range, headers):
+    """
+    Return whether a response with ``headers`` is the one an
+    ``If-Range`` header was sent for, going by its ``ETag`` or
+    ``Last-Modified`` header. Weak entity tags never match.
+    """
+    if if_range.startswith('W/'):
+        return False
+
+    header_name = 'etag' if if_range.startswith('"') else 'last-modified'
+    for name, value in headers:
+        if name.lower() == header_name:
+            return value == if_range
+
+    return False
+
+class RangeRequest(object):
+    """
+    Wraps ``start_response`` to send only the byte ranges a request
+    asked for out of a complete (200) response.
+
+    The ranges can only be chosen once the length of the body is known,
+    so the response's headers are held back until :meth:`begin` is
+    called, with the length of the body if the application didn't give
+    a ``Content-Length``. The body is then passed through
+    :meth:`select`, or for a file, :attr:`parts` are sent from it.
+
+    If ranges don't apply to the response, it is sent in full and
+    :attr:`parts` is ``None``.
+    """
+
+    __slots__ = (
+        '_start_response',
+        '_write',
+        'range_header',
+        'if_range',
+        'status',
+        'headers',
+        'parts',
+        'trailer',
+        'offset',
+        'part_index',
+    )
+
+    def __init__(self, start_response, range_header, if_range=None):
+        self._start_response = start_response
+        self._write = None
+        self.range_header = range_header
+        self.if_range = if_range
+        self.status = None
+        self.headers = None
+        # (part header, start, stop) for each range to send
+        self.parts = None
+        self.trailer = b""
+        # Position in the full body
+        self.offset = 0
+        self.part_index = 0
+
+    def start_response(self, status, headers, exc_info=None):
+        if self._write is not None:
+            # The response writer replaces the headers or re-raises,
+            # and an error response is sent in full
+            self.parts = None
+            self.trailer = b""
+            self._write = self._start_response(status, headers, exc_info)
+        else:
+            self.status = status
+            self.headers = headers
+
+        return self.write
+
+    def write(self, data):
+        self.begin()
+        for piece in self.select(data):
+            self._write(piece)
+
+    def begin(self, length=None):
+        """
+        Choose the ranges to send and pass on the headers for them.
+        """
+        if self._write is not None or self.status is None:
+            return
+
+        status = self.status
+        headers = self.headers
+        content_length = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    pass
+                break
+        if content_length is not None:
+            length = content_length
+
+        if status[:3] == '200' and length is not None and (
+            self.if_range is None or if_range_matches(self.if_range, headers)
+        ):
+            try:
+                ranges = parse_range(self.range_header, length)
+            except RangeNotSatisfiable:
+                logger.debug("Range not satisfiable: %s", self.range_header)
+                status = '416 Range Not Satisfiable'
+                headers = self._drop_headers(headers, ('content-length',)) + [
+                    ('Content-Range', 'bytes */%d' % length),
+                    ('Content-Length', '0'),
+                ]
+                self.parts = []
+            else:
+                if ranges is not None:
+                    status = '206 Partial Content'
+                    headers = self._get_partial_headers(headers, ranges, length)
+
+        self._write = self._start_response(status, headers)
+
+    @staticmethod
+    def _drop_headers(headers, header_names):
+        return [header for header in headers if header[0].lower() not in header_names]
+
+    def _get_partial_headers(self, headers, ranges, length):
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            self.parts = [(b"", start, stop)]
+            return self._drop_headers(headers, ('content-length',)) + [
+                ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, length)),
+                ('Content-Length', str(stop - start)),
+            ]
+
+        content_type = None
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                content_type = value
+                break
+
+        boundary = uuid.uuid4().hex
+        self.parts = []
+        for start, stop in ranges:
+            part_header = "\r\n--%s\r\n" % boundary
+            if content_type is not None:
+                part_header += "Content-Type: %s\r\n" % content_type
+            part_header += "Content-Range: bytes %d-%d/%d\r\n\r\n" % (start, stop - 1, length)
+            self.parts.append((part_header.encode(const.STR_ENCODING), start, stop))
+        self.trailer = ("\r\n--%s--\r\n" % boundary).encode(const.STR_ENCODING)
+
+        content_length = len(self.trailer) + sum(
+            len(part_header) + stop - start
+            for part_header, start, stop in self.parts
+        )
+        return self._drop_headers(headers, ('content-length', 'content-type')) + [
+            ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary),
+            ('Content-Length', str(content_length)),
+        ]
+
+    @property
+    def done(self):
+        """
+        Whether every range has been sent, so that the rest of the body
+        isn't needed.
+        """
+        return self.parts is not None and self.part_index == len(self.parts)
+
+    def select(self, data):
+        """
+        Return the pieces to send out of ``data``, the next chunk of
+        the full body.
+        """
+        if self.parts is None:
+            return [data]
+
+        pieces = []
+        data_start = self.offset
+        data_stop = data_start + len(data)
+        self.offset = data_stop
+
+        while self.part_index < len(self.parts):
+            part_header, start, stop = self.parts[self.part_index]
+            if start >= data_stop:
+                break
+
+            if start >= data_start and part_header:
+                pieces.append(part_header)
+            pieces.append(data[max(start - data_start, 0):min(stop, data_stop) - data_start])
+            if stop > data_stop:
+                break
+
+            self.part_index += 1
+            if self.part_index == len(self.parts) and self.trailer:
+                pieces.append(self.trailer)
+
+        return pieces
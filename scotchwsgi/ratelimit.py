@@ -0,0 +1,105 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from scotchwsgi import const
+
+logger = logging.getLogger(__name__)
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Retry after %ds" % retry_after)
+        self.retry_after = retry_after
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter(object):
+    """
+    Limits each client to ``max_connections`` open connections and
+    ``rate`` requests a second, with bursts of up to ``burst`` requests.
+
+    Buckets are kept for at most ``max_clients`` clients, the least
+    recently seen being dropped first. A client whose bucket has filled
+    back up is no different from one never seen, so :meth:`sweep`
+    drops those too.
+    """
+
+    def __init__(self, rate=None, burst=None, max_connections=None,
+                 max_clients=const.RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst or (max(rate, 1) if rate else None)
+        self.max_connections = max_connections
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.connections = {}
+
+    def acquire_connection(self, client):
+        """
+        Count a new connection from ``client``, returning ``False`` if
+        it already has too many open.
+        """
+        if self.max_connections is None:
+            return True
+
+        count = self.connections.get(client, 0)
+        if count >= self.max_connections:
+            return False
+
+        self.connections[client] = count + 1
+        return True
+
+    def release_connection(self, client):
+        if self.max_connections is None:
+            return
+
+        count = self.connections.get(client, 0) - 1
+        if count > 0:
+            self.connections[client] = count
+        else:
+            self.connections.pop(client, None)
+
+    def allow_request(self, client):
+        """
+        Take a token from ``client``'s bucket. Returns ``0`` if the
+        request is allowed, otherwise the number of seconds to wait.
+        """
+        if self.rate is None:
+            return 0
+
+        now = time.monotonic()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.burst, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+
+        if bucket.tokens < 1:
+            return math.ceil((1 - bucket.tokens) / self.rate)
+
+        bucket.tokens -= 1
+        return 0
+
+    def sweep(self):
+        """
+        Drop the buckets of clients that have been idle long enough for
+        them to fill back up.
+        """
+        idle_time = self.burst / self.rate
+        now = time.monotonic()
+
+        # Buckets are in order of last use, so stop at the first active one
+        while self.buckets:
+            client, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated < idle_time:
+                break
+            del self.buckets[client]
@@ -1,10 +1,38 @@
 import logging
+import re
+from io import BytesIO
 
 from scotchwsgi import const
 
 logger = logging.getLogger(__name__)
 
+# int() also accepts signs, whitespace and underscores, none of which
+# are allowed in body sizes
+CONTENT_LENGTH = re.compile(r'[0-9]+\Z')
+CHUNK_SIZE = re.compile(rb'[0-9a-fA-F]+\Z')
+
+class RequestHeaderFieldsTooLarge(ValueError):
+    pass
+
+class RequestEntityTooLarge(ValueError):
+    pass
+
+class ExpectationFailed(ValueError):
+    pass
+
+def read_line(reader, max_size=None):
+    if max_size is None:
+        return reader.readline()
+
+    line = reader.readline(max_size + 1)
+    if len(line) > max_size:
+        raise RequestHeaderFieldsTooLarge("Line exceeds %d bytes" % max_size)
+
+    return line
+
 class WSGIRequest(object):
+    __slots__ = ('method', 'path', 'query', 'http_version', 'headers', 'body')
+
     def __init__(self, method, path, query, http_version, headers, body):
         self.method = method
         self.path = path
@@ -13,9 +41,16 @@ class WSGIRequest(object):
         self.headers = headers
         self.body = body
 
+    @property
+    def request_line(self):
+        if self.query:
+            return "%s %s?%s %s" % (self.method, self.path, self.query, self.http_version)
+        else:
+            return "%s %s %s" % (self.method, self.path, self.http_version)
+
     @staticmethod
-    def read_request_line(reader):
-        request_line = reader.readline().decode(const.STR_ENCODING)
+    def read_request_line(reader, max_size=None):
+        request_line = read_line(reader, max_size).decode(const.STR_ENCODING)
         logger.info("Received request %s", request_line)
 
         try:
@@ -34,13 +69,23 @@ class WSGIRequest(object):
         return request_method, request_path, request_query, http_version
 
     @staticmethod
-    def read_headers(reader):
+    def read_headers(reader, max_size=None, max_count=None):
         headers = {}
+        header_count = 0
+        remaining_size = max_size
         while True:
-            header = reader.readline().decode(const.STR_ENCODING).replace('\r\n', '\n').rstrip('\n')
+            header = read_line(reader, remaining_size)
+            if remaining_size is not None:
+                remaining_size -= len(header)
+
+            header = header.decode(const.STR_ENCODING).replace('\r\n', '\n').rstrip('\n')
             if header == '':
                 break
 
+            header_count += 1
+            if max_count is not None and header_count > max_count:
+                raise RequestHeaderFieldsTooLarge("More than %d headers received" % max_count)
+
             try:
                 header_name, header_value = header.split(':', 1)
             except ValueError:
@@ -55,8 +100,15 @@ class WSGIRequest(object):
         return headers
 
     @staticmethod
-    def read_body(reader, content_length=None):
+    def read_body(reader, content_length=None, max_size=None):
         if content_length is not None:
+            if max_size is not None and content_length > max_size:
+                raise RequestEntityTooLarge(
+                    "content-length %d exceeds limit of %d bytes" % (
+                        content_length, max_size
+                    )
+                )
+
             logger.debug("Reading body (content-length: %d)", content_length)
             message_body = reader.read(content_length)
             logger.debug("Body: %s", message_body)
@@ -72,18 +124,39 @@ class WSGIRequest(object):
             message_body = b""
 
             while True:
-                chunk_length_hex = reader.readline().rstrip()
+                chunk_length_hex = read_line(reader, const.MAX_CHUNK_SIZE_LINE).rstrip()
                 logger.debug("Chunk length hex: %s", chunk_length_hex)
+                if not CHUNK_SIZE.match(chunk_length_hex):
+                    raise ValueError("Invalid chunk size: %r" % chunk_length_hex)
                 chunk_length = int(chunk_length_hex, 16)
                 logger.debug("Reading chunk of length %d", chunk_length)
                 if chunk_length == 0:
-                    while reader.readline() not in (b"\r\n", b"\n"):
-                        continue # Ignore trailer headers
+                    # Ignore trailer headers, up to the size allowed for headers
+                    remaining_size = const.MAX_HEADER_SIZE
+                    while True:
+                        trailer = read_line(reader, remaining_size)
+                        if trailer in (b"\r\n", b"\n"):
+                            break
+                        if not trailer:
+                            raise ValueError("Connection closed while reading chunk trailer")
+                        remaining_size -= len(trailer)
                     break
 
+                if max_size is not None and len(message_body) + chunk_length > max_size:
+                    raise RequestEntityTooLarge(
+                        "Chunked body exceeds limit of %d bytes" % max_size
+                    )
+
                 chunk_data = reader.read(chunk_length)
                 logger.debug("Chunk: %r", chunk_data)
-                chunk_newline = reader.readline()
+                if len(chunk_data) != chunk_length:
+                    raise ValueError(
+                        "Chunk of %d bytes too large, only read %d bytes" % (
+                            chunk_length, len(chunk_data)
+                        )
+                    )
+                if reader.read(2) != b"\r\n":
+                    raise ValueError("Chunk not followed by CRLF")
 
                 # Reconstruct message (though ideally the chunks should feed into the application as they arrive)
                 message_body += chunk_data
@@ -91,15 +164,7 @@ class WSGIRequest(object):
         return message_body
 
     @staticmethod
-    def from_reader(reader):
-        method, path, query, http_version = WSGIRequest.read_request_line(
-            reader
-        )
-
-        headers = WSGIRequest.read_headers(
-            reader
-        )
-
+    def read_message_body(reader, headers, max_size=None):
         transfer_encoding = headers.get('transfer-encoding')
         content_length = headers.get('content-length')
 
@@ -109,11 +174,64 @@ class WSGIRequest(object):
                     "Received unsupported transfer-encoding: %s" % transfer_encoding
                 )
 
-            body = WSGIRequest.read_body(reader)
+            return WSGIRequest.read_body(reader, max_size=max_size)
         elif content_length:
-            body = WSGIRequest.read_body(reader, int(content_length))
+            if not CONTENT_LENGTH.match(content_length):
+                raise ValueError("Invalid content-length: %s" % content_length)
+            content_length = int(content_length)
+
+            return WSGIRequest.read_body(reader, content_length, max_size)
+        else:
+            return b""
+
+    @staticmethod
+    def from_reader(reader, writer=None, max_header_size=None, max_header_count=None, max_body_size=None,
+                    parser=None, on_headers=None):
+        """
+        Read a request from ``reader``.
+
+        The request line and headers are read with ``parser`` (see
+        :mod:`scotchwsgi.parser`), or in pure Python if not given.
+        ``on_headers``, if given, is called once they have been read,
+        before the body.
+
+        If ``writer`` is given, the body of a request sent with
+        ``Expect: 100-continue`` is not read until the application
+        first reads from it, see :class:`ContinueReader`.
+        """
+        if parser is not None:
+            method, path, query, http_version, headers = parser.parse_head(
+                reader,
+                max_header_size,
+                max_header_count,
+            )
         else:
-            body = b""
+            method, path, query, http_version = WSGIRequest.read_request_line(
+                reader,
+                max_header_size,
+            )
+
+            headers = WSGIRequest.read_headers(
+                reader,
+                max_header_size,
+                max_header_count,
+            )
+
+        if on_headers is not None:
+            on_headers()
+
+        expect = headers.get('expect')
+        if expect and http_version != 'HTTP/1.0':
+            # RFC 7231 5.1.1: HTTP/1.0 expectations must be ignored
+            if expect.lower() != '100-continue':
+                raise ExpectationFailed("Received unsupported expectation: %s" % expect)
+
+            if writer is not None:
+                body = ContinueReader(reader, writer, headers, max_body_size)
+            else:
+                body = WSGIRequest.read_message_body(reader, headers, max_body_size)
+        else:
+            body = WSGIRequest.read_message_body(reader, headers, max_body_size)
 
         return WSGIRequest(
             method=method,
@@ -123,3 +241,59 @@ class WSGIRequest(object):
             headers=headers,
             body=body,
         )
+
+class ContinueReader(object):
+    """
+    ``wsgi.input`` for requests sent with ``Expect: 100-continue``.
+
+    ``100 Continue`` is only sent (and the body only read) when the
+    application first reads the input, so requests the application
+    rejects without looking at the body don't cost an upload.
+    """
+
+    __slots__ = ('reader', 'writer', 'headers', 'max_size', 'body')
+
+    def __init__(self, reader, writer, headers, max_size=None):
+        self.reader = reader
+        self.writer = writer
+        self.headers = headers
+        self.max_size = max_size
+        self.body = None
+
+        content_length = headers.get('content-length')
+        if max_size is not None and content_length and content_length.isdigit():
+            if int(content_length) > max_size:
+                # Reject before the client has sent anything
+                raise RequestEntityTooLarge(
+                    "content-length %s exceeds limit of %d bytes" % (
+                        content_length, max_size
+                    )
+                )
+
+    @property
+    def consumed(self):
+        return self.body is not None
+
+    def _get_body(self):
+        if self.body is None:
+            logger.debug("Sending 100 Continue")
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            self.writer.flush()
+
+            self.body = BytesIO(
+                WSGIRequest.read_message_body(self.reader, self.headers, self.max_size)
+            )
+
+        return self.body
+
+    def read(self, size=-1):
+        return self._get_body().read(size)
+
+    def readline(self, size=-1):
+        return self._get_body().readline(size)
+
+    def readlines(self, hint=-1):
+        return self._get_body().readlines(hint)
+
+    def __iter__(self):
+        return iter(self._get_body())
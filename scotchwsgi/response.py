@@ -1,15 +1,53 @@
+import io
 import logging
+import os
+import stat
+import time
+from email.utils import formatdate
+
+import gevent
+import gevent.lock
+import gevent.socket
 
 from scotchwsgi import const
 
 logger = logging.getLogger(__name__)
 
+class SendTimeout(Exception):
+    """
+    Raised when a client reads a response too slowly.
+    """
+
 class WSGIResponseHeaders(object):
-    def __init__(self, server_headers, app_headers):
+    """
+    The headers of a response, with those needed to frame its body
+    added.
+
+    A body without a ``Content-Length`` is sent chunked to HTTP/1.1
+    clients. HTTP/1.0 clients don't understand chunked encoding, so
+    for them it ends when the connection is closed instead.
+    """
+
+    __slots__ = (
+        'response_headers',
+        'has_connection_close',
+        'has_content_length',
+        'content_length',
+        'has_transfer_encoding_chunked',
+        'content_type',
+        'has_date',
+        'has_server',
+    )
+
+    def __init__(self, server_headers, app_headers, http_version='HTTP/1.1'):
         self.response_headers = []
         self.has_connection_close = False
         self.has_content_length = False
+        self.content_length = None
         self.has_transfer_encoding_chunked = False
+        self.content_type = None
+        self.has_date = False
+        self.has_server = False
 
         for header_name, header_value in server_headers:
             self.response_headers.append((header_name, header_value))
@@ -21,23 +59,193 @@ class WSGIResponseHeaders(object):
         for header_name, header_value in app_headers:
             self.response_headers.append((header_name, header_value))
 
-            if header_name.lower() == 'content-length':
+            header_name = header_name.lower()
+            if header_name == 'content-length':
                 self.has_content_length = True
+                self.content_length = header_value
+            elif header_name == 'content-type':
+                self.content_type = header_value.split(';', 1)[0].strip().lower()
+            elif header_name == 'date':
+                self.has_date = True
+            elif header_name == 'server':
+                self.has_server = True
 
         if not self.has_content_length and not self.has_connection_close:
-            self.response_headers.append(('Transfer-Encoding', 'chunked'))
-            self.has_transfer_encoding_chunked = True
+            if http_version == 'HTTP/1.0':
+                self.response_headers = [
+                    header for header in self.response_headers
+                    if header[0].lower() != 'connection'
+                ]
+                self.response_headers.append(('Connection', 'close'))
+                self.has_connection_close = True
+            else:
+                self.response_headers.append(('Transfer-Encoding', 'chunked'))
+                self.has_transfer_encoding_chunked = True
 
     def __iter__(self):
         return iter(self.response_headers)
 
+class FileWrapper(object):
+    """
+    ``wsgi.file_wrapper``, which lets the worker send a file's contents
+    straight from the file with ``sendfile``. Files it can't be sent
+    that way are read ``block_size`` bytes at a time.
+    """
+
+    __slots__ = ('filelike', 'block_size')
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.block_size)
+        if data:
+            return data
+        raise StopIteration
+
+    def close(self):
+        close = getattr(self.filelike, 'close', None)
+        if callable(close):
+            close()
+
+    def get_file_range(self):
+        """
+        Return ``(fileno, offset, size)`` for the rest of the file, or
+        ``None`` if it isn't a regular file.
+        """
+        try:
+            fileno = self.filelike.fileno()
+            offset = self.filelike.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+        file_stat = os.fstat(fileno)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return fileno, offset, max(file_stat.st_size - offset, 0)
+
+class CachedHeaders(object):
+    """
+    Pre-encoded ``Date`` and ``Server`` header lines added to every
+    response.
+
+    The date only changes once a second, so rather than formatting it
+    for each response, :meth:`refresh` is called once a second by the
+    worker.
+    """
+
+    __slots__ = ('date', 'server')
+
+    def __init__(self, server_name=const.SERVER_NAME):
+        self.server = b"Server: " + server_name.encode(const.STR_ENCODING) + b"\r\n"
+        self.refresh()
+
+    def refresh(self, now=None):
+        self.date = b"Date: " + formatdate(now, usegmt=True).encode(const.STR_ENCODING) + b"\r\n"
+
 class WSGIResponseWriter(object):
-    def __init__(self, writer, server_headers=None):
+    """
+    Writes a response to ``writer``.
+
+    Body data is held in an output buffer until ``buffer_size`` bytes
+    have been written or the oldest buffered data is ``buffer_delay``
+    seconds old, so that many small writes go out as one chunk. Data
+    held for ``buffer_delay`` is sent by a timer even if the application
+    writes nothing more, e.g. while it waits for more to send.
+    Responses of a content type in ``streaming_content_types`` are
+    never buffered, and :meth:`flush` sends any buffered data
+    immediately.
+
+    A writer can be reused for each response on a connection by
+    calling :meth:`reset` between responses.
+
+    If ``cached_headers`` is given, its ``Date`` and ``Server`` headers
+    are sent with each response, unless the application set its own.
+    """
+
+    __slots__ = (
+        'writer',
+        'headers_to_send',
+        'headers_sent',
+        'server_headers',
+        'http_version',
+        'wrote_last_chunk',
+        'buffer_size',
+        'buffer_delay',
+        'streaming_content_types',
+        'buffer',
+        'buffered_size',
+        'buffered_since',
+        'streaming',
+        'cached_headers',
+        'send_timeout',
+        'response_send_timeout',
+        'send_time',
+        'send_timer',
+        'flush_timer',
+        'flush_lock',
+        'flush_error',
+        'trace',
+    )
+
+    def __init__(self, writer, server_headers=None, buffer_size=0, buffer_delay=None,
+                 streaming_content_types=const.STREAMING_CONTENT_TYPES, cached_headers=None,
+                 send_timeout=None, response_send_timeout=None, http_version='HTTP/1.1'):
         self.writer = writer
         self.headers_to_send = []
         self.headers_sent = []
         self.server_headers = server_headers or []
+        # The request's version, which decides how the body is framed
+        self.http_version = http_version
         self.wrote_last_chunk = False
+        self.buffer_size = buffer_size
+        self.buffer_delay = buffer_delay
+        self.streaming_content_types = streaming_content_types
+        self.buffer = []
+        self.buffered_size = 0
+        self.buffered_since = None
+        self.streaming = False
+        self.cached_headers = cached_headers
+        # Seconds a single write may block for, and that writes may
+        # block for in total while sending one response
+        self.send_timeout = send_timeout
+        self.response_send_timeout = response_send_timeout
+        self.send_time = 0
+        self.send_timer = None
+        # Made when first needed. The lock keeps the timer's flushes
+        # from interleaving with the application's writes, and an error
+        # in one is raised by the application's next write.
+        self.flush_timer = None
+        self.flush_lock = None
+        self.flush_error = None
+        # The request's RequestTrace, told when the first byte is sent
+        self.trace = None
+
+    def reset(self, server_headers=None, http_version='HTTP/1.1'):
+        del self.headers_to_send[:]
+        del self.headers_sent[:]
+        self.server_headers = server_headers or []
+        self.http_version = http_version
+        self.wrote_last_chunk = False
+        self.buffer.clear()
+        self.buffered_size = 0
+        self.buffered_since = None
+        self.streaming = False
+        self.send_time = 0
+        if self.flush_timer is not None:
+            self.flush_timer.stop()
+        self.flush_error = None
+
+    def start_streaming(self):
+        """
+        Mark the response as a stream (e.g. a long-poll response), so
+        that it is never buffered.
+        """
+        self.streaming = True
 
     def start_response(self, status, app_headers, exc_info=None):
         logger.debug("start_response %s %s %s", status, app_headers, exc_info)
@@ -56,6 +264,7 @@ class WSGIResponseWriter(object):
         response_headers = WSGIResponseHeaders(
             self.server_headers,
             app_headers,
+            self.http_version,
         )
 
         self.headers_to_send[:] = [status, response_headers]
@@ -69,41 +278,228 @@ class WSGIResponseWriter(object):
         if self.wrote_last_chunk:
             raise AssertionError("write() after last chunk written")
 
+        if self.flush_error is not None:
+            raise self.flush_error
+
         elif not self.headers_sent:
-            status, response_headers = self.headers_to_send[:]
+            status, response_headers = self.headers_to_send
             logger.debug("Send headers %s %s", status, response_headers)
 
-            self.writer.write(b"HTTP/1.1 ")
-            self.writer.write(status.encode(const.STR_ENCODING))
-            self.writer.write(b"\r\n")
-
+            header_lines = [b"HTTP/1.1 ", status.encode(const.STR_ENCODING), b"\r\n"]
+            cached_headers = self.cached_headers
+            if cached_headers is not None:
+                if not response_headers.has_date:
+                    header_lines.append(cached_headers.date)
+                if not response_headers.has_server:
+                    header_lines.append(cached_headers.server)
             for header_name, header_value in response_headers:
-                self.writer.write(header_name.encode(const.STR_ENCODING))
-                self.writer.write(b": ")
-                self.writer.write(header_value.encode(const.STR_ENCODING))
-                self.writer.write(b"\r\n")
+                header_lines.append(header_name.encode(const.STR_ENCODING))
+                header_lines.append(b": ")
+                header_lines.append(header_value.encode(const.STR_ENCODING))
+                header_lines.append(b"\r\n")
+            header_lines.append(b"\r\n")
 
-            self.writer.write(b"\r\n")
+            self._send(b"".join(header_lines))
+            if self.trace is not None:
+                self.trace.first_byte_at = time.time()
 
             self.headers_sent[:] = [status, response_headers]
 
-        if self.wrote_transfer_encoding_chunked:
-            chunk_size = len(data)
-            chunk_size_hex = b"%0.2X" % len(data)
+        if data:
+            self.buffer.append(data)
+            self.buffered_size += len(data)
+
+            first_buffered = self.buffered_since is None and self.buffer_delay is not None
+            if first_buffered:
+                self.buffered_since = time.monotonic()
+
+            if self._should_flush():
+                self.flush()
+            elif first_buffered:
+                self._start_flush_timer()
+        else:
+            self.flush()
+
+            if self.wrote_transfer_encoding_chunked:
+                self.wrote_last_chunk = True
+                self._send(b"0\r\n\r\n") # marks end of chunked encoding
+                self._send()
+
+    def _should_flush(self):
+        if self.buffered_size >= self.buffer_size:
+            return True
+
+        if self.is_streaming:
+            return True
+
+        if self.buffered_since is not None:
+            return time.monotonic() - self.buffered_since >= self.buffer_delay
+
+        return False
+
+    def flush(self):
+        if not self.headers_sent:
+            return
+
+        if self.flush_lock is None:
+            self._flush()
+        else:
+            with self.flush_lock:
+                if self.flush_error is not None:
+                    raise self.flush_error
+                self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            data = b"".join(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+            self.buffer.clear()
+            self.buffered_size = 0
+            if self.buffered_since is not None:
+                self.buffered_since = None
+                if self.flush_timer is not None:
+                    self.flush_timer.stop()
+
+            if self.wrote_transfer_encoding_chunked:
+                self._send(b"%0.2X\r\n%s\r\n" % (len(data), data))
+            else:
+                self._send(data)
+
+        self._send()
+
+    def _start_flush_timer(self):
+        if self.flush_timer is None:
+            self.flush_timer = gevent.get_hub().loop.timer(self.buffer_delay)
+            self.flush_lock = gevent.lock.Semaphore()
+        # The timer's callback runs in the hub, which can't block, so
+        # the flush is done in a greenlet of its own
+        self.flush_timer.start(gevent.spawn, self._flush_delayed)
+
+    def _flush_delayed(self):
+        with self.flush_lock:
+            # Already sent, or dropped by cancel_flush()
+            if not self.buffer or self.flush_error is not None:
+                return
+            try:
+                self._flush()
+            except (SendTimeout, OSError) as e:
+                self.flush_error = e
+
+    def cancel_flush(self):
+        """
+        Drop any buffered data, so that a response that failed part way
+        through isn't sent more of later by the flush timer.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.stop()
+        self.buffer.clear()
+        self.buffered_size = 0
+        self.buffered_since = None
 
-            self.writer.write(chunk_size_hex)
-            self.writer.write(b"\r\n")
+    def _get_send_timeout(self):
+        timeout = self.send_timeout
+        if self.response_send_timeout is not None:
+            remaining = self.response_send_timeout - self.send_time
+            if timeout is None or remaining < timeout:
+                timeout = max(remaining, 0)
+        return timeout
 
-            if chunk_size > 0:
+    def _send(self, data=None):
+        """
+        Write ``data`` to the client, or flush what has been written if
+        it is ``None``, raising :class:`SendTimeout` if that takes
+        longer than the send timeouts allow.
+        """
+        timeout = self._get_send_timeout()
+        if timeout is None:
+            if data is None:
+                self.writer.flush()
+            else:
                 self.writer.write(data)
-                self.writer.write(b"\r\n")
+            return
+
+        # A timer can't be rescheduled with a different timeout
+        if self.send_timer is None or self.send_timer.seconds != timeout:
+            self.send_timer = gevent.Timeout(timeout, SendTimeout)
+
+        started = time.monotonic()
+        self.send_timer.start()
+        try:
+            if data is None:
+                self.writer.flush()
             else:
-                self.wrote_last_chunk = True
-                self.writer.write(b"\r\n") # marks end of chunked encoding
+                self.writer.write(data)
+        finally:
+            self.send_timer.cancel()
+            self.send_time += time.monotonic() - started
+
+    def send_file(self, sock, fileno, offset, count):
+        """
+        Send ``count`` bytes of the file ``fileno`` from ``offset`` as
+        part of the body, copied straight from the file to ``sock`` by
+        the kernel. The response must have a ``Content-Length``.
+        """
+        if not self.headers_sent:
+            # Sends the headers
+            self.write(b"")
         else:
-            self.writer.write(data)
+            self.flush()
+
+        sock_fileno = sock.fileno()
+        started = time.monotonic()
+        try:
+            while count > 0:
+                try:
+                    sent = os.sendfile(sock_fileno, fileno, offset, count)
+                except BlockingIOError:
+                    gevent.socket.wait_write(
+                        sock_fileno,
+                        self._get_send_timeout(),
+                        SendTimeout,
+                    )
+                    continue
 
-        self.writer.flush()
+                if not sent:
+                    raise EOFError("File ended %d bytes short" % count)
+                offset += sent
+                count -= sent
+        finally:
+            self.send_time += time.monotonic() - started
+
+    def finish(self):
+        """
+        Send anything not yet sent, ending the response.
+        """
+        if not self.headers_sent or self.wrote_transfer_encoding_chunked:
+            # Force headers to be sent if nothing was written previously.
+            # In the case of chunked encoding, write an empty (i.e. the last) chunk
+            # to mark end of message
+            self.write(b"")
+        else:
+            self.flush()
+
+    @property
+    def content_type(self):
+        if not self.headers_to_send:
+            return None
+        status_, response_headers = self.headers_to_send
+        return response_headers.content_type
+
+    @property
+    def content_length(self):
+        """
+        The length of the body given by the application, or ``None``.
+        """
+        if not self.headers_to_send:
+            return None
+        status_, response_headers = self.headers_to_send
+        try:
+            return int(response_headers.content_length)
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def is_streaming(self):
+        return self.streaming or self.content_type in self.streaming_content_types
 
     @property
     def wrote_connection_close(self):
@@ -0,0 +1,291 @@
+import logging
+import mmap
+import struct
+import time
+
+from scotchwsgi import const
+
+logger = logging.getLogger(__name__)
+
+STATE_FREE = 0
+STATE_IDLE = 1
+STATE_READ = 2
+STATE_APP = 3
+STATE_WRITE = 4
+STATE_STREAM = 5
+
+STATE_NAMES = {
+    STATE_FREE: 'free',
+    STATE_IDLE: 'keepalive',
+    STATE_READ: 'read',
+    STATE_APP: 'app',
+    STATE_WRITE: 'write',
+    STATE_STREAM: 'stream',
+}
+
+# Request timer phases that correspond to a state
+PHASE_STATES = {
+    'read': STATE_READ,
+    'app': STATE_APP,
+    'write': STATE_WRITE,
+    'stream': STATE_STREAM,
+}
+
+# pid, requests, connections, slow clients, started at, busy time, busy since
+WORKER_FORMAT = struct.Struct('=iQQQddd')
+# state, since, client, request line
+CONNECTION_FORMAT = struct.Struct('=Bd46s256s')
+REQUEST_LINE_FORMAT = struct.Struct('=256s')
+REQUEST_LINE_OFFSET = CONNECTION_FORMAT.size - REQUEST_LINE_FORMAT.size
+
+class Scoreboard(object):
+    """
+    Shared memory with a fixed-size slot for each worker and each of
+    its connections.
+
+    The memory is created by the master before workers are forked, so
+    that all of them share it. Each slot is only ever written by the
+    worker it belongs to and is read without locking, so a slot read
+    while it is being updated may be inconsistent. That is good enough
+    for showing what the workers are doing.
+    """
+
+    def __init__(self, num_workers, connections_per_worker=const.MAX_CONNECTIONS):
+        self.num_workers = num_workers
+        self.connections_per_worker = connections_per_worker
+        self.worker_size = WORKER_FORMAT.size + connections_per_worker * CONNECTION_FORMAT.size
+        self.memory = mmap.mmap(-1, num_workers * self.worker_size)
+
+    def worker(self, index):
+        return WorkerScoreboard(self, index)
+
+    def _read_worker(self, index):
+        offset = index * self.worker_size
+        pid, requests, connections, slow_clients, started_at, _, _ = WORKER_FORMAT.unpack_from(
+            self.memory,
+            offset,
+        )
+
+        connection_slots = []
+        offset += WORKER_FORMAT.size
+        for _ in range(self.connections_per_worker):
+            state, since, client, request_line = CONNECTION_FORMAT.unpack_from(self.memory, offset)
+            if state != STATE_FREE:
+                connection_slots.append((
+                    state,
+                    since,
+                    client.rstrip(b"\0").decode(const.STR_ENCODING),
+                    request_line.rstrip(b"\0").decode(const.STR_ENCODING),
+                ))
+            offset += CONNECTION_FORMAT.size
+
+        return pid, requests, connections, slow_clients, started_at, connection_slots
+
+    def get_busy_time(self, index, now=None):
+        """
+        Return ``(pid, busy_time)`` for a worker, where ``busy_time`` is
+        the number of seconds it has had at least one request in flight.
+        """
+        if now is None:
+            now = time.time()
+
+        pid, _, _, _, _, busy_time, busy_since = WORKER_FORMAT.unpack_from(
+            self.memory,
+            index * self.worker_size,
+        )
+        if busy_since:
+            busy_time += now - busy_since
+        return pid, busy_time
+
+    def clear(self, index):
+        """
+        Clear the slots of a worker that has exited for good.
+        """
+        offset = index * self.worker_size
+        self.memory[offset:offset + self.worker_size] = bytes(self.worker_size)
+
+    def render(self):
+        """
+        Return a plain text report of every worker and its busy
+        connections, longest running first.
+        """
+        now = time.time()
+        lines = []
+        for index in range(self.num_workers):
+            pid, requests, connections, slow_clients, started_at, connection_slots = self._read_worker(index)
+            if not pid:
+                lines.append("Worker %d: not running" % index)
+                continue
+
+            counts = dict.fromkeys(STATE_NAMES, 0)
+            for state, _, _, _ in connection_slots:
+                counts[state] += 1
+
+            lines.append("Worker %d (PID %d): up %ds, %d requests, %d connections, %d slow clients dropped, %s" % (
+                index,
+                pid,
+                now - started_at,
+                requests,
+                connections,
+                slow_clients,
+                ' '.join(
+                    '%s=%d' % (STATE_NAMES[state], count)
+                    for state, count in counts.items()
+                    if state != STATE_FREE
+                ),
+            ))
+
+            busy_slots = sorted(
+                (slot for slot in connection_slots if slot[0] != STATE_IDLE),
+                key=lambda slot: slot[1],
+            )
+            for state, since, client, request_line in busy_slots:
+                lines.append("    %-9s %8.3fs  %-20s %s" % (
+                    STATE_NAMES.get(state, '?'),
+                    now - since,
+                    client,
+                    request_line,
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+class WorkerScoreboard(object):
+    """
+    A worker's part of the :class:`Scoreboard`.
+    """
+
+    def __init__(self, scoreboard, index):
+        self.memory = scoreboard.memory
+        self.offset = index * scoreboard.worker_size
+        self.connections_offset = self.offset + WORKER_FORMAT.size
+        self.free_slots = list(range(scoreboard.connections_per_worker - 1, -1, -1))
+        self.pid = 0
+        self.started_at = 0
+        self.requests = 0
+        self.connections = 0
+        self.slow_clients = 0
+        self.active_requests = 0
+        self.busy_time = 0
+        self.busy_since = 0
+
+    def start(self, pid):
+        # Clear anything left by the worker this one replaces
+        end = self.connections_offset + len(self.free_slots) * CONNECTION_FORMAT.size
+        self.memory[self.offset:end] = bytes(end - self.offset)
+
+        self.pid = pid
+        self.started_at = time.time()
+        self._write()
+
+    def _write(self):
+        WORKER_FORMAT.pack_into(
+            self.memory,
+            self.offset,
+            self.pid,
+            self.requests,
+            self.connections,
+            self.slow_clients,
+            self.started_at,
+            self.busy_time,
+            self.busy_since,
+        )
+
+    def count_slow_client(self):
+        self.slow_clients += 1
+        self._write()
+
+    def start_request(self):
+        self.requests += 1
+        self.active_requests += 1
+        if self.active_requests == 1:
+            self.busy_since = time.time()
+        self._write()
+
+    def finish_request(self):
+        self.active_requests -= 1
+        if not self.active_requests:
+            self.busy_time += time.time() - self.busy_since
+            self.busy_since = 0
+        self._write()
+
+    def acquire(self, client):
+        """
+        Return a slot for a new connection from ``client``, or ``None``
+        if all are in use.
+        """
+        self.connections += 1
+        self._write()
+
+        if not self.free_slots:
+            return None
+
+        index = self.free_slots.pop()
+        return ConnectionSlot(
+            self,
+            index,
+            self.connections_offset + index * CONNECTION_FORMAT.size,
+            client,
+        )
+
+class ConnectionSlot(object):
+    """
+    The scoreboard slot of one connection. Its time is when the current
+    request (or wait for one) started, so that stuck requests stand out.
+    """
+
+    __slots__ = ('worker_scoreboard', 'index', 'offset', 'client', 'busy')
+
+    def __init__(self, worker_scoreboard, index, offset, client):
+        self.worker_scoreboard = worker_scoreboard
+        self.index = index
+        self.offset = offset
+        self.client = client[:46].encode(const.STR_ENCODING, 'replace')
+        self.busy = False
+        self.start(STATE_IDLE)
+
+    def start(self, state):
+        CONNECTION_FORMAT.pack_into(
+            self.worker_scoreboard.memory,
+            self.offset,
+            state,
+            time.time(),
+            self.client,
+            b"",
+        )
+
+    def set_state(self, state):
+        self.worker_scoreboard.memory[self.offset] = state
+
+    def set_phase(self, phase):
+        """
+        Update the state from a :class:`RequestTimer` phase.
+        """
+        state = PHASE_STATES.get(phase)
+        if state is not None:
+            self.set_state(state)
+        if state == STATE_STREAM:
+            # A stream can stay open indefinitely without keeping the
+            # worker busy
+            self.finish_request()
+
+    def start_request(self, request_line):
+        self.set_request_line(request_line)
+        self.busy = True
+        self.worker_scoreboard.start_request()
+
+    def finish_request(self):
+        if self.busy:
+            self.busy = False
+            self.worker_scoreboard.finish_request()
+
+    def set_request_line(self, request_line):
+        REQUEST_LINE_FORMAT.pack_into(
+            self.worker_scoreboard.memory,
+            self.offset + REQUEST_LINE_OFFSET,
+            request_line.encode(const.STR_ENCODING, 'replace'),
+        )
+
+    def release(self):
+        self.finish_request()
+        self.worker_scoreboard.memory[self.offset:self.offset + CONNECTION_FORMAT.size] = bytes(CONNECTION_FORMAT.size)
+        self.worker_scoreboard.free_slots.append(self.index)
@@ -1,81 +1,413 @@
 import logging
 import multiprocessing
+import multiprocessing.connection
 import os
 import signal
 import ssl
 import sys
 import time
 
-from gevent import socket
-
-from scotchwsgi.worker import start_new_worker
+from scotchwsgi import const
+from scotchwsgi.affinity import get_worker_cpu_sets
+from scotchwsgi.autoscale import Autoscaler
+from scotchwsgi.listeners import (
+    configure_listener,
+    create_listener,
+    format_address,
+    get_server_name,
+    get_systemd_listeners,
+)
+from scotchwsgi.scoreboard import Scoreboard
+from scotchwsgi.worker import CONTROL_DRAIN, start_new_worker
 
 logger = logging.getLogger(__name__)
 
 class WSGIServer(object):
-    def __init__(self, host, port, app_location, ssl_config=None, backlog=None, num_workers=1, request_timeout=30):
+    def __init__(self, host, port, app_location, ssl_config=None, backlog=None, num_workers=1, request_timeout=30,
+                 max_blocking_time=None, slow_request_threshold=None,
+                 max_header_size=const.MAX_HEADER_SIZE, max_header_count=const.MAX_HEADER_COUNT,
+                 max_body_size=None, write_buffer_size=0, write_buffer_delay=None,
+                 streaming_content_types=const.STREAMING_CONTENT_TYPES,
+                 heartbeat_interval=const.HEARTBEAT_INTERVAL, max_streams=const.MAX_STREAMS,
+                 parser='auto', max_requests=None, max_requests_jitter=0, max_rss=None,
+                 graceful_timeout=const.GRACEFUL_TIMEOUT, binds=None, unix_socket_mode=None,
+                 tcp_nodelay=True, defer_accept=None, fastopen=None, send_buffer_size=None,
+                 receive_buffer_size=None, cache_size=0, cache_vary_headers=(),
+                 single_flight=False, max_connections_per_client=None, rate_limit=None,
+                 rate_limit_burst=None, scoreboard=True, status_path=None, min_workers=None,
+                 max_workers=None, scale_up_ratio=const.AUTOSCALE_UP_RATIO,
+                 scale_down_ratio=const.AUTOSCALE_DOWN_RATIO,
+                 scale_cooldown=const.AUTOSCALE_COOLDOWN, cpu_affinity=None,
+                 cpu_affinity_interface=None, send_timeout=const.SEND_TIMEOUT,
+                 response_send_timeout=None, notsent_lowat=None, header_timeout=const.HEADER_TIMEOUT,
+                 header_max_timeout=const.HEADER_MAX_TIMEOUT, header_min_rate=const.HEADER_MIN_RATE,
+                 body_timeout=const.BODY_TIMEOUT, body_min_rate=const.BODY_MIN_RATE, health_path=None,
+                 readiness_path=None, tracing=False, trace_exporter=None):
         self.host = host
         self.port = port
+        # Each address is a (host, port) tuple or a Unix domain socket path
+        self.binds = binds or [(host, port)]
+        self.unix_socket_mode = unix_socket_mode
+        self.tcp_nodelay = tcp_nodelay
+        self.defer_accept = defer_accept
+        self.fastopen = fastopen
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self.cache_size = cache_size
+        self.cache_vary_headers = cache_vary_headers
+        self.single_flight = single_flight
+        self.max_connections_per_client = max_connections_per_client
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst
+        self.enable_scoreboard = scoreboard
+        self.status_path = status_path
+        self.health_path = health_path
+        self.readiness_path = readiness_path
+        self.tracing = tracing
+        self.trace_exporter = trace_exporter
         self.app_location = app_location
         self.ssl_config = ssl_config
         self.backlog = backlog
+        # Autoscaling is enabled by giving a maximum number of workers
+        self.min_workers = min_workers or 1
+        self.max_workers = max_workers
+        if max_workers:
+            num_workers = max(self.min_workers, min(num_workers, max_workers))
+        self.scale_up_ratio = scale_up_ratio
+        self.scale_down_ratio = scale_down_ratio
+        self.scale_cooldown = scale_cooldown
         self.num_workers = num_workers
+        self.cpu_affinity = cpu_affinity
+        self.cpu_affinity_interface = cpu_affinity_interface
+        self.send_timeout = send_timeout
+        self.response_send_timeout = response_send_timeout
+        self.notsent_lowat = notsent_lowat
+        self.header_timeout = header_timeout
+        self.header_max_timeout = header_max_timeout
+        self.header_min_rate = header_min_rate
+        self.body_timeout = body_timeout
+        self.body_min_rate = body_min_rate
+        self.worker_cpu_sets = []
         self.request_timeout = request_timeout
+        self.max_blocking_time = max_blocking_time
+        self.slow_request_threshold = slow_request_threshold
+        self.max_header_size = max_header_size
+        self.max_header_count = max_header_count
+        self.max_body_size = max_body_size
+        self.write_buffer_size = write_buffer_size
+        self.write_buffer_delay = write_buffer_delay
+        self.streaming_content_types = streaming_content_types
+        self.heartbeat_interval = heartbeat_interval
+        self.max_streams = max_streams
+        self.parser = parser
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss = max_rss
+        self.graceful_timeout = graceful_timeout
         self.worker_processes = []
+        self.control_pipes = []
+        # (worker index, process, control pipe) of workers draining
+        # before being removed
+        self.retiring_workers = []
+        self.autoscaler = None
+        self.socks = []
+        self.server_names = []
+        self.unix_socket_paths = []
+        self.scoreboard = None
 
     def start(self, blocking=True):
-        self.sock = socket.socket()
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
+        self.socks = get_systemd_listeners()
+        if self.socks:
+            logger.info("Using %d sockets passed by systemd", len(self.socks))
+            self.server_names = [self.host] * len(self.socks)
+        else:
+            self.socks = [
+                create_listener(address, self.backlog, self.unix_socket_mode)
+                for address in self.binds
+            ]
+            self.unix_socket_paths = [address for address in self.binds if isinstance(address, str)]
+            self.server_names = [get_server_name(address, self.host) for address in self.binds]
+
+        for sock in self.socks:
+            configure_listener(
+                sock,
+                defer_accept=self.defer_accept,
+                fastopen=self.fastopen,
+                send_buffer_size=self.send_buffer_size,
+                receive_buffer_size=self.receive_buffer_size,
+            )
+            logger.info("Listening on %s", format_address(sock.getsockname()))
+
         if self.ssl_config:
             logger.info("Using SSL")
-            self.sock = ssl.wrap_socket(
-                self.sock,
-                server_side=True,
-                **self.ssl_config,
-            )
+            self.socks = [
+                ssl.wrap_socket(
+                    sock,
+                    server_side=True,
+                    **self.ssl_config,
+                )
+                for sock in self.socks
+            ]
 
-        if self.backlog:
-            self.sock.listen(self.backlog)
-        else:
-            self.sock.listen()
+        self.sock = self.socks[0]
 
-        logger.info("Listening on %s:%d", self.host, self.port)
+        if self.cpu_affinity:
+            self.worker_cpu_sets = get_worker_cpu_sets(self.cpu_affinity, self.cpu_affinity_interface)
 
-        for worker_index in range(self.num_workers):
-            worker_process = multiprocessing.Process(
-                name="worker-%d"%worker_index,
-                target=start_new_worker,
-                args=(
-                    self.app_location,
-                    self.sock,
-                    self.host,
-                    os.getpid(),
-                    self.request_timeout,
-                )
+        if self.enable_scoreboard or self.max_workers:
+            # Created before the workers are forked so that they share it
+            self.scoreboard = Scoreboard(self.max_workers or self.num_workers)
+
+        if self.max_workers:
+            self.autoscaler = Autoscaler(
+                self.scoreboard,
+                self.socks,
+                self.min_workers,
+                self.max_workers,
+                scale_up_ratio=self.scale_up_ratio,
+                scale_down_ratio=self.scale_down_ratio,
+                cooldown=self.scale_cooldown,
             )
-            worker_process.start()
+
+        for worker_index in range(self.num_workers):
+            worker_process, control_pipe = self._start_worker(worker_index)
             self.worker_processes.append(worker_process)
+            self.control_pipes.append(control_pipe)
 
         signal.signal(signal.SIGTERM, self.handle_signal)
         signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGUSR1, self.handle_status)
 
         self.alive = True
         if blocking:
+            self._run()
+
+    def _run(self):
+        # Signals are written to a pipe so that waiting for a worker to
+        # exit can also be interrupted by them, without polling
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        previous_wakeup_fd = signal.set_wakeup_fd(wakeup_w)
+
+        if self.autoscaler is not None:
+            timeout = const.AUTOSCALE_INTERVAL
+        else:
+            timeout = None
+        next_autoscale = time.monotonic() + const.AUTOSCALE_INTERVAL
+
+        try:
             while self.alive:
-                time.sleep(1)
+                multiprocessing.connection.wait(
+                    [worker_process.sentinel for worker_process in self.worker_processes] +
+                    [worker_process.sentinel for _, worker_process, _ in self.retiring_workers] +
+                    [wakeup_r],
+                    timeout,
+                )
+
+                try:
+                    os.read(wakeup_r, 512)
+                except BlockingIOError:
+                    pass
+
+                self.remove_retired_workers()
+                self.replace_dead_workers()
+
+                if self.autoscaler is not None and self.alive and time.monotonic() >= next_autoscale:
+                    self.autoscale()
+                    next_autoscale = time.monotonic() + const.AUTOSCALE_INTERVAL
+        finally:
+            signal.set_wakeup_fd(previous_wakeup_fd)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+
+    def _start_worker(self, worker_index):
+        # The worker learns of the master exiting when this pipe closes,
+        # which it can only do if no other worker holds its write end
+        control_pipe_r, control_pipe_w = multiprocessing.Pipe(duplex=False)
+        control_pipes = self.control_pipes + [pipe for _, _, pipe in self.retiring_workers]
+        inherited_fds = [pipe.fileno() for pipe in control_pipes if not pipe.closed]
+        inherited_fds.append(control_pipe_w.fileno())
+
+        worker_options = self._get_worker_options()
+        worker_options['control_pipe'] = control_pipe_r
+        worker_options['inherited_fds'] = inherited_fds
+        worker_options['extra_socks'] = self.socks[1:]
+        worker_options['server_names'] = self.server_names
+        worker_options['worker_index'] = worker_index
+        if self.worker_cpu_sets:
+            worker_options['cpu_affinity'] = self.worker_cpu_sets[worker_index % len(self.worker_cpu_sets)]
+
+        worker_process = multiprocessing.Process(
+            name="worker-%d"%worker_index,
+            target=start_new_worker,
+            args=(
+                self.app_location,
+                self.socks[0],
+                self.host,
+                os.getpid(),
+                self.request_timeout,
+            ),
+            kwargs=worker_options,
+        )
+        worker_process.start()
+        control_pipe_r.close()
+
+        return worker_process, control_pipe_w
+
+    def replace_dead_workers(self):
+        """
+        Start a new worker in place of each one that has exited, e.g.
+        after reaching its request or memory limit.
+        """
+        for worker_index, worker_process in enumerate(self.worker_processes):
+            if not self.alive:
+                break
+
+            if not worker_process.is_alive():
+                logger.info(
+                    "Worker process %d (PID: %d) exited with code %s, replacing it",
+                    worker_index,
+                    worker_process.pid,
+                    worker_process.exitcode,
+                )
+                if worker_process.exitcode:
+                    # Don't spin if the worker fails on start up
+                    time.sleep(const.WORKER_RESTART_DELAY)
+                    if not self.alive:
+                        break
+
+                self.control_pipes[worker_index].close()
+                worker_process, control_pipe = self._start_worker(worker_index)
+                self.worker_processes[worker_index] = worker_process
+                self.control_pipes[worker_index] = control_pipe
+
+    def autoscale(self):
+        # The slots of a retiring worker can't be reused until it exits
+        if self.retiring_workers:
+            return
+
+        target = self.autoscaler.get_target(len(self.worker_processes))
+        while len(self.worker_processes) < target:
+            worker_process, control_pipe = self._start_worker(len(self.worker_processes))
+            self.worker_processes.append(worker_process)
+            self.control_pipes.append(control_pipe)
+        while len(self.worker_processes) > target:
+            self.retire_worker()
+
+    def retire_worker(self):
+        """
+        Remove the last worker, letting it finish the requests it has in
+        flight first.
+        """
+        worker_index = len(self.worker_processes) - 1
+        worker_process = self.worker_processes.pop()
+        control_pipe = self.control_pipes.pop()
+        logger.info("Retiring worker process %d (PID: %d)", worker_index, worker_process.pid)
+
+        try:
+            control_pipe.send(CONTROL_DRAIN)
+        except OSError:
+            pass # already exited
+        self.retiring_workers.append((worker_index, worker_process, control_pipe))
+
+    def remove_retired_workers(self):
+        for retiring_worker in list(self.retiring_workers):
+            worker_index, worker_process, control_pipe = retiring_worker
+            if not worker_process.is_alive():
+                logger.info("Worker process %d (PID: %d) retired", worker_index, worker_process.pid)
+                control_pipe.close()
+                self.scoreboard.clear(worker_index)
+                self.retiring_workers.remove(retiring_worker)
+
+    def _get_worker_options(self):
+        return {
+            'max_blocking_time': self.max_blocking_time,
+            'slow_request_threshold': self.slow_request_threshold,
+            'max_header_size': self.max_header_size,
+            'max_header_count': self.max_header_count,
+            'max_body_size': self.max_body_size,
+            'write_buffer_size': self.write_buffer_size,
+            'write_buffer_delay': self.write_buffer_delay,
+            'streaming_content_types': self.streaming_content_types,
+            'heartbeat_interval': self.heartbeat_interval,
+            'max_streams': self.max_streams,
+            'parser': self.parser,
+            'max_requests': self.max_requests,
+            'max_requests_jitter': self.max_requests_jitter,
+            'max_rss': self.max_rss,
+            'graceful_timeout': self.graceful_timeout,
+            'tcp_nodelay': self.tcp_nodelay,
+            'cache_size': self.cache_size,
+            'cache_vary_headers': self.cache_vary_headers,
+            'single_flight': self.single_flight,
+            'max_connections_per_client': self.max_connections_per_client,
+            'rate_limit': self.rate_limit,
+            'rate_limit_burst': self.rate_limit_burst,
+            'scoreboard': self.scoreboard,
+            'status_path': self.status_path,
+            'health_path': self.health_path,
+            'readiness_path': self.readiness_path,
+            'tracing': self.tracing,
+            'trace_exporter': self.trace_exporter,
+            'send_timeout': self.send_timeout,
+            'response_send_timeout': self.response_send_timeout,
+            'notsent_lowat': self.notsent_lowat,
+            'header_timeout': self.header_timeout,
+            'header_max_timeout': self.header_max_timeout,
+            'header_min_rate': self.header_min_rate,
+            'body_timeout': self.body_timeout,
+            'body_min_rate': self.body_min_rate,
+        }
 
     def stop(self):
         for index, worker_process in enumerate(self.worker_processes):
             logger.info("Terminating worker process %d (PID: %d)", index, worker_process.pid)
             worker_process.terminate()
+        for _, worker_process, control_pipe in self.retiring_workers:
+            worker_process.terminate()
+            control_pipe.close()
+        for control_pipe in self.control_pipes:
+            control_pipe.close()
         self.worker_processes = []
+        self.control_pipes = []
+        self.retiring_workers = []
+        self.autoscaler = None
         self.alive = False
-        self.sock.close()
+        for sock in self.socks:
+            sock.close()
+        for path in self.unix_socket_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
     def handle_signal(self, signo, _stack_frame):
         logger.debug("Received signal %d", signo)
         self.stop()
 
+    def handle_reload(self, signo, _stack_frame):
+        """
+        Replace every worker, letting each finish the requests it has
+        in flight first.
+        """
+        logger.info("Received signal %d, replacing workers", signo)
+        for control_pipe in self.control_pipes:
+            try:
+                control_pipe.send(CONTROL_DRAIN)
+            except OSError:
+                pass # worker already exited, it will be replaced anyway
+
+    def handle_status(self, signo, _stack_frame):
+        """
+        Log what every worker is doing.
+        """
+        if self.scoreboard is None:
+            logger.warning("Received signal %d, but the scoreboard is disabled", signo)
+            return
+
+        logger.info("Scoreboard:\n%s", self.scoreboard.render())
+
 def make_server(*args, **kwargs):
     return WSGIServer(*args, **kwargs)
@@ -0,0 +1,90 @@
+import logging
+
+import gevent
+import gevent.queue
+import gevent.socket
+
+logger = logging.getLogger(__name__)
+
+SSE_CONTENT_TYPE = 'text/event-stream'
+SSE_HEARTBEAT = b":\n\n"
+
+_END = object()
+
+class ClientDisconnected(Exception):
+    pass
+
+def watch_disconnect(conn, greenlet):
+    """
+    Kill ``greenlet`` with :class:`ClientDisconnected` once the client
+    closes ``conn``.
+    """
+    try:
+        gevent.socket.wait_read(conn.fileno())
+        if conn.recv(1, gevent.socket.MSG_PEEK):
+            # Client sent more data rather than disconnecting, there
+            # is nothing more to watch for without consuming it
+            return
+    except ValueError:
+        # recv flags are not supported on SSL sockets
+        return
+    except OSError:
+        pass
+
+    logger.info("Client disconnected during stream")
+    greenlet.kill(ClientDisconnected, block=False)
+
+def stream_response(response_iter, response_writer, conn=None, heartbeat_interval=None):
+    """
+    Write each item of ``response_iter`` as soon as it is produced.
+
+    The iterator is run in its own greenlet so that, while it is idle,
+    server-sent event streams can be kept alive by sending a comment
+    every ``heartbeat_interval`` seconds. If the client disconnects,
+    :class:`ClientDisconnected` is raised.
+    """
+    queue = gevent.queue.Queue(maxsize=1)
+
+    def produce():
+        try:
+            for data in response_iter:
+                queue.put(data)
+        except Exception as e:
+            queue.put(e)
+        else:
+            queue.put(_END)
+
+    producer = gevent.spawn(produce)
+    if conn is not None:
+        watcher = gevent.spawn(watch_disconnect, conn, gevent.getcurrent())
+    else:
+        watcher = None
+
+    if response_writer.content_type == SSE_CONTENT_TYPE:
+        timeout = heartbeat_interval
+    else:
+        # Heartbeats would corrupt any other kind of body
+        timeout = None
+
+    try:
+        while True:
+            try:
+                data = queue.get(timeout=timeout)
+            except gevent.queue.Empty:
+                logger.debug("Sending heartbeat")
+                response_writer.write(SSE_HEARTBEAT)
+                continue
+
+            if data is _END:
+                break
+            elif isinstance(data, Exception):
+                raise data
+            elif data:
+                response_writer.write(data)
+            else:
+                response_writer.flush()
+    finally:
+        if watcher is not None:
+            watcher.kill(block=False)
+        # Wait for the producer to exit so the iterator can be closed
+        producer.kill()
@@ -0,0 +1,107 @@
+import io
+import logging
+import time
+
+from gevent import socket
+
+logger = logging.getLogger(__name__)
+
+PHASE_HEADERS = 'headers'
+PHASE_BODY = 'body'
+
+class RequestTimeout(Exception):
+    """
+    Raised when a client sends a request too slowly.
+    """
+
+    def __init__(self, phase, received):
+        super().__init__("Timed out reading request %s" % phase)
+        self.phase = phase
+        # Number of bytes of the phase received before timing out
+        self.received = received
+
+class ConnectionEvicted(Exception):
+    """
+    Thrown into a connection's greenlet to close it and make room for
+    others.
+    """
+
+class ReadDeadline(object):
+    """
+    The time left to read one phase of a request (its headers or its
+    body).
+
+    The phase must be read within ``timeout`` seconds of its first read.
+    If ``min_rate`` is given, every ``min_rate`` bytes received extend
+    that by a second, up to ``max_timeout`` seconds in all. A client
+    trickling a byte at a time therefore runs out of time, while one
+    sending at a reasonable rate can take as long as it needs.
+    """
+
+    __slots__ = ('phase', 'timeout', 'max_timeout', 'min_rate', 'started', 'deadline', 'received')
+
+    def __init__(self, phase, timeout, max_timeout=None, min_rate=None):
+        self.phase = phase
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.min_rate = min_rate
+        self.started = None
+        self.deadline = None
+        self.received = 0
+
+    def remaining(self):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+            self.deadline = now + self.timeout
+        return self.deadline - now
+
+    def add_received(self, nbytes):
+        self.received += nbytes
+        if self.min_rate:
+            deadline = self.deadline + nbytes / self.min_rate
+            if self.max_timeout is not None:
+                deadline = min(deadline, self.started + self.max_timeout)
+            self.deadline = deadline
+
+class DeadlineReader(io.RawIOBase):
+    """
+    Raw reader for a connection that raises :class:`RequestTimeout` if
+    a read would go past the current :class:`ReadDeadline`.
+
+    The deadline is applied as the socket's timeout for each read, so
+    it costs no more than an ordinary blocking read.
+    """
+
+    def __init__(self, raw, conn):
+        self.raw = raw
+        self.conn = conn
+        self.deadline = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        deadline = self.deadline
+        if deadline is None:
+            return self.raw.readinto(buffer)
+
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            raise RequestTimeout(deadline.phase, deadline.received)
+
+        self.conn.settimeout(timeout)
+        try:
+            nbytes = self.raw.readinto(buffer)
+        except socket.timeout:
+            raise RequestTimeout(deadline.phase, deadline.received)
+        finally:
+            self.conn.settimeout(None)
+
+        if nbytes:
+            deadline.add_received(nbytes)
+        return nbytes
+
+    def close(self):
+        self.raw.close()
+        super().close()
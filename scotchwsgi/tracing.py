@@ -0,0 +1,323 @@
+import abc
+import json
+import logging
+import random
+import re
+import socket
+import time
+
+from scotchwsgi import const
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+INVALID_TRACE_ID = '0' * 32
+INVALID_SPAN_ID = '0' * 16
+
+# Flags of traces started here: sampled
+DEFAULT_TRACE_FLAGS = '01'
+
+# Datagrams are kept under the size that fits in one packet on most
+# networks, less IP and UDP headers
+MAX_DATAGRAM_SIZE = 1472
+
+def parse_traceparent(traceparent):
+    """
+    Return ``(trace_id, parent_id, flags)`` from a W3C ``traceparent``
+    header, or ``None`` if it is invalid.
+    """
+    match = TRACEPARENT.match(traceparent.strip())
+    if match is None:
+        return None
+
+    version, trace_id, parent_id, flags, extra = match.groups()
+    # Later versions may add fields, but version 00 has exactly four
+    if version == 'ff' or (version == '00' and extra):
+        return None
+    if trace_id == INVALID_TRACE_ID or parent_id == INVALID_SPAN_ID:
+        return None
+
+    return trace_id, parent_id, flags
+
+SPAN_FORMAT = '{"name":"%s","trace_id":"%s","span_id":"%s","parent_id":%s,"start":%r,"end":%r%s}\n'
+
+def encode_span(span):
+    """
+    Encode a span as a line of JSON. All but its attributes are known
+    to need no escaping, so only those go through the JSON encoder.
+    """
+    attributes = span.get('attributes')
+    return (SPAN_FORMAT % (
+        span['name'],
+        span['trace_id'],
+        span['span_id'],
+        '"%s"' % span['parent_id'] if span['parent_id'] is not None else 'null',
+        span['start'],
+        span['end'],
+        ',"attributes":' + json.dumps(attributes, separators=(',', ':')) if attributes else '',
+    )).encode(const.STR_ENCODING)
+
+def generate_id(bits):
+    """
+    Return a random ID of ``bits`` bits as lower case hex.
+    """
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+class RequestTrace(object):
+    """
+    The trace context of a request and the times of each step in
+    serving it.
+
+    The request's span continues the trace of the ``traceparent``
+    header the request was sent with, or starts a new one. It has a
+    child span for each step:
+
+    - ``accept``: from the connection being accepted until the first
+      request on it arrived
+    - ``headers``: reading the request line and headers
+    - ``body``: reading the body
+    - ``app``: calling the application, until it returned its iterable
+    - ``first_byte``: from calling the application until the response
+      headers were sent
+    - ``last_byte``: from then until the end of the response was sent
+
+    Only the times are recorded while the request is served, the spans
+    are made from them when exported.
+    """
+
+    __slots__ = (
+        'request_id',
+        'trace_id',
+        'span_id',
+        'parent_id',
+        'flags',
+        'tracestate',
+        'connected_at',
+        'started_at',
+        'headers_read_at',
+        'body_read_at',
+        'app_started_at',
+        'app_returned_at',
+        'first_byte_at',
+        'last_byte_at',
+    )
+
+    def __init__(self, started_at, connected_at=None):
+        self.request_id = None
+        self.trace_id = None
+        self.span_id = None
+        self.parent_id = None
+        self.flags = DEFAULT_TRACE_FLAGS
+        self.tracestate = None
+        self.connected_at = connected_at
+        self.started_at = started_at
+        self.headers_read_at = None
+        self.body_read_at = None
+        self.app_started_at = None
+        self.app_returned_at = None
+        self.first_byte_at = None
+        self.last_byte_at = None
+
+    def set_context(self, headers):
+        """
+        Continue the trace given by a request's headers, if any, and
+        give the request its IDs.
+        """
+        self.request_id = generate_id(128)
+        self.span_id = generate_id(64)
+
+        traceparent = headers.get('traceparent')
+        context = parse_traceparent(traceparent) if traceparent else None
+        if context is not None:
+            self.trace_id, self.parent_id, self.flags = context
+            self.tracestate = headers.get('tracestate')
+        else:
+            self.trace_id = generate_id(128)
+
+    @property
+    def sampled(self):
+        return bool(int(self.flags, 16) & 1)
+
+    @property
+    def traceparent(self):
+        """
+        The ``traceparent`` to send with requests made while serving
+        this one.
+        """
+        return '00-%s-%s-%s' % (self.trace_id, self.span_id, self.flags)
+
+    def get_environ(self):
+        return {
+            'scotchwsgi.request_id': self.request_id,
+            'scotchwsgi.trace_id': self.trace_id,
+            'scotchwsgi.span_id': self.span_id,
+            'scotchwsgi.traceparent': self.traceparent,
+            'scotchwsgi.tracestate': self.tracestate,
+        }
+
+    def get_spans(self, attributes=None):
+        """
+        Return the request's span and its children, as dicts.
+        """
+        started_at = self.connected_at if self.connected_at is not None else self.started_at
+        finished_at = self.last_byte_at if self.last_byte_at is not None else time.time()
+
+        request_attributes = {'request_id': self.request_id}
+        if attributes:
+            request_attributes.update(attributes)
+        spans = [self._make_span('request', self.span_id, self.parent_id, started_at, finished_at,
+                                 request_attributes)]
+
+        for name, start, end in (
+            ('accept', self.connected_at, self.started_at),
+            ('headers', self.started_at, self.headers_read_at),
+            ('body', self.headers_read_at, self.body_read_at),
+            ('app', self.app_started_at, self.app_returned_at),
+            ('first_byte', self.app_started_at, self.first_byte_at),
+            ('last_byte', self.first_byte_at, self.last_byte_at),
+        ):
+            if start is not None and end is not None:
+                spans.append(self._make_span(name, generate_id(64), self.span_id, start, end))
+
+        return spans
+
+    def _make_span(self, name, span_id, parent_id, start, end, attributes=None):
+        span = {
+            'name': name,
+            'trace_id': self.trace_id,
+            'span_id': span_id,
+            'parent_id': parent_id,
+            'start': start,
+            'end': end,
+        }
+        if attributes:
+            span['attributes'] = attributes
+        return span
+
+class SpanExporter(abc.ABC):
+    """
+    Collects the traces of requests and sends their spans in batches,
+    once ``batch_size`` traces have been collected or when
+    :meth:`flush` is called (every ``flush_interval`` seconds by the
+    worker).
+
+    Spans are only made and encoded (as one JSON object per line) when
+    a batch is sent, so collecting a trace costs no more than a list
+    append. Subclasses implement :meth:`send`.
+    """
+
+    def __init__(self, batch_size=const.TRACE_BATCH_SIZE, flush_interval=const.TRACE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.exported = 0
+
+    def export(self, trace, attributes=None):
+        self.batch.append((trace, attributes))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        batch = self.batch
+        self.batch = []
+        lines = [
+            encode_span(span)
+            for trace, attributes in batch
+            for span in trace.get_spans(attributes)
+        ]
+
+        try:
+            self.send(lines)
+        except OSError as e:
+            logger.warning("Failed to export %d spans: %s", len(lines), e)
+        else:
+            self.exported += len(lines)
+
+    @abc.abstractmethod
+    def send(self, lines):
+        """
+        Send ``lines``, the encoded spans of a batch. An ``OSError``
+        drops the batch.
+        """
+
+    def close(self):
+        self.flush()
+
+class FileExporter(SpanExporter):
+    """
+    Appends spans to a local file. Each batch is written at once, so
+    workers can share the file.
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.file = None
+
+    def send(self, lines):
+        if self.file is None:
+            self.file = open(self.path, 'ab', buffering=0)
+        self.file.write(b"".join(lines))
+
+    def close(self):
+        super().close()
+        if self.file is not None:
+            self.file.close()
+
+class UdpExporter(SpanExporter):
+    """
+    Sends spans to a collector over UDP, as many lines to a datagram as
+    fit. Spans are dropped rather than slowing down requests if the
+    collector can't keep up.
+    """
+
+    def __init__(self, host, port, **kwargs):
+        super().__init__(**kwargs)
+        self.address = (host, port)
+        self.sock = None
+
+    def send(self, lines):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+
+        datagram = []
+        size = 0
+        for line in lines:
+            if datagram and size + len(line) > MAX_DATAGRAM_SIZE:
+                self._send_datagram(b"".join(datagram))
+                datagram = []
+                size = 0
+            datagram.append(line)
+            size += len(line)
+        if datagram:
+            self._send_datagram(b"".join(datagram))
+
+    def _send_datagram(self, datagram):
+        try:
+            self.sock.sendto(datagram, self.address)
+        except BlockingIOError:
+            logger.debug("Dropped %d bytes of spans", len(datagram))
+
+    def close(self):
+        super().close()
+        if self.sock is not None:
+            self.sock.close()
+
+def get_span_exporter(spec):
+    """
+    Return an exporter for ``file:PATH`` or ``udp:HOST:PORT``.
+    """
+    kind, sep, target = spec.partition(':')
+    if sep and target:
+        if kind == 'file':
+            return FileExporter(target)
+        elif kind == 'udp':
+            host, sep, port = target.rpartition(':')
+            if sep and port.isdigit():
+                return UdpExporter(host, int(port))
+
+    raise ValueError("Unknown span exporter: %s" % spec)
@@ -0,0 +1,90 @@
+import logging
+import time
+from collections import defaultdict
+
+import gevent
+import gevent.events
+
+logger = logging.getLogger(__name__)
+slow_request_logger = logging.getLogger('scotchwsgi.slow')
+
+class EventLoopWatchdog(object):
+    """
+    Reports greenlets that block the event loop for longer than
+    ``max_blocking_time`` seconds, along with the request they were
+    serving.
+
+    Detection is done by gevent's monitoring thread, which runs
+    outside of the event loop and so keeps running while it is
+    blocked.
+    """
+
+    def __init__(self, max_blocking_time, active_requests):
+        self.max_blocking_time = max_blocking_time
+        self.active_requests = active_requests
+
+    def start(self):
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.max_blocking_time
+        gevent.events.subscribers.append(self.handle_event)
+        gevent.get_hub().start_periodic_monitoring_thread()
+
+    def handle_event(self, event):
+        if not isinstance(event, gevent.events.EventLoopBlocked):
+            return
+
+        # The report ends with a dump of every thread and greenlet,
+        # only the stack of the blocking greenlet is of interest here
+        stack = []
+        for line in event.info:
+            if line.startswith('Info:'):
+                break
+            stack.append(line)
+
+        logger.warning(
+            "Event loop blocked for more than %.3fs (request: %s)\n%s",
+            event.blocking_time,
+            self.active_requests.get(event.greenlet, '-'),
+            '\n'.join(stack),
+        )
+
+class RequestTimer(object):
+    """
+    Accumulates the time spent in each phase of a request.
+    ``on_phase``, if given, is called with each new phase.
+    """
+
+    __slots__ = ('start', 'last', 'current', 'durations', 'on_phase')
+
+    def __init__(self, phase, on_phase=None):
+        self.start = self.last = time.monotonic()
+        self.current = phase
+        self.durations = defaultdict(float)
+        self.on_phase = on_phase
+
+    def phase(self, phase):
+        now = time.monotonic()
+        self.durations[self.current] += now - self.last
+        self.current = phase
+        self.last = now
+        if self.on_phase is not None:
+            self.on_phase(phase)
+
+    def stop(self):
+        self.phase(None)
+        return self.last - self.start
+
+def log_slow_request(request_line, timer, threshold):
+    total = timer.stop()
+    if total < threshold:
+        return
+
+    slow_request_logger.warning(
+        "Slow request %s (%.3fs): %s",
+        request_line,
+        total,
+        ' '.join(
+            '%s=%.3fs' % (phase, duration)
+            for phase, duration in timer.durations.items()
+        ),
+    )
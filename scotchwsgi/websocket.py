@@ -0,0 +1,257 @@
+import base64
+import binascii
+import hashlib
+import logging
+import struct
+
+import gevent
+
+from scotchwsgi import const
+from scotchwsgi.response import SendTimeout
+from scotchwsgi.timeouts import RequestTimeout
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_VERSION = '13'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_MESSAGE_TOO_BIG = 1009
+
+class WebSocketError(Exception):
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+def is_websocket_request(request):
+    if request.method != 'GET' or request.http_version != 'HTTP/1.1':
+        return False
+
+    connection_tokens = [
+        token.strip().lower()
+        for token in request.headers.get('connection', '').split(',')
+    ]
+
+    return (
+        request.headers.get('upgrade', '').lower() == 'websocket' and
+        'upgrade' in connection_tokens
+    )
+
+def accept_websocket(request, writer):
+    """
+    Complete the RFC 6455 opening handshake for ``request``.
+    """
+    if request.headers.get('sec-websocket-version') != WEBSOCKET_VERSION:
+        raise ValueError(
+            "Unsupported websocket version: %s" % request.headers.get('sec-websocket-version')
+        )
+
+    key = request.headers.get('sec-websocket-key', '').strip()
+    try:
+        if len(base64.b64decode(key, validate=True)) != 16:
+            raise ValueError("Invalid websocket key: %s" % key)
+    except binascii.Error:
+        raise ValueError("Invalid websocket key: %s" % key)
+
+    accept = base64.b64encode(
+        hashlib.sha1(key.encode(const.STR_ENCODING) + WEBSOCKET_GUID).digest()
+    )
+
+    writer.write(
+        b"HTTP/1.1 101 Switching Protocols\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: " + accept + b"\r\n"
+        b"\r\n"
+    )
+    writer.flush()
+
+def mask(data, key):
+    """
+    XOR ``data`` with the 4 byte masking ``key`` (masking and
+    unmasking are the same operation).
+
+    The whole payload is XORed as a single integer, which is much
+    faster than working byte by byte in Python.
+    """
+    length = len(data)
+    if not length:
+        return data
+
+    repeated_key = (key * (length // 4 + 1))[:length]
+    return (
+        int.from_bytes(data, 'little') ^ int.from_bytes(repeated_key, 'little')
+    ).to_bytes(length, 'little')
+
+def encode_frame(opcode, payload, fin=True):
+    first_byte = (0x80 if fin else 0) | opcode
+    length = len(payload)
+
+    if length < 126:
+        header = struct.pack('!BB', first_byte, length)
+    elif length < (1 << 16):
+        header = struct.pack('!BBH', first_byte, 126, length)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, length)
+
+    return header + payload
+
+class WebSocket(object):
+    """
+    Server side of a websocket connection, made available to
+    applications as ``environ['wsgi.websocket']``.
+
+    Sending a frame raises :class:`SendTimeout` if the client doesn't
+    read it within ``send_timeout`` seconds, after which the connection
+    is treated as closed.
+    """
+
+    def __init__(self, reader, writer, max_message_size=None, send_timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.max_message_size = max_message_size
+        self.closed = False
+        self.send_timer = gevent.Timeout(send_timeout, SendTimeout) if send_timeout is not None else None
+
+    def _read_exactly(self, size):
+        data = self.reader.read(size)
+        if len(data) != size:
+            raise EOFError("Connection closed while reading frame")
+        return data
+
+    def _read_frame(self):
+        first_byte, second_byte = self._read_exactly(2)
+
+        fin = bool(first_byte & 0x80)
+        opcode = first_byte & 0x0F
+        if first_byte & 0x70:
+            raise WebSocketError("Reserved bits set without an extension")
+
+        if not second_byte & 0x80:
+            raise WebSocketError("Received unmasked frame from client")
+
+        length = second_byte & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', self._read_exactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self._read_exactly(8))
+
+        if opcode >= OPCODE_CLOSE and (length > 125 or not fin):
+            raise WebSocketError("Invalid control frame")
+
+        if self.max_message_size is not None and length > self.max_message_size:
+            raise WebSocketError("Frame too large", CLOSE_MESSAGE_TOO_BIG)
+
+        masking_key = self._read_exactly(4)
+        payload = mask(self._read_exactly(length), masking_key)
+
+        return fin, opcode, payload
+
+    def receive(self):
+        """
+        Return the next text (``str``) or binary (``bytes``) message,
+        or ``None`` once the connection is closed.
+        """
+        message_opcode = None
+        fragments = []
+        message_size = 0
+
+        while not self.closed:
+            try:
+                fin, opcode, payload = self._read_frame()
+            except WebSocketError as e:
+                logger.info("Websocket error: %s", e)
+                self.close(e.code)
+                return None
+            except (EOFError, OSError, RequestTimeout):
+                self.closed = True
+                return None
+
+            if opcode == OPCODE_PING:
+                self._send_frame(OPCODE_PONG, payload)
+                continue
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                if len(payload) >= 2:
+                    code, = struct.unpack('!H', payload[:2])
+                else:
+                    code = CLOSE_NORMAL
+                self.close(code)
+                return None
+
+            if opcode == OPCODE_CONTINUATION:
+                if message_opcode is None:
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+            elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if message_opcode is not None:
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+                message_opcode = opcode
+            else:
+                self.close(CLOSE_PROTOCOL_ERROR)
+                return None
+
+            fragments.append(payload)
+            message_size += len(payload)
+            if self.max_message_size is not None and message_size > self.max_message_size:
+                self.close(CLOSE_MESSAGE_TOO_BIG)
+                return None
+
+            if fin:
+                message = b"".join(fragments)
+                if message_opcode == OPCODE_TEXT:
+                    try:
+                        return message.decode('utf-8')
+                    except UnicodeDecodeError:
+                        self.close(CLOSE_INVALID_DATA)
+                        return None
+                return message
+
+        return None
+
+    def _send_frame(self, opcode, payload):
+        if self.send_timer is None:
+            self.writer.write(encode_frame(opcode, payload))
+            self.writer.flush()
+            return
+
+        self.send_timer.start()
+        try:
+            self.writer.write(encode_frame(opcode, payload))
+            self.writer.flush()
+        except SendTimeout:
+            # Whatever was partly sent can't be followed by another frame
+            self.closed = True
+            raise
+        finally:
+            self.send_timer.cancel()
+
+    def send(self, message):
+        if self.closed:
+            raise WebSocketError("Websocket is closed")
+
+        if isinstance(message, str):
+            self._send_frame(OPCODE_TEXT, message.encode('utf-8'))
+        else:
+            self._send_frame(OPCODE_BINARY, bytes(message))
+
+    def close(self, code=CLOSE_NORMAL, reason=''):
+        if self.closed:
+            return
+
+        self.closed = True
+        try:
+            self._send_frame(OPCODE_CLOSE, struct.pack('!H', code) + reason.encode('utf-8'))
+        except OSError:
+            pass
@@ -1,37 +1,204 @@
 import importlib
+import io
+import ipaddress
 import logging
 import os
+import random
+import resource
 import signal
+import ssl
 import sys
 import time
+from collections import OrderedDict
+from functools import partial
 from io import BytesIO
 
 import gevent
 import gevent.monkey
 import gevent.pool
+import gevent.event
 import gevent.server
+import gevent.socket
+import gevent.ssl
 
 from scotchwsgi import const
-from scotchwsgi.response import WSGIResponseWriter
-from scotchwsgi.request import WSGIRequest
+from scotchwsgi.affinity import set_cpu_affinity
+from scotchwsgi.cache import ResponseCache, ResponseRecorder, SingleFlight
+from scotchwsgi.listeners import get_server_address
+from scotchwsgi.parser import get_parser
+from scotchwsgi.ratelimit import RateLimiter, TooManyRequests
+from scotchwsgi.ranges import RangeRequest
+from scotchwsgi.response import CachedHeaders, FileWrapper, SendTimeout, WSGIResponseWriter
+from scotchwsgi.scoreboard import STATE_IDLE, STATE_READ
+from scotchwsgi.request import (
+    ContinueReader,
+    ExpectationFailed,
+    RequestEntityTooLarge,
+    RequestHeaderFieldsTooLarge,
+    WSGIRequest,
+)
+from scotchwsgi.timeouts import (
+    PHASE_BODY,
+    PHASE_HEADERS,
+    ConnectionEvicted,
+    DeadlineReader,
+    ReadDeadline,
+    RequestTimeout,
+)
+from scotchwsgi.tracing import RequestTrace, get_span_exporter
+from scotchwsgi.streaming import ClientDisconnected, stream_response, watch_disconnect
+from scotchwsgi.watchdog import EventLoopWatchdog, RequestTimer, log_slow_request
+from scotchwsgi.websocket import WEBSOCKET_VERSION, WebSocket, accept_websocket, is_websocket_request
 
 logger = logging.getLogger(__name__)
 
+# Environ keys of request header names. Requests mostly have the same
+# few headers, so each key is only worked out once.
+ENVIRON_KEYS = {
+    'content-type': 'CONTENT_TYPE',
+    'content-length': 'CONTENT_LENGTH',
+}
+MAX_ENVIRON_KEYS = 1000
+
+# Pre-built responses to health and readiness probes, as the status
+# line, the headers (other than Date and Server) and the body
+READY_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n",
+    b"Content-Type: text/plain\r\nContent-Length: 3\r\nCache-Control: no-store\r\n\r\n",
+    b"OK\n",
+)
+NOT_READY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n",
+    b"Connection: close\r\nContent-Type: text/plain\r\nContent-Length: 10\r\nCache-Control: no-store\r\n\r\n",
+    b"Not ready\n",
+)
+
+CONTROL_DRAIN = 'drain'
+
+# Connections that can't be sent files with sendfile, which would
+# bypass the encryption
+SSL_SOCKET_TYPES = (ssl.SSLSocket, gevent.ssl.SSLSocket)
+
 class WSGIWorker(object):
-    def __init__(self, app_location, sock, hostname, parent_pid, request_timeout):
+    def __init__(self, app_location, sock, hostname, parent_pid, request_timeout,
+                 max_blocking_time=None, slow_request_threshold=None,
+                 max_header_size=const.MAX_HEADER_SIZE, max_header_count=const.MAX_HEADER_COUNT,
+                 max_body_size=None, write_buffer_size=0, write_buffer_delay=None,
+                 streaming_content_types=const.STREAMING_CONTENT_TYPES,
+                 heartbeat_interval=const.HEARTBEAT_INTERVAL, max_streams=const.MAX_STREAMS,
+                 parser='auto', max_requests=None, max_requests_jitter=0, max_rss=None,
+                 graceful_timeout=const.GRACEFUL_TIMEOUT, control_pipe=None, inherited_fds=(),
+                 extra_socks=(), tcp_nodelay=True, cache_size=0, cache_vary_headers=(),
+                 single_flight=False, max_connections_per_client=None, rate_limit=None,
+                 rate_limit_burst=None, scoreboard=None, worker_index=0, status_path=None,
+                 cpu_affinity=None, send_timeout=const.SEND_TIMEOUT, response_send_timeout=None,
+                 notsent_lowat=None, header_timeout=const.HEADER_TIMEOUT,
+                 header_max_timeout=const.HEADER_MAX_TIMEOUT, header_min_rate=const.HEADER_MIN_RATE,
+                 body_timeout=const.BODY_TIMEOUT, body_min_rate=const.BODY_MIN_RATE, health_path=None,
+                 readiness_path=None, tracing=False, trace_exporter=None, server_names=()):
         gevent.monkey.patch_all()
 
         # Ignore interrupts to disable KeyboardInterrupt being logged
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Replacement workers are forked after the master has installed
+        # its own handlers, which must not run in the worker
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.set_wakeup_fd(-1)
+
+        # The master's ends of other workers' control pipes, which
+        # would stop this worker's pipe from closing when the master exits
+        for fd in inherited_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+        if cpu_affinity:
+            logger.info("Pinning worker %d to CPUs %s", worker_index, sorted(cpu_affinity))
+            set_cpu_affinity(cpu_affinity)
 
         # Allow app location to refer to files in cwd
         sys.path.append(os.getcwd())
 
-        self.sock = sock
+        self.socks = [sock] + list(extra_socks)
         self.hostname = hostname
-        _, self.port = sock.getsockname()
+        # The SERVER_NAME of each listener, the host it was bound to
+        self.server_names = list(server_names) or [hostname] * len(self.socks)
+        self.server_address = get_server_address(sock, self.server_names[0])
         self.parent_pid = parent_pid
         self.request_timeout = request_timeout
+        self.max_blocking_time = max_blocking_time
+        self.slow_request_threshold = slow_request_threshold
+        self.max_header_size = max_header_size
+        self.max_header_count = max_header_count
+        self.max_body_size = max_body_size
+        self.write_buffer_size = write_buffer_size
+        self.write_buffer_delay = write_buffer_delay
+        self.streaming_content_types = streaming_content_types
+        self.heartbeat_interval = heartbeat_interval
+        self.max_streams = max_streams
+        self.parser = get_parser(parser)
+        if max_requests:
+            # Jitter keeps workers started together from all restarting together
+            max_requests += random.randint(0, max_requests_jitter)
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.graceful_timeout = graceful_timeout
+        self.tcp_nodelay = tcp_nodelay
+        self.send_timeout = send_timeout
+        self.response_send_timeout = response_send_timeout
+        if notsent_lowat and not hasattr(gevent.socket, 'TCP_NOTSENT_LOWAT'):
+            logger.warning("TCP_NOTSENT_LOWAT is not supported on this platform")
+            notsent_lowat = None
+        self.notsent_lowat = notsent_lowat
+        self.slow_clients = 0
+        self.header_timeout = header_timeout
+        self.header_max_timeout = header_max_timeout
+        self.header_min_rate = header_min_rate
+        self.body_timeout = body_timeout
+        self.body_min_rate = body_min_rate
+        # Connections still reading request headers, oldest first
+        self.reading_headers = OrderedDict()
+        self.evicted_connections = 0
+        if cache_size:
+            self.response_cache = ResponseCache(cache_size, cache_vary_headers)
+        else:
+            self.response_cache = None
+        if single_flight:
+            self.single_flight = SingleFlight(cache_vary_headers)
+        else:
+            self.single_flight = None
+        if max_connections_per_client or rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, rate_limit_burst, max_connections_per_client)
+        else:
+            self.rate_limiter = None
+        self.scoreboard = scoreboard
+        if scoreboard is not None:
+            self.worker_scoreboard = scoreboard.worker(worker_index)
+        else:
+            self.worker_scoreboard = None
+        self.status_path = status_path
+        self.health_path = health_path
+        self.readiness_path = readiness_path
+        # Paths of probes answered by the worker rather than the application
+        self.probe_paths = frozenset(path for path in (health_path, readiness_path) if path is not None)
+        self.span_exporter = get_span_exporter(trace_exporter) if trace_exporter else None
+        self.tracing = tracing or self.span_exporter is not None
+        # Responses larger than this are neither cached nor shared
+        self.max_recorded_size = cache_size or const.MAX_SHARED_RESPONSE_SIZE
+        self.requests_handled = 0
+        self.draining = False
+        self.idle_connections = set()
+        self.active_requests = {}
+        self.streams = set()
+        self.pool = None
+        self.servers = []
+        self.control_pipe = control_pipe
+        self.stop_event = None
+        self.parent_exited = False
+        self.cached_headers = CachedHeaders()
 
         app_module = importlib.import_module(app_location)
         if not hasattr(app_module, 'app'):
@@ -43,32 +210,313 @@ class WSGIWorker(object):
     def start(self):
         logger.info("Worker starting (PID: %d)", os.getpid())
 
-        pool = gevent.pool.Pool(size=const.MAX_CONNECTIONS)
+        if self.worker_scoreboard is not None:
+            self.worker_scoreboard.start(os.getpid())
 
-        server = gevent.server.StreamServer(
-            self.sock,
-            self._handle_connection,
-            spawn=pool,
-        )
-        server.start()
+        if self.max_blocking_time:
+            watchdog = EventLoopWatchdog(self.max_blocking_time, self.active_requests)
+            watchdog.start()
+
+        gevent.spawn(self._refresh_cached_headers)
+        if self.max_rss:
+            gevent.spawn(self._check_memory)
+        if self.rate_limiter is not None and self.rate_limiter.rate:
+            gevent.spawn(self._sweep_rate_limits)
+        if self.span_exporter is not None:
+            gevent.spawn(self._flush_spans)
+
+        self.pool = gevent.pool.Pool(size=const.MAX_CONNECTIONS)
 
+        # Connections from every listener share the one pool
+        for sock, server_name in zip(self.socks, self.server_names):
+            server = gevent.server.StreamServer(
+                sock,
+                partial(self._handle_connection, server_address=get_server_address(sock, server_name)),
+                spawn=self.pool,
+            )
+            server.start()
+            self.servers.append(server)
+
+        if self.control_pipe is not None:
+            self.stop_event = gevent.event.Event()
+            gevent.spawn(self._watch_control_pipe)
+            self.stop_event.wait()
+        else:
+            while not self.draining:
+                if os.getppid() != self.parent_pid:
+                    self.parent_exited = True
+                    break
+                time.sleep(1)
+
+        if self.parent_exited:
+            logger.info("Worker parent exited, exiting")
+        else:
+            self._drain()
+
+        if self.span_exporter is not None:
+            self.span_exporter.close()
+
+    def _watch_control_pipe(self):
+        """
+        Wait for messages from the master. The pipe is closed when the
+        master exits, so this also detects the master's death at once.
+        """
         while True:
-            if os.getppid() != self.parent_pid:
-                logger.info("Worker parent changed, exiting")
-                break
-            time.sleep(1)
+            try:
+                gevent.socket.wait_read(self.control_pipe.fileno())
+                message = self.control_pipe.recv()
+            except (EOFError, OSError):
+                self.parent_exited = True
+                self.stop_event.set()
+                return
+
+            if message == CONTROL_DRAIN:
+                self.start_draining("requested by master")
+            else:
+                logger.warning("Unknown control message: %r", message)
+
+    def start_draining(self, reason):
+        """
+        Stop the worker once the requests in flight have completed, so
+        that the master can start a replacement.
+        """
+        if not self.draining:
+            logger.info("Worker draining (PID: %d): %s", os.getpid(), reason)
+            self.draining = True
+            for server in self.servers:
+                server.stop_accepting()
+            if self.stop_event is not None:
+                self.stop_event.set()
+
+    def _drain(self):
+        # Keep-alive connections waiting for another request would
+        # otherwise hold the worker open until they time out
+        for greenlet in list(self.idle_connections):
+            greenlet.kill(block=False)
 
-    def _handle_connection(self, conn, addr):
+        if not self.pool.join(timeout=self.graceful_timeout):
+            logger.warning(
+                "%d connections still open after %ss, exiting anyway",
+                len(self.pool),
+                self.graceful_timeout,
+            )
+
+        logger.info("Worker exiting (PID: %d)", os.getpid())
+
+    def _check_memory(self):
+        while not self.draining:
+            gevent.sleep(const.MEMORY_CHECK_INTERVAL)
+            rss = get_rss()
+            if rss > self.max_rss:
+                self.start_draining("RSS of %d bytes exceeds %d" % (rss, self.max_rss))
+
+    def _sweep_rate_limits(self):
+        while True:
+            gevent.sleep(const.RATE_LIMIT_SWEEP_INTERVAL)
+            self.rate_limiter.sweep()
+
+    def _flush_spans(self):
+        while True:
+            gevent.sleep(self.span_exporter.flush_interval)
+            self.span_exporter.flush()
+
+    def _refresh_cached_headers(self):
+        while True:
+            # Wake up just after the second changes, so the date is never stale
+            gevent.sleep(1 - time.time() % 1)
+            self.cached_headers.refresh()
+
+    def _handle_connection(self, conn, addr, server_address=None):
         logger.info("New connection: %s", addr)
+        connected_at = time.time() if self.tracing else None
+
+        if self.pool is not None and self.pool.free_count() < const.EVICTION_FREE_SLOTS:
+            self._evict_connection()
 
-        reader = conn.makefile('rb')
+        if self.tcp_nodelay:
+            # Otherwise the body can be held back until the headers,
+            # written separately, are acknowledged
+            try:
+                conn.setsockopt(gevent.socket.IPPROTO_TCP, gevent.socket.TCP_NODELAY, 1)
+            except OSError:
+                pass # not a TCP connection
+
+        if self.notsent_lowat:
+            # Keep little more than what is in flight in the kernel, so
+            # that a slow reader holds the application back rather than
+            # filling a send buffer that can grow to megabytes
+            try:
+                conn.setsockopt(gevent.socket.IPPROTO_TCP, gevent.socket.TCP_NOTSENT_LOWAT, self.notsent_lowat)
+            except OSError:
+                pass # not a TCP connection
+
+        reader = io.BufferedReader(DeadlineReader(conn.makefile('rb', buffering=0), conn))
         writer = conn.makefile('wb')
+        response_writer = self._make_response_writer(writer)
+
+        # Limits are per IP address, connections from a Unix domain
+        # socket (i.e. a local proxy) are not limited
+        client = addr[0] if self.rate_limiter is not None and isinstance(addr, tuple) else None
+        if client is not None and not self.rate_limiter.acquire_connection(client):
+            logger.warning("Too many connections from: %s", client)
+            client = None
+            handle_requests = False
+        else:
+            handle_requests = True
+
+        if self.worker_scoreboard is not None:
+            slot = self.worker_scoreboard.acquire(addr[0] if isinstance(addr, tuple) else 'unix')
+        else:
+            slot = None
+
+        # Set when the client stopped reading, so that what is left in
+        # the writer's buffer isn't sent
+        abort = False
+        try:
+            if handle_requests:
+                self._handle_requests(conn, addr, reader, writer, response_writer, server_address,
+                                      client, slot, connected_at)
+            else:
+                self._send_error("429 Too Many Requests", writer)
+        except gevent.GreenletExit:
+            logger.debug("Idle connection closed for drain: %s", addr)
+        except ConnectionEvicted:
+            logger.info("Connection evicted to make room for others: %s", addr)
+        except ClientDisconnected:
+            # Only raised here while the application waits to start a stream
+            logger.info("Client disconnected before stream started: %s", addr)
+        except RequestTimeout as e:
+            # Only raised here while the application reads a deferred body
+            logger.info("Timed out reading request %s from: %s", e.phase, addr)
+        except SendTimeout:
+            logger.warning("Client too slow reading the response, closing connection: %s", addr)
+            abort = True
+            self.slow_clients += 1
+            if self.worker_scoreboard is not None:
+                self.worker_scoreboard.count_slow_client()
+        finally:
+            if client is not None:
+                self.rate_limiter.release_connection(client)
+            if slot is not None:
+                slot.release()
+            self.reading_headers.pop(gevent.getcurrent(), None)
+
+            logger.debug("Closing connection")
+
+            try:
+                reader.close()
+            except IOError:
+                pass
+
+            self._close_writer(conn, writer, abort)
+            conn.close()
+
+    def _close_writer(self, conn, writer, abort=False):
+        """
+        Close ``writer``, sending what is left in its buffer unless
+        ``abort`` is set. That is sent within the send timeout, after
+        which the connection is shut down, since a client that stopped
+        reading would otherwise hold the greenlet forever.
+        """
+        if not abort:
+            try:
+                with gevent.Timeout(self.send_timeout, SendTimeout):
+                    writer.close()
+                return
+            except SendTimeout:
+                logger.warning("Client too slow reading the end of the response, closing connection")
+            except IOError:
+                return
+
+        # Sends fail at once on a shut down socket, so closing the
+        # writer only releases it
+        try:
+            conn.shutdown(gevent.socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            writer.close()
+        except IOError:
+            pass
+
+    def _handle_requests(self, conn, addr, reader, writer, response_writer, server_address=None,
+                         client=None, slot=None, connected_at=None):
         close_connection = False
+        keep_alive = False
+        greenlet = gevent.getcurrent()
+        deadline_reader = reader.raw
 
         while not close_connection:
+            if keep_alive and self.draining:
+                # The worker started draining while the last response was sent
+                break
+
+            if keep_alive:
+                # Only the request timeout applies to waiting for the next request
+                deadline_reader.deadline = None
+            else:
+                # A new connection is expected to send its request at once
+                self._start_reading_headers(greenlet, deadline_reader)
+            keep_alive = True
+            received_request = False
+
+            if slot is not None:
+                slot.start(STATE_IDLE)
+
             try:
                 with gevent.Timeout(self.request_timeout):
-                    request = WSGIRequest.from_reader(reader)
+                    self.idle_connections.add(greenlet)
+                    try:
+                        if not reader.peek(1):
+                            logger.debug("Connection closed by client: %s", addr)
+                            break
+                    finally:
+                        self.idle_connections.discard(greenlet)
+                    received_request = True
+
+                    if self.tracing:
+                        # Only the first request on a connection waited for it to be accepted
+                        trace = RequestTrace(time.time(), connected_at)
+                        connected_at = None
+                    else:
+                        trace = None
+
+                    if deadline_reader.deadline is None:
+                        self._start_reading_headers(greenlet, deadline_reader)
+                    if slot is not None:
+                        slot.start(STATE_READ)
+
+                    if client is not None:
+                        retry_after = self.rate_limiter.allow_request(client)
+                        if retry_after:
+                            raise TooManyRequests(retry_after)
+
+                    timer = RequestTimer('read', slot.set_phase if slot is not None else None)
+                    request = WSGIRequest.from_reader(
+                        reader,
+                        writer,
+                        max_header_size=self.max_header_size,
+                        max_header_count=self.max_header_count,
+                        max_body_size=self.max_body_size,
+                        parser=self.parser,
+                        on_headers=partial(self._start_reading_body, greenlet, deadline_reader, trace),
+                    )
+            except TooManyRequests as e:
+                logger.warning("Too many requests from: %s", addr)
+                self._send_error("429 Too Many Requests", writer, [('Retry-After', str(e.retry_after))])
+                close_connection = True
+            except RequestHeaderFieldsTooLarge:
+                logger.error("Request headers too large from: %s", addr)
+                self._send_error("431 Request Header Fields Too Large", writer)
+                close_connection = True
+            except RequestEntityTooLarge:
+                logger.error("Request body too large from: %s", addr)
+                self._send_error("413 Request Entity Too Large", writer)
+                close_connection = True
+            except ExpectationFailed:
+                logger.error("Unsupported expectation received from: %s", addr)
+                self._send_error("417 Expectation Failed", writer)
+                close_connection = True
             except ValueError:
                 logger.error("Invalid request received from: %s", addr)
                 self._send_error("400 Bad Request", writer)
@@ -77,103 +525,619 @@ class WSGIWorker(object):
                 logger.error("Unsupported request received from: %s", addr)
                 self._send_error("501 Not Implemented", writer)
                 close_connection = True
+            except RequestTimeout as e:
+                logger.info("Timed out reading request %s from: %s", e.phase, addr)
+                if received_request:
+                    # Clients that never sent anything are dropped silently
+                    self._send_error("408 Request Timeout", writer)
+                close_connection = True
             except gevent.Timeout:
                 logger.info("Connection timed out: %s", addr)
                 close_connection = True
             else:
-                response_writer = self._send_response(request, writer)
-                if not response_writer or response_writer.wrote_connection_close:
+                if request.path in self.probe_paths:
+                    # Probes don't count as requests, nor reach the application
+                    timer.phase('write')
+                    if not self._send_probe_response(request, writer):
+                        close_connection = True
+                    continue
+
+                if trace is not None:
+                    trace.body_read_at = time.time()
+                    trace.set_context(request.headers)
+
+                self.requests_handled += 1
+                if self.max_requests and self.requests_handled >= self.max_requests:
+                    self.start_draining("handled %d requests" % self.requests_handled)
+
+                request_line = request.request_line
+                if slot is not None:
+                    slot.start_request(request_line)
+
+                self.active_requests[gevent.getcurrent()] = request_line
+                try:
+                    if self.status_path is not None and request.path == self.status_path:
+                        sent_response_writer = self._send_status(addr, writer, timer)
+                    elif is_websocket_request(request):
+                        if slot is not None:
+                            # An open websocket doesn't keep the worker busy
+                            slot.finish_request()
+                        # The body deadline is for HTTP requests, frames may
+                        # be any time apart
+                        deadline_reader.deadline = None
+                        self._handle_websocket(request, reader, writer, server_address)
+                        break
+                    else:
+                        sent_response_writer = self._send_response(
+                            request,
+                            writer,
+                            timer,
+                            conn,
+                            response_writer,
+                            server_address,
+                            trace,
+                        )
+                finally:
+                    del self.active_requests[gevent.getcurrent()]
+                    if slot is not None:
+                        slot.finish_request()
+
+                if trace is not None:
+                    trace.last_byte_at = time.time()
+                    if self.span_exporter is not None and trace.sampled:
+                        self._export_trace(trace, request, addr, sent_response_writer)
+
+                is_streaming = sent_response_writer and sent_response_writer.is_streaming
+                if self.slow_request_threshold is not None and not is_streaming:
+                    log_slow_request(request_line, timer, self.slow_request_threshold)
+
+                if not sent_response_writer or sent_response_writer.wrote_connection_close:
+                    close_connection = True
+                elif is_streaming:
+                    # The connection no longer holds a pool slot
+                    close_connection = True
+                elif isinstance(request.body, ContinueReader) and not request.body.consumed:
+                    # The client may or may not send the body it was
+                    # never asked for, so the connection can't be reused
                     close_connection = True
 
-        logger.debug("Closing connection")
+    def _export_trace(self, trace, request, addr, sent_response_writer):
+        attributes = {
+            'method': request.method,
+            'path': request.path,
+            'client': addr[0] if isinstance(addr, tuple) else 'unix',
+        }
+        if sent_response_writer and sent_response_writer.headers_sent:
+            attributes['status'] = int(sent_response_writer.headers_sent[0][:3])
+        self.span_exporter.export(trace, attributes)
 
-        try:
-            reader.close()
-        except IOError:
-            pass
+    def _start_reading_headers(self, greenlet, deadline_reader):
+        self.reading_headers[greenlet] = None
+        if self.header_timeout:
+            deadline_reader.deadline = ReadDeadline(
+                PHASE_HEADERS,
+                self.header_timeout,
+                self.header_max_timeout,
+                self.header_min_rate,
+            )
 
-        try:
-            writer.close()
-        except IOError:
-            pass
+    def _start_reading_body(self, greenlet, deadline_reader, trace=None):
+        self.reading_headers.pop(greenlet, None)
+        if trace is not None:
+            trace.headers_read_at = time.time()
+        if self.body_timeout:
+            deadline_reader.deadline = ReadDeadline(
+                PHASE_BODY,
+                self.body_timeout,
+                min_rate=self.body_min_rate,
+            )
+        else:
+            deadline_reader.deadline = None
 
-        conn.close()
+    def _evict_connection(self):
+        """
+        Close a connection to keep room in the pool for new ones,
+        preferring the oldest that hasn't yet sent its request headers,
+        then an idle keep-alive connection.
+        """
+        if self.reading_headers:
+            greenlet, _ = self.reading_headers.popitem(last=False)
+        elif self.idle_connections:
+            greenlet = self.idle_connections.pop()
+        else:
+            return
+
+        self.evicted_connections += 1
+        greenlet.kill(ConnectionEvicted, block=False)
+
+    def _make_response_writer(self, writer, server_headers=None, http_version='HTTP/1.1'):
+        return WSGIResponseWriter(
+            writer,
+            server_headers,
+            buffer_size=self.write_buffer_size,
+            buffer_delay=self.write_buffer_delay,
+            streaming_content_types=self.streaming_content_types,
+            cached_headers=self.cached_headers,
+            send_timeout=self.send_timeout,
+            response_send_timeout=self.response_send_timeout,
+            http_version=http_version,
+        )
+
+    def _send_response(self, request, writer, timer=None, conn=None, response_writer=None,
+                       server_address=None, trace=None):
+        if timer is None:
+            timer = RequestTimer('app')
+        else:
+            timer.phase('app')
 
-    def _send_response(self, request, writer):
-        environ = self._get_environ(request)
         server_headers = self._get_server_headers(request)
-        response_writer = WSGIResponseWriter(writer, server_headers)
+        if response_writer is None:
+            response_writer = self._make_response_writer(writer, server_headers, request.http_version)
+        else:
+            response_writer.reset(server_headers, request.http_version)
+        response_writer.trace = trace
+
+        start_response = response_writer.start_response
+        range_request = None
+        cache_key = None
+        if request.method == 'GET' and 'range' in request.headers:
+            # Partial responses are neither cached nor shared
+            range_request = RangeRequest(start_response, request.headers['range'], request.headers.get('if-range'))
+            start_response = range_request.start_response
+        elif self.response_cache is not None:
+            cache_key, cached_response = self.response_cache.lookup(request)
+            if cached_response is not None:
+                return self._send_cached_response(cached_response, response_writer, timer)
+        elif self.single_flight is not None:
+            cache_key = self.single_flight.make_key(request)
+
+        leading_flight = False
+        if cache_key is not None and self.single_flight is not None:
+            in_flight = self.single_flight.join(cache_key)
+            if in_flight is None:
+                leading_flight = True
+            else:
+                shared_response = self.single_flight.wait(in_flight, self.request_timeout)
+                if shared_response is not None:
+                    return self._send_cached_response(shared_response, response_writer, timer)
+
+        recorder = None
+        if cache_key is not None:
+            recorder = ResponseRecorder(start_response, self.max_recorded_size)
+            start_response = recorder.start_response
+
+        # Filled in by _start_stream as soon as the response turns out to
+        # be a stream, which may be long before its first item
+        stream = {}
+        try:
+            return self._call_application(
+                request,
+                start_response,
+                response_writer,
+                recorder,
+                timer,
+                conn,
+                server_address,
+                range_request,
+                trace,
+                stream,
+            )
+        finally:
+            if stream:
+                self._end_stream(stream)
+            if leading_flight:
+                self.single_flight.finish(cache_key, recorder)
+            if recorder is not None and recorder.complete and self.response_cache is not None:
+                self.response_cache.store(cache_key, recorder)
+
+    def _call_application(self, request, app_start_response, response_writer, recorder, timer, conn,
+                          server_address, range_request=None, trace=None, stream=None):
+        if stream is None:
+            stream = {}
+
+        def start_response(status, headers, exc_info=None):
+            write = app_start_response(status, headers, exc_info)
+            if not stream and response_writer.is_streaming:
+                self._start_stream(stream, conn)
+            return write
+
+        def start_streaming():
+            response_writer.start_streaming()
+            if not stream:
+                self._start_stream(stream, conn)
+
+        environ = self._get_environ(request, server_address)
+        environ['scotchwsgi.stream'] = start_streaming
 
         logger.debug("Calling into application")
-        response_iter = self.application(environ, response_writer.start_response)
+        if trace is not None:
+            environ.update(trace.get_environ())
+            trace.app_started_at = time.time()
+            response_iter = self.application(environ, start_response)
+            trace.app_returned_at = time.time()
+        else:
+            response_iter = self.application(environ, start_response)
         logger.debug("Called into application")
 
         try:
-            for response in response_iter:
-                if response: # don't write empty strings
+            if isinstance(response_iter, FileWrapper) and conn is not None and recorder is None:
+                sent_response_writer = self._send_file(response_iter, response_writer, range_request, conn, timer)
+                if sent_response_writer is not None:
+                    return sent_response_writer
+
+            if range_request is not None:
+                return self._send_ranges(response_iter, response_writer, range_request, timer)
+
+            response_iter_next = iter(response_iter)
+            for response in response_iter_next:
+                if not response_writer.headers_sent and response_writer.is_streaming:
+                    return self._stream_response(response, response_iter_next, response_writer, conn, timer, stream)
+
+                timer.phase('write')
+                if response:
                     logger.debug("Write %s", response)
                     response_writer.write(response)
+                    if recorder is not None:
+                        recorder.record(response)
+                else:
+                    # An empty string asks for buffered output to be sent
+                    response_writer.flush()
+                timer.phase('app')
 
-            if not response_writer.headers_sent or response_writer.wrote_transfer_encoding_chunked:
-                # Force headers to be sent if nothing was written previously.
-                # In the case of chunked encoding, write an empty (i.e. the last) chunk
-                # to mark end of message
-                response_writer.write(b"")
+            timer.phase('write')
+            response_writer.finish()
+
+            if recorder is not None:
+                recorder.complete = True
 
             return response_writer
+        except ClientDisconnected:
+            logger.info("Client disconnected before response completed")
+        except (SendTimeout, RequestTimeout):
+            # The connection can't be used again, leave it to be closed
+            raise
         except Exception as e:
             logger.error("Application aborted: %r", e)
         finally:
+            response_writer.cancel_flush()
             response_iter_close = getattr(response_iter, 'close', None)
             if callable(response_iter_close):
                 response_iter.close()
             logger.debug("Called into application")
 
-    def _send_error(self, status_line, writer):
+    def _send_file(self, file_wrapper, response_writer, range_request, conn, timer):
+        """
+        Send the file of a ``wsgi.file_wrapper`` response (or the ranges
+        of it asked for) with ``sendfile``. Returns ``None``, having
+        sent nothing, if the file, response or connection doesn't allow
+        it.
+        """
+        if isinstance(conn, SSL_SOCKET_TYPES):
+            return None
+
+        file_range = file_wrapper.get_file_range()
+        if file_range is None:
+            return None
+        fileno, offset, size = file_range
+
+        parts = None
+        trailer = b""
+        if range_request is not None:
+            range_request.begin(size)
+            parts = range_request.parts
+            trailer = range_request.trailer
+
+        if parts is None:
+            length = response_writer.content_length
+            if length is None or response_writer.is_streaming:
+                return None
+            parts = [(b"", 0, length)]
+
+        timer.phase('write')
+        for part_header, start, stop in parts:
+            if part_header:
+                response_writer.write(part_header)
+            response_writer.send_file(conn, fileno, offset + start, stop - start)
+        if trailer:
+            response_writer.write(trailer)
+        response_writer.finish()
+
+        return response_writer
+
+    def _send_ranges(self, response_iter, response_writer, range_request, timer):
+        """
+        Send the ranges of the response asked for, no longer iterating
+        over it once they have been sent.
+        """
+        for response in response_iter:
+            range_request.begin()
+            timer.phase('write')
+            for piece in range_request.select(response):
+                if piece:
+                    response_writer.write(piece)
+            if range_request.done:
+                break
+            timer.phase('app')
+
+        range_request.begin()
+        if range_request.parts is not None and not range_request.done:
+            logger.error("Response ended before the range asked for")
+            return None
+
+        timer.phase('write')
+        response_writer.finish()
+        return response_writer
+
+    def _send_cached_response(self, cached_response, response_writer, timer):
+        logger.debug("Sending cached response")
+        timer.phase('write')
+        response_writer.start_response(cached_response.status, cached_response.get_headers())
+        if cached_response.body:
+            response_writer.write(cached_response.body)
+        response_writer.finish()
+        return response_writer
+
+    def _stream_response(self, first_response, response_iter, response_writer, conn, timer, stream):
+        if not stream:
+            self._start_stream(stream, conn)
+        if not stream['detached']:
+            return self._send_error("503 Service Unavailable", response_writer.writer)
+
+        timer.phase('stream')
+        if first_response:
+            response_writer.write(first_response)
+        else:
+            response_writer.flush()
+
+        # Disconnects are already being watched for, see _start_stream
+        stream_response(response_iter, response_writer, None, self.heartbeat_interval)
+
+        response_writer.finish()
+        return response_writer
+
+    def _start_stream(self, stream, conn):
+        """
+        Move a streamed response's connection out of the pool and watch
+        for the client disconnecting, from when the application starts
+        the stream rather than when it sends the first item. Long polls
+        and event streams can wait a long time for that.
+        """
+        greenlet = gevent.getcurrent()
+        stream['greenlet'] = greenlet
+        stream['detached'] = self._detach_from_pool(greenlet)
+        if stream['detached'] and conn is not None:
+            stream['watcher'] = gevent.spawn(watch_disconnect, conn, greenlet)
+
+    def _end_stream(self, stream):
+        watcher = stream.get('watcher')
+        if watcher is not None:
+            watcher.kill(block=False)
+        self.streams.discard(stream['greenlet'])
+
+    def _detach_from_pool(self, greenlet):
+        """
+        Move a long-lived connection (a stream or websocket) out of the
+        connection pool, so that it does not hold on to a slot meant
+        for ordinary requests.
+        """
+        if len(self.streams) >= self.max_streams:
+            logger.error("Too many open streams, rejecting stream")
+            return False
+
+        self.streams.add(greenlet)
+        if self.pool is not None and greenlet in self.pool:
+            self.pool.discard(greenlet)
+
+        return True
+
+    def _handle_websocket(self, request, reader, writer, server_address=None):
+        greenlet = gevent.getcurrent()
+        if not self._detach_from_pool(greenlet):
+            self._send_error("503 Service Unavailable", writer)
+            return
+
+        try:
+            try:
+                with gevent.Timeout(self.send_timeout, SendTimeout):
+                    accept_websocket(request, writer)
+            except ValueError as e:
+                logger.error("Invalid websocket handshake: %s", e)
+                self._send_error("400 Bad Request", writer)
+                return
+
+            websocket = WebSocket(reader, writer, self.max_body_size, self.send_timeout)
+
+            environ = self._get_environ(request, server_address)
+            environ['wsgi.websocket'] = websocket
+            environ['wsgi.websocket_version'] = WEBSOCKET_VERSION
+
+            def start_response(status, headers, exc_info=None):
+                # The handshake response has already been sent
+                return websocket.send
+
+            logger.debug("Calling into application (websocket)")
+            response_iter = self.application(environ, start_response)
+            try:
+                for _ in response_iter:
+                    pass
+            except SendTimeout:
+                # Counted as a slow client by _handle_connection
+                raise
+            except Exception as e:
+                logger.error("Application aborted: %r", e)
+            finally:
+                response_iter_close = getattr(response_iter, 'close', None)
+                if callable(response_iter_close):
+                    response_iter.close()
+                websocket.close()
+        finally:
+            self.streams.discard(greenlet)
+
+    def _send_error(self, status_line, writer, headers=()):
         server_headers = [('Connection', 'close')]
-        response_writer = WSGIResponseWriter(writer, server_headers)
-        response_writer.start_response(status_line, [])
+        response_writer = WSGIResponseWriter(
+            writer,
+            server_headers,
+            cached_headers=self.cached_headers,
+            send_timeout=self.send_timeout,
+        )
+        response_writer.start_response(status_line, list(headers))
         response_writer.write(b'')
         return response_writer
 
-    def _get_environ(self, request):
+    def _send_status(self, addr, writer, timer):
+        """
+        Send the scoreboard as plain text. It shows clients' addresses
+        and request lines, so only local clients may see it.
+        """
+        if self.scoreboard is None or not is_local_client(addr):
+            return self._send_error("404 Not Found", writer)
+
+        timer.phase('write')
+        body = self.scoreboard.render().encode(const.STR_ENCODING)
+        response_writer = WSGIResponseWriter(
+            writer,
+            [('Connection', 'close')],
+            cached_headers=self.cached_headers,
+            send_timeout=self.send_timeout,
+        )
+        response_writer.start_response('200 OK', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        response_writer.write(body)
+        return response_writer
+
+    def is_ready(self):
+        """
+        Return whether the worker should be sent more requests, which
+        it shouldn't if it is draining or nearly out of connections.
+        """
+        if self.draining:
+            return False
+        return self.pool is None or self.pool.free_count() >= const.READINESS_FREE_SLOTS
+
+    def _send_probe_response(self, request, writer):
+        """
+        Answer a health or readiness probe from a pre-built response.
+        Returns whether the connection can be kept open.
+        """
+        if request.path == self.readiness_path and not self.is_ready():
+            probe_response = NOT_READY_RESPONSE
+        else:
+            probe_response = READY_RESPONSE
+
+        status_line, headers, body = probe_response
+        response = [status_line, self.cached_headers.date, self.cached_headers.server, headers]
+        if request.method != 'HEAD':
+            response.append(body)
+
+        with gevent.Timeout(self.send_timeout, SendTimeout):
+            writer.write(b"".join(response))
+            writer.flush()
+
+        return probe_response is READY_RESPONSE and not isinstance(request.body, ContinueReader)
+
+    def _get_environ(self, request, server_address=None):
+        server_name, server_port = server_address or self.server_address
+        if not server_port:
+            # Unix domain sockets have no port, use the one the client asked for
+            server_name, server_port = self._get_host(request, server_name)
+
         environ = {
             'REQUEST_METHOD': request.method,
             'SCRIPT_NAME': '',
-            'SERVER_NAME': self.hostname,
-            'SERVER_PORT': str(self.port),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': server_port,
             'SERVER_PROTOCOL': request.http_version,
             'PATH_INFO': request.path,
-            'QUERY_STRING': request.query,
+            'QUERY_STRING': request.query or '',
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': 'http',
-            'wsgi.input': BytesIO(request.body),
+            'wsgi.input': self._get_input(request),
             'wsgi.errors': sys.stderr,
+            'wsgi.file_wrapper': FileWrapper,
             'wsgi.multithread': True,
             'wsgi.multiprocess': True,
             'wsgi.run_once': False,
         }
 
-        environ['PATH_INFO'] = request.path
-        environ['QUERY_STRING'] = request.query if request.query else ''
-
-        environ_headers = request.headers.copy()
-        if 'content-type' in request.headers:
-            environ['CONTENT_TYPE'] = environ_headers.pop('content-type')
-        if 'content-length' in request.headers:
-            environ['CONTENT_LENGTH'] = environ_headers.pop('content-length')
-        for http_header_name, http_header_value in environ_headers.items():
-            http_header_name = 'HTTP_{}'.format(http_header_name.upper().replace('-', '_'))
-            environ[http_header_name] = http_header_value
-        environ_headers.clear()
+        environ_keys = ENVIRON_KEYS
+        for http_header_name, http_header_value in request.headers.items():
+            environ_key = environ_keys.get(http_header_name)
+            if environ_key is None:
+                environ_key = get_environ_key(http_header_name)
+            environ[environ_key] = http_header_value
 
         return environ
 
+    def _get_host(self, request, default_name):
+        host = request.headers.get('host')
+        if not host:
+            return default_name, '80'
+
+        name, sep, port = host.rpartition(':')
+        if sep and port.isdigit() and not name.endswith(':'):
+            return name, port
+        return host, '80'
+
+    def _get_input(self, request):
+        if isinstance(request.body, ContinueReader):
+            return request.body
+        return BytesIO(request.body)
+
     def _get_server_headers(self, request):
-        server_headers = []
-        if request.headers.get('connection', '').lower() == 'close':
-            server_headers.append(('Connection', 'close'))
-        return server_headers
+        connection_options = [
+            option.strip().lower()
+            for option in request.headers.get('connection', '').split(',')
+        ]
+        if request.http_version == 'HTTP/1.0':
+            # HTTP/1.0 connections are only persistent if asked for
+            if not self.draining and 'keep-alive' in connection_options:
+                return [('Connection', 'keep-alive')]
+            return [('Connection', 'close')]
+
+        if self.draining or 'close' in connection_options:
+            return [('Connection', 'close')]
+        return []
+
+def get_environ_key(header_name):
+    """
+    Return the environ key for a (lower case) request header name,
+    remembering it for the next request with that header.
+    """
+    environ_key = 'HTTP_' + header_name.upper().replace('-', '_')
+    # Header names are chosen by clients, so only so many are kept
+    if len(ENVIRON_KEYS) < MAX_ENVIRON_KEYS:
+        ENVIRON_KEYS[header_name] = environ_key
+    return environ_key
+
+def is_local_client(addr):
+    """
+    Return whether a client connected over the loopback interface or a
+    Unix domain socket.
+    """
+    if not isinstance(addr, tuple):
+        return True
+
+    try:
+        return ipaddress.ip_address(addr[0]).is_loopback
+    except ValueError:
+        return False
+
+def get_rss():
+    """
+    Return the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # Without /proc, fall back to the peak RSS (in KB on Linux and
+        # bytes on macOS)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
 
 def start_new_worker(*args, **kwargs):
     worker = WSGIWorker(*args, **kwargs)
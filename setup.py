@@ -9,6 +9,9 @@ setup(
     install_requires=[
         'gevent',
     ],
+    extras_require={
+        'httptools': ['httptools'],
+    },
     packages=['scotchwsgi'],
     scripts=[
         'bin/scotchwsgi',
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from scotchwsgi import affinity
+from scotchwsgi.affinity import (
+    get_interface_cpus,
+    get_interface_node_cpus,
+    get_worker_cpu_sets,
+    order_cpus,
+    parse_cpu_list,
+    parse_cpu_mask,
+)
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+class TestParsing(unittest.TestCase):
+    def test_cpu_list(self):
+        self.assertEqual(parse_cpu_list('0-3,8'), [0, 1, 2, 3, 8])
+        self.assertEqual(parse_cpu_list('5\n'), [5])
+
+    def test_invalid_cpu_list(self):
+        for value in ('', 'a', '1-', '1-b'):
+            with self.assertRaises(ValueError):
+                parse_cpu_list(value)
+
+    def test_cpu_mask(self):
+        self.assertEqual(parse_cpu_mask('0000000a'), [1, 3])
+        self.assertEqual(parse_cpu_mask('00000001,00000000'), [32])
+        self.assertEqual(parse_cpu_mask('0'), [])
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        paths = {
+            'SYS_CPU_PATH': 'cpu',
+            'SYS_NODE_PATH': 'node',
+            'SYS_NET_PATH': 'net',
+            'PROC_INTERRUPTS_PATH': 'interrupts',
+            'PROC_IRQ_PATH': 'irq',
+        }
+        self.patches = [
+            patch.object(affinity, name, os.path.join(self.root.name, path))
+            for name, path in paths.items()
+        ]
+        for path_patch in self.patches:
+            path_patch.start()
+
+    def tearDown(self):
+        for path_patch in self.patches:
+            path_patch.stop()
+        self.root.cleanup()
+
+    def _path(self, *parts):
+        return os.path.join(self.root.name, *parts)
+
+    def test_order_cpus(self):
+        # CPUs 0 and 2, 1 and 3 are hyperthread siblings
+        for cpu, siblings in ((0, '0,2'), (1, '1,3'), (2, '0,2'), (3, '1,3')):
+            write_file(self._path('cpu', 'cpu%d' % cpu, 'topology', 'thread_siblings_list'), siblings)
+
+        self.assertEqual(order_cpus([0, 1, 2, 3]), [0, 1, 2, 3])
+        self.assertEqual(order_cpus([3, 2, 1, 0]), [0, 1, 2, 3])
+
+    def test_order_cpus_adjacent_siblings(self):
+        # CPUs 0 and 1, 2 and 3 are hyperthread siblings
+        for cpu, siblings in ((0, '0-1'), (1, '0-1'), (2, '2-3'), (3, '2-3')):
+            write_file(self._path('cpu', 'cpu%d' % cpu, 'topology', 'thread_siblings_list'), siblings)
+
+        self.assertEqual(order_cpus([0, 1, 2, 3]), [0, 2, 1, 3])
+
+    def test_interface_cpus_from_interrupts(self):
+        write_file(self._path('interrupts'), (
+            "           CPU0       CPU1\n"
+            "  24:         10          0   PCI-MSI 1-edge      eth0-TxRx-0\n"
+            "  25:          0         10   PCI-MSI 2-edge      eth0-TxRx-1\n"
+            "  26:          0         10   PCI-MSI 3-edge      eth1-TxRx-0\n"
+            " NMI:          0          0   Non-maskable interrupts\n"
+        ))
+        write_file(self._path('irq', '24', 'smp_affinity_list'), '3')
+        write_file(self._path('irq', '25', 'smp_affinity_list'), '1-2')
+        write_file(self._path('irq', '26', 'smp_affinity_list'), '5')
+
+        self.assertEqual(get_interface_cpus('eth0'), [3, 1])
+
+    def test_interface_cpus_from_rps(self):
+        write_file(self._path('net', 'eth0', 'queues', 'rx-0', 'rps_cpus'), '4')
+        write_file(self._path('net', 'eth0', 'queues', 'rx-1', 'rps_cpus'), '8')
+        write_file(self._path('net', 'eth0', 'queues', 'tx-0', 'xps_cpus'), '1')
+
+        self.assertEqual(get_interface_cpus('eth0'), [2, 3])
+
+    def test_interface_without_queues(self):
+        self.assertEqual(get_interface_cpus('eth0'), [])
+
+    def test_interface_node_cpus(self):
+        write_file(self._path('net', 'eth0', 'device', 'numa_node'), '1')
+        write_file(self._path('node', 'node1', 'cpulist'), '4-7')
+
+        self.assertEqual(get_interface_node_cpus('eth0'), [4, 5, 6, 7])
+
+    def test_interface_node_unknown(self):
+        write_file(self._path('net', 'eth0', 'device', 'numa_node'), '-1')
+
+        self.assertEqual(get_interface_node_cpus('eth0'), [])
+
+    @patch('scotchwsgi.affinity.os.sched_getaffinity', create=True, return_value={0, 1, 2, 3, 4, 5, 6, 7})
+    def test_auto_cpu_sets(self, _):
+        self.assertEqual(get_worker_cpu_sets('auto'), [{cpu} for cpu in range(8)])
+
+    @patch('scotchwsgi.affinity.os.sched_getaffinity', create=True, return_value={0, 1, 2, 3, 4, 5, 6, 7})
+    def test_auto_cpu_sets_for_interface(self, _):
+        write_file(self._path('net', 'eth0', 'queues', 'rx-0', 'rps_cpus'), '40')
+        write_file(self._path('net', 'eth0', 'queues', 'rx-1', 'rps_cpus'), '10')
+
+        self.assertEqual(get_worker_cpu_sets(['auto'], 'eth0'), [{6}, {4}])
+
+    @patch('scotchwsgi.affinity.os.sched_getaffinity', create=True, return_value={0, 1, 2, 3, 4, 5, 6, 7})
+    def test_auto_cpu_sets_for_interface_node(self, _):
+        write_file(self._path('net', 'eth0', 'device', 'numa_node'), '1')
+        write_file(self._path('node', 'node1', 'cpulist'), '4-7')
+
+        self.assertEqual(get_worker_cpu_sets(['auto'], 'eth0'), [{4}, {5}, {6}, {7}])
+
+    def test_explicit_cpu_sets(self):
+        self.assertEqual(get_worker_cpu_sets(['0-1', '2,3']), [{0, 1}, {2, 3}])
@@ -0,0 +1,83 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from scotchwsgi.autoscale import Autoscaler
+from scotchwsgi.scoreboard import Scoreboard
+
+class TestAutoscaler(unittest.TestCase):
+    def setUp(self):
+        self.scoreboard = Scoreboard(4, connections_per_worker=1)
+        self.worker_scoreboards = [self.scoreboard.worker(index) for index in range(4)]
+        for index, worker_scoreboard in enumerate(self.worker_scoreboards):
+            worker_scoreboard.start(1000 + index)
+
+        self.autoscaler = Autoscaler(self.scoreboard, [], 1, 4, cooldown=0)
+
+        self.mock_get_queue_length = patch.object(Autoscaler, 'get_queue_length', return_value=0)
+        self.mock_get_queue_length.start()
+
+    def tearDown(self):
+        self.mock_get_queue_length.stop()
+
+    def _set_busy_ratio(self, num_workers, busy_ratio):
+        # Measure once, then pretend a second has passed with each
+        # worker busy for busy_ratio of it
+        self.autoscaler.measure(num_workers)
+        for index in range(num_workers):
+            pid, busy_time, measured_at = self.autoscaler.samples[index]
+            self.autoscaler.samples[index] = (pid, busy_time - busy_ratio, measured_at - 1)
+
+    def test_measure(self):
+        now = time.time()
+        self.assertIsNone(self.autoscaler.measure(2, now))
+
+        self.worker_scoreboards[0].start_request()
+        self.worker_scoreboards[0].busy_since = now
+        self.worker_scoreboards[0]._write()
+
+        self.assertAlmostEqual(self.autoscaler.measure(2, now + 2), 0.5)
+
+    def test_replaced_worker_not_measured(self):
+        self.autoscaler.measure(1)
+        self.worker_scoreboards[0].start(2000)
+
+        self.assertIsNone(self.autoscaler.measure(1))
+
+    def test_scale_up(self):
+        self._set_busy_ratio(2, 1.0)
+        self.assertEqual(self.autoscaler.get_target(2), 3)
+
+    def test_scale_up_capped(self):
+        self._set_busy_ratio(4, 1.0)
+        self.assertEqual(self.autoscaler.get_target(4), 4)
+
+    def test_scale_up_on_queue(self):
+        self._set_busy_ratio(2, 0.5)
+        with patch.object(Autoscaler, 'get_queue_length', return_value=100):
+            self.assertEqual(self.autoscaler.get_target(2), 3)
+
+    def test_scale_down(self):
+        self._set_busy_ratio(3, 0.1)
+        self.assertEqual(self.autoscaler.get_target(3), 2)
+
+    def test_scale_down_capped(self):
+        self._set_busy_ratio(1, 0.0)
+        self.assertEqual(self.autoscaler.get_target(1), 1)
+
+    def test_hysteresis(self):
+        self._set_busy_ratio(2, 0.5)
+        self.assertEqual(self.autoscaler.get_target(2), 2)
+
+    def test_cooldown(self):
+        self.autoscaler.cooldown = 60
+        self.autoscaler.last_scaled = time.monotonic()
+
+        self._set_busy_ratio(2, 1.0)
+        self.assertEqual(self.autoscaler.get_target(2), 2)
+
+    def test_invalid_range(self):
+        with self.assertRaises(ValueError):
+            Autoscaler(self.scoreboard, [], 4, 2)
+        with self.assertRaises(ValueError):
+            Autoscaler(self.scoreboard, [], 1, 4, scale_up_ratio=0.5, scale_down_ratio=0.5)
@@ -0,0 +1,178 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from scotchwsgi.cache import ResponseCache, ResponseRecorder, SingleFlight
+from scotchwsgi.request import WSGIRequest
+
+def make_request(method='GET', path='/', query='', headers=None):
+    return WSGIRequest(method, path, query, 'HTTP/1.1', headers or {}, b'')
+
+def make_recorder(status='200 OK', headers=None, body=b'abc', max_size=1024):
+    if headers is None:
+        headers = [('Cache-Control', 'max-age=1')]
+    recorder = ResponseRecorder(Mock(), max_size)
+    write = recorder.start_response(status, headers)
+    write(body)
+    return recorder
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(1024)
+
+    def test_miss_then_hit(self):
+        key, cached_response = self.cache.lookup(make_request())
+        self.assertIsNone(cached_response)
+        self.cache.store(key, make_recorder())
+
+        key, cached_response = self.cache.lookup(make_request())
+        self.assertEqual(cached_response.status, '200 OK')
+        self.assertEqual(cached_response.body, b'abc')
+        self.assertIn(('Age', '0'), cached_response.get_headers())
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_keyed_by_query(self):
+        key, _ = self.cache.lookup(make_request(query='a=1'))
+        self.cache.store(key, make_recorder())
+
+        _, cached_response = self.cache.lookup(make_request(query='a=2'))
+        self.assertIsNone(cached_response)
+
+    def test_keyed_by_vary_headers(self):
+        cache = ResponseCache(1024, vary_headers=['Accept-Language'])
+        key, _ = cache.lookup(make_request(headers={'accept-language': 'en'}))
+        cache.store(key, make_recorder(headers=[
+            ('Cache-Control', 'max-age=1'),
+            ('Vary', 'Accept-Language'),
+        ]))
+
+        _, cached_response = cache.lookup(make_request(headers={'accept-language': 'fr'}))
+        self.assertIsNone(cached_response)
+        _, cached_response = cache.lookup(make_request(headers={'accept-language': 'en'}))
+        self.assertIsNotNone(cached_response)
+
+    def test_expired(self):
+        with patch('scotchwsgi.cache.time.monotonic', return_value=100):
+            key, _ = self.cache.lookup(make_request())
+            self.cache.store(key, make_recorder())
+
+        with patch('scotchwsgi.cache.time.monotonic', return_value=101):
+            _, cached_response = self.cache.lookup(make_request())
+
+        self.assertIsNone(cached_response)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_uncacheable_requests(self):
+        key, _ = self.cache.lookup(make_request(method='POST'))
+        self.assertIsNone(key)
+        key, _ = self.cache.lookup(make_request(headers={'authorization': 'Basic abc'}))
+        self.assertIsNone(key)
+
+    def test_uncacheable_responses(self):
+        for status, headers in (
+            ('200 OK', []),
+            ('200 OK', [('Cache-Control', 'max-age=0')]),
+            ('200 OK', [('Cache-Control', 'no-store')]),
+            ('200 OK', [('Cache-Control', 'private, max-age=10')]),
+            ('200 OK', [('Cache-Control', 'max-age=10'), ('Set-Cookie', 'a=1')]),
+            ('200 OK', [('Cache-Control', 'max-age=10'), ('Vary', 'Cookie')]),
+            ('500 Internal Server Error', [('Cache-Control', 'max-age=10')]),
+        ):
+            key, _ = self.cache.lookup(make_request())
+            self.cache.store(key, make_recorder(status, headers))
+            self.assertEqual(len(self.cache.entries), 0, (status, headers))
+
+    def test_s_maxage_preferred(self):
+        self.assertEqual(self.cache.get_max_age([('Cache-Control', 's-maxage=5, max-age=1')]), 5)
+        self.assertEqual(self.cache.get_max_age([('Cache-Control', 'max-age=1, s-maxage=5')]), 5)
+
+    def test_body_too_large(self):
+        key, _ = self.cache.lookup(make_request())
+        self.cache.store(key, make_recorder(body=b'a' * 2048, max_size=1024))
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(300)
+        for path in ('/a', '/b'):
+            key, _ = cache.lookup(make_request(path=path))
+            cache.store(key, make_recorder(body=b'a' * 100))
+
+        # Make /a the most recently used
+        cache.lookup(make_request(path='/a'))
+
+        key, _ = cache.lookup(make_request(path='/c'))
+        cache.store(key, make_recorder(body=b'a' * 100))
+
+        self.assertIsNotNone(cache.lookup(make_request(path='/a'))[1])
+        self.assertIsNone(cache.lookup(make_request(path='/b'))[1])
+        self.assertIsNotNone(cache.lookup(make_request(path='/c'))[1])
+        self.assertLessEqual(cache.size, 300)
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.key = self.single_flight.make_key(make_request())
+
+    def _finish_recorder(self, **kwargs):
+        recorder = make_recorder(**kwargs)
+        recorder.complete = True
+        return recorder
+
+    def test_first_request_leads(self):
+        self.assertIsNone(self.single_flight.join(self.key))
+        self.assertIsNotNone(self.single_flight.join(self.key))
+
+    def test_response_shared(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.single_flight.finish(self.key, self._finish_recorder())
+
+        response = self.single_flight.wait(in_flight)
+        self.assertEqual(response.body, b'abc')
+        self.assertEqual(self.single_flight.coalesced, 1)
+        self.assertEqual(self.single_flight.flights, {})
+
+    def test_private_response_not_shared(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.single_flight.finish(self.key, self._finish_recorder(headers=[('Cache-Control', 'private')]))
+
+        self.assertIsNone(self.single_flight.wait(in_flight))
+
+    def test_response_without_cache_control_not_shared(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.single_flight.finish(self.key, self._finish_recorder(headers=[('Content-Length', '3')]))
+
+        self.assertIsNone(self.single_flight.wait(in_flight))
+
+    def test_public_response_shared(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.single_flight.finish(self.key, self._finish_recorder(headers=[('Cache-Control', 'public')]))
+
+        self.assertEqual(self.single_flight.wait(in_flight).body, b'abc')
+
+    def test_request_with_cookie_not_coalesced(self):
+        self.assertIsNone(self.single_flight.make_key(make_request(headers={'cookie': 'session=1'})))
+
+        single_flight = SingleFlight(vary_headers=['Cookie'])
+        self.assertIsNotNone(single_flight.make_key(make_request(headers={'cookie': 'session=1'})))
+
+    def test_incomplete_response_not_shared(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.single_flight.finish(self.key, make_recorder())
+
+        self.assertIsNone(self.single_flight.wait(in_flight))
+
+    def test_wait_timeout(self):
+        self.single_flight.join(self.key)
+        in_flight = self.single_flight.join(self.key)
+
+        self.assertIsNone(self.single_flight.wait(in_flight, timeout=0.01))
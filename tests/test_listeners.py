@@ -0,0 +1,131 @@
+import os
+import stat
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from gevent import socket
+
+from scotchwsgi.listeners import (
+    configure_listener,
+    create_listener,
+    format_address,
+    get_accept_queue_length,
+    get_server_address,
+    get_server_name,
+    get_systemd_listeners,
+    parse_bind,
+)
+
+class TestParseBind(unittest.TestCase):
+    def test_host_port(self):
+        self.assertEqual(parse_bind('localhost:8080'), ('localhost', 8080))
+
+    def test_ipv6(self):
+        self.assertEqual(parse_bind('[::1]:8080'), ('::1', 8080))
+
+    def test_unix(self):
+        self.assertEqual(parse_bind('unix:/run/app.sock'), '/run/app.sock')
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_bind('localhost')
+
+    def test_server_name(self):
+        self.assertEqual(get_server_name(('api.example.com', 8080), 'localhost'), 'api.example.com')
+        self.assertEqual(get_server_name(('0.0.0.0', 8080), 'localhost'), 'localhost')
+        self.assertEqual(get_server_name('/run/app.sock', 'localhost'), 'localhost')
+
+    def test_format_address(self):
+        self.assertEqual(format_address(('localhost', 8080)), 'localhost:8080')
+        self.assertEqual(format_address('/run/app.sock'), 'unix:/run/app.sock')
+
+class TestCreateListener(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'app.sock')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_unix_socket(self):
+        sock = create_listener(self.path, unix_socket_mode=0o660)
+        try:
+            self.assertEqual(sock.family, socket.AF_UNIX)
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o660)
+            self.assertEqual(get_server_address(sock, 'example.com'), ('example.com', ''))
+        finally:
+            sock.close()
+
+    def test_stale_unix_socket_replaced(self):
+        create_listener(self.path).close()
+        sock = create_listener(self.path)
+        sock.close()
+
+    def test_tcp_socket(self):
+        sock = create_listener(('127.0.0.1', 0))
+        try:
+            _, port = sock.getsockname()
+            self.assertEqual(get_server_address(sock, 'example.com'), ('example.com', str(port)))
+        finally:
+            sock.close()
+
+class TestConfigureListener(unittest.TestCase):
+    def setUp(self):
+        self.sock = create_listener(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_buffer_sizes(self):
+        configure_listener(self.sock, send_buffer_size=65536, receive_buffer_size=65536)
+
+        # Linux doubles the requested size for bookkeeping overhead
+        self.assertGreaterEqual(self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 65536)
+        self.assertGreaterEqual(self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+
+    @unittest.skipUnless(hasattr(socket, 'TCP_DEFER_ACCEPT'), "TCP_DEFER_ACCEPT not supported")
+    def test_defer_accept(self):
+        configure_listener(self.sock, defer_accept=5)
+
+        self.assertGreater(self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT), 0)
+
+    def test_unsupported_option_skipped(self):
+        with patch('scotchwsgi.listeners.socket.TCP_FASTOPEN', None, create=True):
+            configure_listener(self.sock, fastopen=128)
+
+class TestSystemdListeners(unittest.TestCase):
+    def test_not_activated(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(get_systemd_listeners(), [])
+
+    def test_other_process(self):
+        with patch.dict(os.environ, {'LISTEN_PID': str(os.getpid() + 1), 'LISTEN_FDS': '1'}):
+            self.assertEqual(get_systemd_listeners(), [])
+
+    def test_activated(self):
+        mock_socket = Mock()
+        with patch.dict(os.environ, {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '2'}), \
+             patch('scotchwsgi.listeners.socket.socket', mock_socket):
+            listeners = get_systemd_listeners()
+            self.assertNotIn('LISTEN_FDS', os.environ)
+
+        self.assertEqual(len(listeners), 2)
+        mock_socket.assert_any_call(fileno=3)
+        mock_socket.assert_any_call(fileno=4)
+
+class TestGetAcceptQueueLength(unittest.TestCase):
+    @unittest.skipUnless(hasattr(socket, 'TCP_INFO'), "TCP_INFO not supported")
+    def test_queued_connections(self):
+        sock = create_listener(('127.0.0.1', 0))
+        self.assertEqual(get_accept_queue_length(sock), 0)
+
+        clients = [socket.create_connection(sock.getsockname()) for _ in range(3)]
+        self.assertEqual(get_accept_queue_length(sock), 3)
+
+        for client in clients:
+            client.close()
+        sock.close()
+
+    def test_unix_socket(self):
+        self.assertIsNone(get_accept_queue_length(Mock(family=socket.AF_UNIX)))
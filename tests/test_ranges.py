@@ -0,0 +1,127 @@
+import unittest
+from unittest.mock import Mock
+
+from scotchwsgi.ranges import MAX_RANGES, RangeNotSatisfiable, RangeRequest, if_range_matches, parse_range
+
+class TestParseRange(unittest.TestCase):
+    def test_single_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), [(0, 100)])
+        self.assertEqual(parse_range('bytes=900-', 1000), [(900, 1000)])
+        self.assertEqual(parse_range('bytes=-100', 1000), [(900, 1000)])
+        # Clamped to the body
+        self.assertEqual(parse_range('bytes=900-2000', 1000), [(900, 1000)])
+        self.assertEqual(parse_range('bytes=-2000', 1000), [(0, 1000)])
+
+    def test_multiple_ranges_merged(self):
+        self.assertEqual(
+            parse_range('bytes=500-599, 0-99,50-149, 150-199', 1000),
+            [(0, 200), (500, 600)],
+        )
+
+    def test_unsatisfiable_ranges_dropped(self):
+        self.assertEqual(parse_range('bytes=2000-, 0-0', 1000), [(0, 1)])
+
+    def test_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=1000-', 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=-0', 1000)
+
+    def test_invalid_ignored(self):
+        self.assertIsNone(parse_range('items=0-1', 1000))
+        self.assertIsNone(parse_range('bytes', 1000))
+        self.assertIsNone(parse_range('bytes=1-0', 1000))
+        self.assertIsNone(parse_range('bytes=-', 1000))
+        self.assertIsNone(parse_range('bytes=a-b', 1000))
+        self.assertIsNone(parse_range('bytes=0-1,' * (MAX_RANGES + 1), 1000))
+
+class TestIfRange(unittest.TestCase):
+    def test_etag(self):
+        headers = [('ETag', '"abc"')]
+        self.assertTrue(if_range_matches('"abc"', headers))
+        self.assertFalse(if_range_matches('"def"', headers))
+        self.assertFalse(if_range_matches('W/"abc"', [('ETag', 'W/"abc"')]))
+
+    def test_last_modified(self):
+        headers = [('Last-Modified', 'Thu, 01 Jan 1970 00:00:00 GMT')]
+        self.assertTrue(if_range_matches('Thu, 01 Jan 1970 00:00:00 GMT', headers))
+        self.assertFalse(if_range_matches('Fri, 02 Jan 1970 00:00:00 GMT', headers))
+        self.assertFalse(if_range_matches('Thu, 01 Jan 1970 00:00:00 GMT', []))
+
+class TestRangeRequest(unittest.TestCase):
+    BODY = bytes(range(100))
+
+    def _send(self, range_header, headers, if_range=None, chunk_size=7):
+        start_response = Mock()
+        range_request = RangeRequest(start_response, range_header, if_range)
+        range_request.start_response('200 OK', headers)
+
+        pieces = []
+        for i in range(0, len(self.BODY), chunk_size):
+            range_request.begin()
+            pieces.extend(range_request.select(self.BODY[i:i + chunk_size]))
+            if range_request.done:
+                break
+
+        status, response_headers = start_response.call_args[0]
+        return status, dict(response_headers), b"".join(pieces)
+
+    def test_single_range(self):
+        status, headers, body = self._send('bytes=10-29', [('Content-Length', '100')])
+
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(headers['Content-Range'], 'bytes 10-29/100')
+        self.assertEqual(headers['Content-Length'], '20')
+        self.assertEqual(body, self.BODY[10:30])
+
+    def test_multiple_ranges(self):
+        status, headers, body = self._send(
+            'bytes=0-4,50-59',
+            [('Content-Type', 'text/plain'), ('Content-Length', '100')],
+        )
+
+        self.assertEqual(status, '206 Partial Content')
+        content_type, boundary = headers['Content-Type'].split('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertEqual(
+            body,
+            b"\r\n--" + boundary.encode() + b"\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-4/100\r\n\r\n"
+            + self.BODY[0:5]
+            + b"\r\n--" + boundary.encode() + b"\r\nContent-Type: text/plain\r\nContent-Range: bytes 50-59/100\r\n\r\n"
+            + self.BODY[50:60]
+            + b"\r\n--" + boundary.encode() + b"--\r\n"
+        )
+
+    def test_not_satisfiable(self):
+        status, headers, body = self._send('bytes=100-', [('Content-Length', '100')])
+
+        self.assertEqual(status, '416 Range Not Satisfiable')
+        self.assertEqual(headers['Content-Range'], 'bytes */100')
+        self.assertEqual(headers['Content-Length'], '0')
+        self.assertEqual(body, b"")
+
+    def test_unknown_length(self):
+        status, headers, body = self._send('bytes=10-29', [])
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, self.BODY)
+
+    def test_if_range_mismatch(self):
+        status, headers, body = self._send(
+            'bytes=10-29',
+            [('Content-Length', '100'), ('ETag', '"new"')],
+            if_range='"old"',
+        )
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, self.BODY)
+
+    def test_not_ok_response(self):
+        start_response = Mock()
+        range_request = RangeRequest(start_response, 'bytes=0-1')
+        range_request.start_response('404 Not Found', [('Content-Length', '100')])
+        range_request.begin()
+
+        start_response.assert_called_once_with('404 Not Found', [('Content-Length', '100')])
+        self.assertIsNone(range_request.parts)
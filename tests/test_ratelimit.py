@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import patch
+
+from scotchwsgi.ratelimit import RateLimiter
+
+class TestConnectionLimit(unittest.TestCase):
+    def test_max_connections(self):
+        rate_limiter = RateLimiter(max_connections=2)
+
+        self.assertTrue(rate_limiter.acquire_connection('1.2.3.4'))
+        self.assertTrue(rate_limiter.acquire_connection('1.2.3.4'))
+        self.assertFalse(rate_limiter.acquire_connection('1.2.3.4'))
+        self.assertTrue(rate_limiter.acquire_connection('5.6.7.8'))
+
+        rate_limiter.release_connection('1.2.3.4')
+        self.assertTrue(rate_limiter.acquire_connection('1.2.3.4'))
+
+    def test_released_clients_forgotten(self):
+        rate_limiter = RateLimiter(max_connections=2)
+        rate_limiter.acquire_connection('1.2.3.4')
+        rate_limiter.release_connection('1.2.3.4')
+
+        self.assertEqual(rate_limiter.connections, {})
+
+    def test_unlimited(self):
+        rate_limiter = RateLimiter(rate=1)
+        for _ in range(10):
+            self.assertTrue(rate_limiter.acquire_connection('1.2.3.4'))
+
+class TestRequestRateLimit(unittest.TestCase):
+    @patch('scotchwsgi.ratelimit.time.monotonic')
+    def test_burst_then_refill(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        rate_limiter = RateLimiter(rate=2, burst=3)
+
+        for _ in range(3):
+            self.assertEqual(rate_limiter.allow_request('1.2.3.4'), 0)
+        self.assertEqual(rate_limiter.allow_request('1.2.3.4'), 1)
+        # Other clients have their own bucket
+        self.assertEqual(rate_limiter.allow_request('5.6.7.8'), 0)
+
+        mock_monotonic.return_value = 100.5
+        self.assertEqual(rate_limiter.allow_request('1.2.3.4'), 0)
+        self.assertEqual(rate_limiter.allow_request('1.2.3.4'), 1)
+
+    def test_max_clients(self):
+        rate_limiter = RateLimiter(rate=1, max_clients=2)
+        for client in ('a', 'b', 'c'):
+            rate_limiter.allow_request(client)
+
+        self.assertEqual(list(rate_limiter.buckets), ['b', 'c'])
+
+    @patch('scotchwsgi.ratelimit.time.monotonic')
+    def test_sweep(self, mock_monotonic):
+        rate_limiter = RateLimiter(rate=1, burst=2)
+        mock_monotonic.return_value = 100
+        rate_limiter.allow_request('a')
+        mock_monotonic.return_value = 101
+        rate_limiter.allow_request('b')
+
+        mock_monotonic.return_value = 102.5
+        rate_limiter.sweep()
+
+        self.assertEqual(list(rate_limiter.buckets), ['b'])
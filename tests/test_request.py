@@ -1,7 +1,14 @@
 import unittest
-from io import BytesIO
+from io import BufferedReader, BytesIO
 
-from scotchwsgi.request import WSGIRequest
+from scotchwsgi.parser import HttptoolsParser, PythonParser, get_parser, httptools
+from scotchwsgi.request import (
+    ContinueReader,
+    ExpectationFailed,
+    RequestEntityTooLarge,
+    RequestHeaderFieldsTooLarge,
+    WSGIRequest,
+)
 
 class TestRequestLine(unittest.TestCase):
     def test_request_line_empty(self):
@@ -123,10 +130,37 @@ class TestRequestBody(unittest.TestCase):
             b'helloworld'
         )
 
+    def test_chunked_body_with_trailer(self):
+        reader = BytesIO(b'5\r\nhello\r\n0\r\nTrailer-One: value\r\n\r\nnext')
+        self.assertEqual(
+            WSGIRequest.read_body(reader),
+            b'hello'
+        )
+        self.assertEqual(reader.read(), b'next')
+
+    def test_chunked_body_ends_in_trailer(self):
+        reader = BytesIO(b'5\r\nhello\r\n0\r\nTrailer-One: value\r\n')
+        self.assertRaises(
+            ValueError,
+            WSGIRequest.read_body,
+            reader
+        )
+
+    def test_chunk_without_crlf(self):
+        for body in (b'5\r\nhelloXX0\r\n\r\n', b'5\r\nhel'):
+            reader = BytesIO(body)
+            self.assertRaises(
+                ValueError,
+                WSGIRequest.read_body,
+                reader
+            )
+
 class TestRequestReader(unittest.TestCase):
+    parser = None
+
     def test_request_line_only(self):
         reader = BytesIO(b'GET /?a=1 HTTP/1.1\r\n')
-        request = WSGIRequest.from_reader(reader)
+        request = WSGIRequest.from_reader(reader, parser=self.parser)
 
         self.assertEqual(request.method, 'GET')
         self.assertEqual(request.path, '/')
@@ -139,7 +173,7 @@ class TestRequestReader(unittest.TestCase):
 
     def test_request_line_and_headers(self):
         reader = BytesIO(b'GET /?a=1 HTTP/1.1\r\nheader-one: value-one\r\nheader-two: value-two\r\n\r\n')
-        request = WSGIRequest.from_reader(reader)
+        request = WSGIRequest.from_reader(reader, parser=self.parser)
 
         self.assertEqual(request.method, 'GET')
         self.assertEqual(request.path, '/')
@@ -158,7 +192,7 @@ class TestRequestReader(unittest.TestCase):
 
     def test_request_line_and_headers_and_body(self):
         reader = BytesIO(b'GET /?a=1 HTTP/1.1\r\nheader-one: value-one\r\ncontent-length: 5\r\n\r\nHello')
-        request = WSGIRequest.from_reader(reader)
+        request = WSGIRequest.from_reader(reader, parser=self.parser)
 
         self.assertEqual(request.method, 'GET')
         self.assertEqual(request.path, '/')
@@ -180,7 +214,7 @@ class TestRequestReader(unittest.TestCase):
 
     def test_request_line_and_headers_and_body_chunked(self):
         reader = BytesIO(b'GET /?a=1 HTTP/1.1\r\nheader-one: value-one\r\ntransfer-encoding: chunked\r\n\r\n5\r\nHello\r\n0\r\n\r\n')
-        request = WSGIRequest.from_reader(reader)
+        request = WSGIRequest.from_reader(reader, parser=self.parser)
 
         self.assertEqual(request.method, 'GET')
         self.assertEqual(request.path, '/')
@@ -199,3 +233,201 @@ class TestRequestReader(unittest.TestCase):
             request.body,
             b'Hello'
         )
+
+class TestRequestLimits(unittest.TestCase):
+    def test_request_line_too_large(self):
+        reader = BytesIO(b'GET /' + b'a' * 100 + b' HTTP/1.1\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.read_request_line,
+            reader,
+            50
+        )
+
+    def test_headers_too_large(self):
+        reader = BytesIO(b'Header-One: value one\r\nHeader-Two: value two\r\n\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.read_headers,
+            reader,
+            30
+        )
+
+    def test_headers_within_size_limit(self):
+        reader = BytesIO(b'Header-One: value one\r\n\r\n')
+        self.assertDictEqual(
+            WSGIRequest.read_headers(reader, 30),
+            {'header-one': 'value one'}
+        )
+
+    def test_too_many_headers(self):
+        reader = BytesIO(b'A: 1\r\nB: 2\r\nC: 3\r\n\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.read_headers,
+            reader,
+            None,
+            2
+        )
+
+    def test_content_length_over_limit(self):
+        reader = BytesIO(b'123456789')
+        self.assertRaises(
+            RequestEntityTooLarge,
+            WSGIRequest.read_body,
+            reader,
+            9,
+            5
+        )
+
+    def test_chunked_body_over_limit(self):
+        reader = BytesIO(b'5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n')
+        self.assertRaises(
+            RequestEntityTooLarge,
+            WSGIRequest.read_body,
+            reader,
+            None,
+            8
+        )
+
+    def test_invalid_content_length(self):
+        for content_length in ('-1', '+5', ' 5', '1_0', '0x5', '\u0665'):
+            reader = BytesIO(b'x' * 2000)
+            self.assertRaises(
+                ValueError,
+                WSGIRequest.read_message_body,
+                reader,
+                {'content-length': content_length},
+                1000
+            )
+            # Nothing was read
+            self.assertEqual(reader.tell(), 0, content_length)
+
+    def test_invalid_chunk_size(self):
+        for chunk_size in (b'-1', b'+5', b'0x5', b'1_0'):
+            reader = BytesIO(chunk_size + b'\r\n' + b'x' * 2000)
+            self.assertRaises(
+                ValueError,
+                WSGIRequest.read_body,
+                reader,
+                None,
+                1000
+            )
+            self.assertEqual(reader.tell(), len(chunk_size) + 2, chunk_size)
+
+    def test_chunk_trailer_over_limit(self):
+        reader = BytesIO(b'0\r\n' + b'Trailer: value\r\n' * 10000 + b'\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.read_body,
+            reader
+        )
+
+class TestRequestExpectContinue(unittest.TestCase):
+    parser = None
+
+    def test_body_deferred_until_read(self):
+        reader = BytesIO(b'POST / HTTP/1.1\r\nexpect: 100-continue\r\ncontent-length: 5\r\n\r\nHello')
+        writer = BytesIO()
+        request = WSGIRequest.from_reader(reader, writer, parser=self.parser)
+
+        self.assertIsInstance(request.body, ContinueReader)
+        self.assertFalse(request.body.consumed)
+        self.assertEqual(writer.getvalue(), b'')
+
+        self.assertEqual(request.body.read(), b'Hello')
+        self.assertTrue(request.body.consumed)
+        self.assertEqual(writer.getvalue(), b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    def test_body_read_without_writer(self):
+        reader = BytesIO(b'POST / HTTP/1.1\r\nexpect: 100-continue\r\ncontent-length: 5\r\n\r\nHello')
+        request = WSGIRequest.from_reader(reader, parser=self.parser)
+
+        self.assertEqual(request.body, b'Hello')
+
+    def test_content_length_over_limit_rejected_early(self):
+        reader = BytesIO(b'POST / HTTP/1.1\r\nexpect: 100-continue\r\ncontent-length: 500\r\n\r\n')
+        writer = BytesIO()
+        self.assertRaises(
+            RequestEntityTooLarge,
+            WSGIRequest.from_reader,
+            reader,
+            writer,
+            max_body_size=100,
+            parser=self.parser,
+        )
+        self.assertEqual(writer.getvalue(), b'')
+
+    def test_unsupported_expectation(self):
+        reader = BytesIO(b'POST / HTTP/1.1\r\nexpect: something\r\n\r\n')
+        self.assertRaises(
+            ExpectationFailed,
+            WSGIRequest.from_reader,
+            reader,
+            parser=self.parser,
+        )
+
+    def test_http_1_0_expectation_ignored(self):
+        reader = BytesIO(b'POST / HTTP/1.0\r\nexpect: something\r\ncontent-length: 5\r\n\r\nHello')
+        request = WSGIRequest.from_reader(reader, BytesIO(), parser=self.parser)
+
+        self.assertEqual(request.body, b'Hello')
+
+class TestRequestReaderPythonParser(TestRequestReader):
+    parser = PythonParser()
+
+class TestRequestExpectContinuePythonParser(TestRequestExpectContinue):
+    parser = PythonParser()
+
+class HttptoolsParserMixin(object):
+    def setUp(self):
+        self.parser = HttptoolsParser()
+
+    def test_invalid_request_line(self):
+        reader = BytesIO(b'junk\r\n\r\n')
+        self.assertRaises(
+            ValueError,
+            WSGIRequest.from_reader,
+            reader,
+            parser=self.parser,
+        )
+
+    def test_too_many_headers(self):
+        reader = BytesIO(b'GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.from_reader,
+            reader,
+            max_header_count=2,
+            parser=self.parser,
+        )
+
+    def test_headers_too_large(self):
+        reader = BytesIO(b'GET / HTTP/1.1\r\nHeader: ' + b'a' * 100 + b'\r\n\r\n')
+        self.assertRaises(
+            RequestHeaderFieldsTooLarge,
+            WSGIRequest.from_reader,
+            reader,
+            max_header_size=50,
+            parser=self.parser,
+        )
+
+    def test_pipelined_requests(self):
+        reader = BufferedReader(BytesIO(b'GET /one HTTP/1.1\r\n\r\nGET /two HTTP/1.1\r\n\r\n'))
+        self.assertEqual(WSGIRequest.from_reader(reader, parser=self.parser).path, '/one')
+        self.assertEqual(WSGIRequest.from_reader(reader, parser=self.parser).path, '/two')
+
+@unittest.skipUnless(httptools, "httptools not installed")
+class TestRequestReaderHttptoolsParser(HttptoolsParserMixin, TestRequestReader):
+    pass
+
+@unittest.skipUnless(httptools, "httptools not installed")
+class TestRequestExpectContinueHttptoolsParser(HttptoolsParserMixin, TestRequestExpectContinue):
+    pass
+
+class TestGetParser(unittest.TestCase):
+    def test_auto_is_python_parser(self):
+        self.assertIsInstance(get_parser('auto'), PythonParser)
+
+    def test_unknown_parser(self):
+        self.assertRaises(ValueError, get_parser, 'unknown')
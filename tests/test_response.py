@@ -1,8 +1,13 @@
 import sys
+import tempfile
 import unittest
 from io import BytesIO
+from unittest.mock import patch
 
-from scotchwsgi.response import WSGIResponseWriter
+import gevent
+import gevent.socket
+
+from scotchwsgi.response import CachedHeaders, FileWrapper, SendTimeout, WSGIResponseWriter
 
 class TestResponseWriter(unittest.TestCase):
     def setUp(self):
@@ -191,3 +196,299 @@ class TestResponseWriter(unittest.TestCase):
                 [('Header', 'Value')],
                 exc_info=sys.exc_info(),
             )
+
+class TestResponseWriterBuffering(unittest.TestCase):
+    def setUp(self):
+        self.writer = BytesIO()
+
+    def _headers_end(self):
+        return self.writer.getvalue().index(b'\r\n\r\n') + 4
+
+    def test_unbuffered_writes_sent_as_separate_chunks(self):
+        response_writer = WSGIResponseWriter(self.writer)
+        response_writer.start_response('200 OK', [])
+        response_writer.write(b'ab')
+        response_writer.write(b'cd')
+        response_writer.finish()
+
+        self.assertEqual(
+            self.writer.getvalue()[self._headers_end():],
+            b'02\r\nab\r\n02\r\ncd\r\n0\r\n\r\n'
+        )
+
+    def test_small_writes_coalesced(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024)
+        response_writer.start_response('200 OK', [])
+        response_writer.write(b'ab')
+        response_writer.write(b'cd')
+
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'')
+
+        response_writer.finish()
+
+        self.assertEqual(
+            self.writer.getvalue()[self._headers_end():],
+            b'04\r\nabcd\r\n0\r\n\r\n'
+        )
+
+    def test_buffer_sent_when_full(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=4)
+        response_writer.start_response('200 OK', [])
+        response_writer.write(b'abc')
+        response_writer.write(b'def')
+        response_writer.write(b'g')
+
+        self.assertEqual(
+            self.writer.getvalue()[self._headers_end():],
+            b'06\r\nabcdef\r\n'
+        )
+
+    def test_flush_sends_buffer(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024)
+        response_writer.start_response('200 OK', [('Content-Length', '4')])
+        response_writer.write(b'ab')
+        response_writer.flush()
+
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'ab')
+
+    def test_buffer_sent_after_delay(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024, buffer_delay=1)
+        response_writer.start_response('200 OK', [('Content-Length', '4')])
+
+        with patch('scotchwsgi.response.time.monotonic', side_effect=[0, 0.2, 0.5, 1]):
+            response_writer.write(b'a')
+            response_writer.write(b'b')
+            self.assertEqual(self.writer.getvalue()[self._headers_end():], b'')
+            response_writer.write(b'c')
+
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'abc')
+
+    def test_buffer_sent_after_delay_without_more_writes(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024, buffer_delay=0.01)
+        response_writer.start_response('200 OK', [('Content-Length', '4')])
+        response_writer.write(b'ab')
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'')
+
+        # As if the application were waiting before writing more
+        gevent.sleep(0.05)
+
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'ab')
+
+    def test_cancel_flush(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024, buffer_delay=0.01)
+        response_writer.start_response('200 OK', [('Content-Length', '4')])
+        response_writer.write(b'ab')
+        response_writer.cancel_flush()
+        gevent.sleep(0.05)
+
+        self.assertEqual(self.writer.getvalue()[self._headers_end():], b'')
+
+    def test_streaming_content_type_not_buffered(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024)
+        response_writer.start_response('200 OK', [('Content-Type', 'text/event-stream; charset=utf-8')])
+        response_writer.write(b'data: 1\n\n')
+
+        self.assertEqual(
+            self.writer.getvalue()[self._headers_end():],
+            b'09\r\ndata: 1\n\n\r\n'
+        )
+
+class TestResponseWriterReuse(unittest.TestCase):
+    def test_reset_between_responses(self):
+        writer = BytesIO()
+        response_writer = WSGIResponseWriter(writer)
+        response_writer.start_response('200 OK', [('Content-Length', '1')])
+        response_writer.write(b'a')
+        response_writer.finish()
+
+        response_writer.reset([('Connection', 'close')])
+        self.assertEqual(response_writer.headers_to_send, [])
+        self.assertEqual(response_writer.headers_sent, [])
+
+        response_writer.start_response('404 Not Found', [('Content-Length', '1')])
+        response_writer.write(b'b')
+        response_writer.finish()
+
+        self.assertTrue(response_writer.wrote_connection_close)
+        self.assertEqual(
+            writer.getvalue(),
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\na'
+            b'HTTP/1.1 404 Not Found\r\nConnection: close\r\nContent-Length: 1\r\n\r\nb'
+        )
+
+class TestResponseFraming(unittest.TestCase):
+    def _send(self, http_version, server_headers, app_headers):
+        writer = BytesIO()
+        response_writer = WSGIResponseWriter(writer, server_headers, http_version=http_version)
+        response_writer.start_response('200 OK', app_headers)
+        response_writer.write(b'abc')
+        response_writer.finish()
+        return response_writer, writer.getvalue()
+
+    def test_chunked_for_http_1_1(self):
+        response_writer, response = self._send('HTTP/1.1', [], [])
+
+        self.assertFalse(response_writer.wrote_connection_close)
+        self.assertEqual(response, b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n03\r\nabc\r\n0\r\n\r\n')
+
+    def test_close_delimited_for_http_1_0(self):
+        response_writer, response = self._send('HTTP/1.0', [('Connection', 'keep-alive')], [])
+
+        self.assertTrue(response_writer.wrote_connection_close)
+        self.assertEqual(response, b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nabc')
+
+    def test_keep_alive_for_http_1_0_with_length(self):
+        response_writer, response = self._send(
+            'HTTP/1.0',
+            [('Connection', 'keep-alive')],
+            [('Content-Length', '3')],
+        )
+
+        self.assertFalse(response_writer.wrote_connection_close)
+        self.assertEqual(response, b'HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nContent-Length: 3\r\n\r\nabc')
+
+class SlowWriter(BytesIO):
+    """Blocks for ``delay`` seconds on each write, as with a slow reader"""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, data):
+        gevent.sleep(self.delay)
+        return super().write(data)
+
+class TestResponseWriterSendTimeout(unittest.TestCase):
+    def test_slow_write_times_out(self):
+        response_writer = WSGIResponseWriter(SlowWriter(1), send_timeout=0.01)
+        response_writer.start_response('200 OK', [('Content-Length', '3')])
+
+        with self.assertRaises(SendTimeout):
+            response_writer.write(b'abc')
+
+    def test_fast_writes_not_timed_out(self):
+        writer = SlowWriter(0.001)
+        response_writer = WSGIResponseWriter(writer, send_timeout=1)
+        response_writer.start_response('200 OK', [('Content-Length', '6')])
+        response_writer.write(b'abc')
+        response_writer.write(b'def')
+
+        self.assertTrue(writer.getvalue().endswith(b'\r\n\r\nabcdef'))
+
+    def test_delayed_flush_timeout_raised_by_next_write(self):
+        writer = SlowWriter(0)
+        response_writer = WSGIResponseWriter(writer, buffer_size=1024, buffer_delay=0.01, send_timeout=0.01)
+        response_writer.start_response('200 OK', [('Content-Length', '4')])
+        response_writer.write(b'ab')
+        # Too slow only while the timer flushes
+        writer.delay = 1
+        gevent.sleep(0.05)
+        writer.delay = 0
+
+        with self.assertRaises(SendTimeout):
+            response_writer.write(b'cd')
+
+    def test_response_send_timeout(self):
+        # Each write is quick enough, but not all of them together
+        response_writer = WSGIResponseWriter(SlowWriter(0.01), send_timeout=1, response_send_timeout=0.03)
+        response_writer.start_response('200 OK', [('Content-Length', '10')])
+
+        with self.assertRaises(SendTimeout):
+            for _ in range(10):
+                response_writer.write(b'a')
+
+    def test_response_send_timeout_reset_between_responses(self):
+        response_writer = WSGIResponseWriter(SlowWriter(0.01), response_send_timeout=0.05)
+        for _ in range(3):
+            response_writer.reset()
+            response_writer.start_response('200 OK', [('Content-Length', '1')])
+            response_writer.write(b'a')
+
+        self.assertLess(response_writer.send_time, 0.05)
+
+class TestFileWrapper(unittest.TestCase):
+    def test_iterates_in_blocks(self):
+        file_wrapper = FileWrapper(BytesIO(b"abcdefg"), block_size=3)
+
+        self.assertEqual(list(file_wrapper), [b"abc", b"def", b"g"])
+        self.assertIsNone(file_wrapper.get_file_range())
+
+    def test_file_range(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"abcdefg")
+            f.seek(2)
+            file_wrapper = FileWrapper(f)
+
+            self.assertEqual(file_wrapper.get_file_range(), (f.fileno(), 2, 5))
+
+            file_wrapper.close()
+            self.assertTrue(f.closed)
+
+    def test_send_file(self):
+        sock, client_sock = gevent.socket.socketpair()
+        body = b"x" * (4 * 1024 * 1024)
+        try:
+            with tempfile.TemporaryFile() as f:
+                f.write(body)
+                f.flush()
+
+                def send():
+                    response_writer = WSGIResponseWriter(sock.makefile('wb'))
+                    response_writer.start_response('200 OK', [('Content-Length', str(len(body) - 10))])
+                    response_writer.send_file(sock, f.fileno(), 10, len(body) - 10)
+                    response_writer.finish()
+                    sock.close()
+
+                sender = gevent.spawn(send)
+                response = client_sock.makefile('rb').read()
+                sender.get()
+
+            self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+            self.assertEqual(response.split(b'\r\n\r\n', 1)[1], body[10:])
+        finally:
+            sock.close()
+            client_sock.close()
+
+class TestCachedHeaders(unittest.TestCase):
+    def setUp(self):
+        self.cached_headers = CachedHeaders('test-server')
+        self.cached_headers.refresh(0)
+        self.writer = BytesIO()
+        self.response_writer = WSGIResponseWriter(self.writer, cached_headers=self.cached_headers)
+
+    def test_refresh(self):
+        self.assertEqual(self.cached_headers.date, b'Date: Thu, 01 Jan 1970 00:00:00 GMT\r\n')
+        self.cached_headers.refresh(86400)
+        self.assertEqual(self.cached_headers.date, b'Date: Fri, 02 Jan 1970 00:00:00 GMT\r\n')
+
+    def test_headers_sent(self):
+        self.response_writer.start_response('200 OK', [('Content-Length', '1')])
+        self.response_writer.write(b'a')
+
+        self.assertEqual(
+            self.writer.getvalue(),
+            b'HTTP/1.1 200 OK\r\n'
+            b'Date: Thu, 01 Jan 1970 00:00:00 GMT\r\n'
+            b'Server: test-server\r\n'
+            b'Content-Length: 1\r\n'
+            b'\r\n'
+            b'a'
+        )
+
+    def test_app_headers_not_overridden(self):
+        self.response_writer.start_response('200 OK', [
+            ('Content-Length', '1'),
+            ('Date', 'Sat, 03 Jan 1970 00:00:00 GMT'),
+            ('Server', 'app'),
+        ])
+        self.response_writer.write(b'a')
+
+        self.assertEqual(
+            self.writer.getvalue(),
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Length: 1\r\n'
+            b'Date: Sat, 03 Jan 1970 00:00:00 GMT\r\n'
+            b'Server: app\r\n'
+            b'\r\n'
+            b'a'
+        )
@@ -0,0 +1,117 @@
+import unittest
+from unittest.mock import patch
+
+from scotchwsgi.scoreboard import (
+    STATE_APP,
+    STATE_FREE,
+    STATE_IDLE,
+    STATE_READ,
+    STATE_WRITE,
+    Scoreboard,
+)
+
+class TestScoreboard(unittest.TestCase):
+    def setUp(self):
+        self.scoreboard = Scoreboard(2, connections_per_worker=4)
+        self.worker_scoreboard = self.scoreboard.worker(0)
+        self.worker_scoreboard.start(1234)
+
+    def test_connection_states(self):
+        slot = self.worker_scoreboard.acquire('127.0.0.1')
+        slot.start(STATE_READ)
+        slot.start_request('GET /slow HTTP/1.1')
+        slot.set_phase('app')
+
+        pid, requests, connections, _, _, connection_slots = self.scoreboard._read_worker(0)
+        self.assertEqual((pid, requests, connections), (1234, 1, 1))
+        self.assertEqual(len(connection_slots), 1)
+        state, _, client, request_line = connection_slots[0]
+        self.assertEqual(state, STATE_APP)
+        self.assertEqual(client, '127.0.0.1')
+        self.assertEqual(request_line, 'GET /slow HTTP/1.1')
+
+        slot.set_phase('write')
+        self.assertEqual(self.scoreboard._read_worker(0)[-1][0][0], STATE_WRITE)
+
+        # Phases with no state of their own leave the state alone
+        slot.set_phase(None)
+        self.assertEqual(self.scoreboard._read_worker(0)[-1][0][0], STATE_WRITE)
+
+    def test_release(self):
+        slot = self.worker_scoreboard.acquire('127.0.0.1')
+        slot.release()
+
+        self.assertEqual(self.scoreboard._read_worker(0)[-1], [])
+        self.assertEqual(len(self.worker_scoreboard.free_slots), 4)
+
+    def test_full(self):
+        slots = [self.worker_scoreboard.acquire('127.0.0.1') for _ in range(5)]
+
+        self.assertIsNone(slots[-1])
+        self.assertEqual(self.scoreboard._read_worker(0)[2], 5)
+
+    def test_replacement_worker_clears_slots(self):
+        slot = self.worker_scoreboard.acquire('127.0.0.1')
+        slot.start(STATE_READ)
+
+        self.scoreboard.worker(0).start(5678)
+
+        pid, requests, connections, _, _, connection_slots = self.scoreboard._read_worker(0)
+        self.assertEqual((pid, requests, connections, connection_slots), (5678, 0, 0, []))
+
+    def test_long_request_line_truncated(self):
+        slot = self.worker_scoreboard.acquire('127.0.0.1')
+        slot.set_request_line('GET /' + 'a' * 1000 + ' HTTP/1.1')
+
+        request_line = self.scoreboard._read_worker(0)[-1][0][3]
+        self.assertEqual(len(request_line), 256)
+        self.assertEqual(self.worker_scoreboard.memory[slot.offset], STATE_IDLE)
+
+    def test_busy_time(self):
+        self.worker_scoreboard.start_request()
+        self.worker_scoreboard.start_request()
+        busy_since = self.worker_scoreboard.busy_since
+        self.worker_scoreboard.finish_request()
+
+        # Still busy with the other request
+        self.assertEqual(self.scoreboard.get_busy_time(0, busy_since + 2), (1234, 2))
+
+        with patch('scotchwsgi.scoreboard.time.time', return_value=busy_since + 3):
+            self.worker_scoreboard.finish_request()
+
+        self.assertEqual(self.scoreboard.get_busy_time(0, busy_since + 10), (1234, 3))
+
+    def test_stream_not_busy(self):
+        slot = self.worker_scoreboard.acquire('127.0.0.1')
+        slot.start_request('GET /events HTTP/1.1')
+        slot.set_phase('stream')
+
+        self.assertEqual(self.worker_scoreboard.active_requests, 0)
+        slot.release()
+        self.assertEqual(self.worker_scoreboard.active_requests, 0)
+
+    def test_clear(self):
+        self.worker_scoreboard.acquire('127.0.0.1')
+        self.scoreboard.clear(0)
+
+        self.assertEqual(self.scoreboard._read_worker(0), (0, 0, 0, 0, 0, []))
+
+    def test_render(self):
+        idle_slot = self.worker_scoreboard.acquire('10.0.0.1')
+        busy_slot = self.worker_scoreboard.acquire('10.0.0.2')
+        busy_slot.start(STATE_READ)
+        busy_slot.set_request_line('GET /slow HTTP/1.1')
+        busy_slot.set_phase('app')
+
+        lines = self.scoreboard.render().splitlines()
+
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("Worker 0 (PID 1234): up 0s, 0 requests, 2 connections, "))
+        self.assertIn("keepalive=1", lines[0])
+        self.assertIn("app=1", lines[0])
+        # Idle connections aren't listed
+        self.assertIn("app", lines[1])
+        self.assertIn("10.0.0.2", lines[1])
+        self.assertIn("GET /slow HTTP/1.1", lines[1])
+        self.assertEqual(lines[2], "Worker 1: not running")
+        self.assertNotIn(STATE_FREE, [slot[0] for slot in self.scoreboard._read_worker(0)[-1]])
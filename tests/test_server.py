@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import Mock, patch
 
 from scotchwsgi.server import make_server
+from scotchwsgi.worker import CONTROL_DRAIN
 
 TEST_HOST = "localhost"
 TEST_PORT = 0
@@ -19,11 +20,11 @@ class BaseServerTestCase(unittest.TestCase):
 
         self.mock_socket_instance = Mock(getsockname=lambda: (TEST_HOST, TEST_PORT))
         self.mock_socket = patch(
-            'scotchwsgi.server.socket.socket',
+            'scotchwsgi.listeners.socket.socket',
             return_value=self.mock_socket_instance,
         )
 
-        self.mock_process.start()
+        self.mock_process_class = self.mock_process.start()
         self.mock_socket.start()
 
         self.mock_app = Mock()
@@ -74,3 +75,133 @@ class TestServerSocketCreation(BaseServerTestCase):
         self.mock_socket_instance.listen.assert_called_with(100)
 
         server.stop()
+
+    def test_server_name_per_bind(self):
+        server = make_server(
+            TEST_HOST,
+            TEST_PORT,
+            self.mock_app,
+            num_workers=NUM_WORKERS,
+            binds=[('127.0.0.1', 8000), ('api.example.com', 8001)],
+        )
+        server.start(blocking=False)
+
+        for call in self.mock_process_class.call_args_list:
+            self.assertEqual(call.kwargs['kwargs']['server_names'], ['127.0.0.1', 'api.example.com'])
+
+        server.stop()
+
+class TestServerWorkerReplacement(BaseServerTestCase):
+    def test_dead_workers_replaced(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, num_workers=NUM_WORKERS)
+        server.start(blocking=False)
+        worker_processes = server.worker_processes.copy()
+        worker_processes[3].is_alive.return_value = False
+        worker_processes[3].exitcode = 0
+
+        server.replace_dead_workers()
+
+        self.assertEqual(len(server.worker_processes), NUM_WORKERS)
+        for index, worker_process in enumerate(server.worker_processes):
+            if index == 3:
+                self.assertIsNot(worker_process, worker_processes[3])
+                worker_process.start.assert_called_once()
+            else:
+                self.assertIs(worker_process, worker_processes[index])
+
+        server.stop()
+
+class TestServerControlPipes(BaseServerTestCase):
+    def test_worker_given_control_pipe(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, num_workers=NUM_WORKERS)
+        server.start(blocking=False)
+
+        self.assertEqual(len(server.control_pipes), NUM_WORKERS)
+        for call in self.mock_process_class.call_args_list:
+            self.assertIn('control_pipe', call.kwargs['kwargs'])
+
+        # Each worker closes the write ends of every pipe created so far
+        last_inherited_fds = self.mock_process_class.call_args_list[-1].kwargs['kwargs']['inherited_fds']
+        self.assertEqual(
+            last_inherited_fds,
+            [control_pipe.fileno() for control_pipe in server.control_pipes],
+        )
+
+        server.stop()
+
+    def test_reload_sends_drain(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, num_workers=NUM_WORKERS)
+        server.start(blocking=False)
+        server.control_pipes = [Mock() for _ in range(NUM_WORKERS)]
+
+        server.handle_reload(0, 0)
+
+        for control_pipe in server.control_pipes:
+            control_pipe.send.assert_called_once_with(CONTROL_DRAIN)
+
+class TestServerAutoscaling(BaseServerTestCase):
+    def test_started_with_min_workers(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, min_workers=2, max_workers=5)
+        server.start(blocking=False)
+
+        self.assertEqual(len(server.worker_processes), 2)
+        self.assertEqual(server.scoreboard.num_workers, 5)
+
+        server.stop()
+
+    def test_scale_up(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, min_workers=2, max_workers=5)
+        server.start(blocking=False)
+
+        with patch.object(server.autoscaler, 'get_target', return_value=4):
+            server.autoscale()
+
+        self.assertEqual(len(server.worker_processes), 4)
+        self.assertEqual(len(server.control_pipes), 4)
+        worker_indexes = [
+            call.kwargs['kwargs']['worker_index']
+            for call in self.mock_process_class.call_args_list
+        ]
+        self.assertEqual(worker_indexes, [0, 1, 2, 3])
+
+        server.stop()
+
+    def test_scale_down(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, min_workers=1, max_workers=5, num_workers=3)
+        server.start(blocking=False)
+        server.control_pipes = [Mock() for _ in range(3)]
+        retiring_process = server.worker_processes[2]
+        retiring_pipe = server.control_pipes[2]
+
+        with patch.object(server.autoscaler, 'get_target', return_value=2):
+            server.autoscale()
+
+        self.assertEqual(len(server.worker_processes), 2)
+        retiring_pipe.send.assert_called_once_with(CONTROL_DRAIN)
+        retiring_process.terminate.assert_not_called()
+
+        # No further scaling until the retiring worker has exited
+        with patch.object(server.autoscaler, 'get_target') as mock_get_target:
+            server.autoscale()
+        mock_get_target.assert_not_called()
+
+        retiring_process.is_alive.return_value = False
+        server.remove_retired_workers()
+
+        self.assertEqual(server.retiring_workers, [])
+        retiring_pipe.close.assert_called_once()
+
+        server.stop()
+
+class TestServerCpuAffinity(BaseServerTestCase):
+    def test_workers_pinned_in_turn(self):
+        server = make_server(TEST_HOST, TEST_PORT, self.mock_app, num_workers=3, cpu_affinity=['0', '1-2'])
+        server.start(blocking=False)
+
+        cpu_sets = [
+            call.kwargs['kwargs']['cpu_affinity']
+            for call in self.mock_process_class.call_args_list
+        ]
+        self.assertEqual(cpu_sets, [{0}, {1, 2}, {0}])
+
+        server.stop()
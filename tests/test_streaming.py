@@ -0,0 +1,67 @@
+import unittest
+from io import BytesIO
+
+import gevent
+
+from scotchwsgi.response import WSGIResponseWriter
+from scotchwsgi.streaming import SSE_HEARTBEAT, stream_response
+
+class TestStreamResponse(unittest.TestCase):
+    def setUp(self):
+        self.writer = BytesIO()
+
+    def _body(self):
+        out = self.writer.getvalue()
+        return out[out.index(b'\r\n\r\n') + 4:]
+
+    def test_items_written(self):
+        response_writer = WSGIResponseWriter(self.writer, buffer_size=1024)
+        response_writer.start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        stream_response(iter([b'data: 1\n\n', b'data: 2\n\n']), response_writer)
+
+        self.assertEqual(
+            self._body(),
+            b'09\r\ndata: 1\n\n\r\n09\r\ndata: 2\n\n\r\n'
+        )
+
+    def test_heartbeat_sent_when_idle(self):
+        def slow_iter():
+            gevent.sleep(0.05)
+            yield b'data: 1\n\n'
+
+        response_writer = WSGIResponseWriter(self.writer)
+        response_writer.start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        stream_response(slow_iter(), response_writer, heartbeat_interval=0.01)
+
+        self.assertTrue(self._body().startswith(b'%0.2X\r\n%s\r\n' % (len(SSE_HEARTBEAT), SSE_HEARTBEAT)))
+        self.assertTrue(self._body().endswith(b'09\r\ndata: 1\n\n\r\n'))
+
+    def test_no_heartbeat_for_other_content_types(self):
+        def slow_iter():
+            gevent.sleep(0.05)
+            yield b'done'
+
+        response_writer = WSGIResponseWriter(self.writer)
+        response_writer.start_response('200 OK', [('Content-Type', 'application/json')])
+        response_writer.start_streaming()
+
+        stream_response(slow_iter(), response_writer, heartbeat_interval=0.01)
+
+        self.assertEqual(self._body(), b'04\r\ndone\r\n')
+
+    def test_iterator_exception_raised(self):
+        def failing_iter():
+            yield b'data: 1\n\n'
+            raise Exception("Iterator exception")
+
+        response_writer = WSGIResponseWriter(self.writer)
+        response_writer.start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        self.assertRaises(
+            Exception,
+            stream_response,
+            failing_iter(),
+            response_writer,
+        )
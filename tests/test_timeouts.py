@@ -0,0 +1,90 @@
+import io
+import socket
+import unittest
+from unittest.mock import Mock, patch
+
+from scotchwsgi.timeouts import PHASE_BODY, PHASE_HEADERS, DeadlineReader, ReadDeadline, RequestTimeout
+
+class TestReadDeadline(unittest.TestCase):
+    @patch('scotchwsgi.timeouts.time.monotonic')
+    def test_starts_on_first_read(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        deadline = ReadDeadline(PHASE_HEADERS, 5)
+
+        mock_monotonic.return_value = 110
+        self.assertEqual(deadline.remaining(), 5)
+        mock_monotonic.return_value = 112
+        self.assertEqual(deadline.remaining(), 3)
+
+    @patch('scotchwsgi.timeouts.time.monotonic')
+    def test_extended_by_min_rate(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        deadline = ReadDeadline(PHASE_HEADERS, 5, max_timeout=10, min_rate=100)
+        deadline.remaining()
+
+        deadline.add_received(200)
+        self.assertEqual(deadline.remaining(), 7)
+        self.assertEqual(deadline.received, 200)
+
+        # Never past the max timeout
+        deadline.add_received(1000)
+        self.assertEqual(deadline.remaining(), 10)
+
+    @patch('scotchwsgi.timeouts.time.monotonic')
+    def test_fixed_without_min_rate(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        deadline = ReadDeadline(PHASE_BODY, 5)
+        deadline.remaining()
+
+        deadline.add_received(1000)
+        self.assertEqual(deadline.remaining(), 5)
+
+class TestDeadlineReader(unittest.TestCase):
+    def test_no_deadline(self):
+        conn = Mock()
+        reader = io.BufferedReader(DeadlineReader(io.BytesIO(b"abc"), conn))
+
+        self.assertEqual(reader.read(), b"abc")
+        conn.settimeout.assert_not_called()
+
+    def test_read_within_deadline(self):
+        conn = Mock()
+        deadline_reader = DeadlineReader(io.BytesIO(b"abc"), conn)
+        deadline_reader.deadline = ReadDeadline(PHASE_HEADERS, 5)
+        reader = io.BufferedReader(deadline_reader)
+
+        self.assertEqual(reader.read(3), b"abc")
+        self.assertEqual(deadline_reader.deadline.received, 3)
+        # The socket is left blocking between reads
+        conn.settimeout.assert_called_with(None)
+
+    def test_timeout(self):
+        a, b = socket.socketpair()
+        try:
+            deadline_reader = DeadlineReader(a.makefile('rb', buffering=0), a)
+            deadline_reader.deadline = ReadDeadline(PHASE_HEADERS, 0.05)
+            reader = io.BufferedReader(deadline_reader)
+
+            b.sendall(b"GET")
+            self.assertEqual(reader.read1(3), b"GET")
+            with self.assertRaises(RequestTimeout) as cm:
+                reader.read1(1)
+
+            self.assertEqual(cm.exception.phase, PHASE_HEADERS)
+            self.assertEqual(cm.exception.received, 3)
+        finally:
+            a.close()
+            b.close()
+
+    @patch('scotchwsgi.timeouts.time.monotonic')
+    def test_expired(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        conn = Mock()
+        deadline_reader = DeadlineReader(io.BytesIO(b"abc"), conn)
+        deadline_reader.deadline = ReadDeadline(PHASE_BODY, 5)
+        deadline_reader.deadline.remaining()
+
+        mock_monotonic.return_value = 106
+        with self.assertRaises(RequestTimeout):
+            deadline_reader.read(1)
+        conn.settimeout.assert_not_called()
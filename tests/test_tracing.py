@@ -0,0 +1,215 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from scotchwsgi.tracing import (
+    FileExporter,
+    RequestTrace,
+    SpanExporter,
+    UdpExporter,
+    generate_id,
+    get_span_exporter,
+    parse_traceparent,
+)
+
+TRACE_ID = '0af7651916cd43dd8448eb211c80319c'
+PARENT_ID = 'b7ad6b7169203331'
+
+class TestParseTraceparent(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(
+            parse_traceparent('00-%s-%s-01' % (TRACE_ID, PARENT_ID)),
+            (TRACE_ID, PARENT_ID, '01'),
+        )
+
+    def test_later_version(self):
+        self.assertEqual(
+            parse_traceparent('01-%s-%s-00-extra' % (TRACE_ID, PARENT_ID)),
+            (TRACE_ID, PARENT_ID, '00'),
+        )
+
+    def test_invalid(self):
+        for traceparent in (
+            '',
+            'junk',
+            '00-%s-%s-01-extra' % (TRACE_ID, PARENT_ID),
+            'ff-%s-%s-01' % (TRACE_ID, PARENT_ID),
+            '00-%s-%s-01' % ('0' * 32, PARENT_ID),
+            '00-%s-%s-01' % (TRACE_ID, '0' * 16),
+            '00-%s-%s-01' % (TRACE_ID.upper(), PARENT_ID),
+            '00-%s-%s-1' % (TRACE_ID, PARENT_ID),
+        ):
+            self.assertIsNone(parse_traceparent(traceparent), traceparent)
+
+class TestRequestTrace(unittest.TestCase):
+    def test_continues_trace(self):
+        trace = RequestTrace(100)
+        trace.set_context({
+            'traceparent': '00-%s-%s-01' % (TRACE_ID, PARENT_ID),
+            'tracestate': 'congo=t61rcWkgMzE',
+        })
+
+        self.assertEqual(trace.trace_id, TRACE_ID)
+        self.assertEqual(trace.parent_id, PARENT_ID)
+        self.assertNotEqual(trace.span_id, PARENT_ID)
+        self.assertTrue(trace.sampled)
+
+        environ = trace.get_environ()
+        self.assertEqual(environ['scotchwsgi.trace_id'], TRACE_ID)
+        self.assertEqual(environ['scotchwsgi.traceparent'], '00-%s-%s-01' % (TRACE_ID, trace.span_id))
+        self.assertEqual(environ['scotchwsgi.tracestate'], 'congo=t61rcWkgMzE')
+        self.assertEqual(len(environ['scotchwsgi.request_id']), 32)
+
+    def test_starts_trace(self):
+        trace = RequestTrace(100)
+        trace.set_context({'traceparent': 'junk', 'tracestate': 'ignored'})
+
+        self.assertEqual(len(trace.trace_id), 32)
+        self.assertEqual(len(trace.span_id), 16)
+        self.assertIsNone(trace.parent_id)
+        self.assertIsNone(trace.tracestate)
+        self.assertTrue(trace.sampled)
+
+    def test_not_sampled(self):
+        trace = RequestTrace(100)
+        trace.set_context({'traceparent': '00-%s-%s-00' % (TRACE_ID, PARENT_ID)})
+
+        self.assertFalse(trace.sampled)
+
+    def test_spans(self):
+        trace = RequestTrace(101, connected_at=100)
+        trace.set_context({})
+        trace.headers_read_at = 102
+        trace.body_read_at = 103
+        trace.app_started_at = 104
+        trace.app_returned_at = 105
+        trace.first_byte_at = 106
+        trace.last_byte_at = 107
+
+        spans = trace.get_spans({'status': 200})
+
+        request_span = spans[0]
+        self.assertEqual(request_span['name'], 'request')
+        self.assertEqual((request_span['start'], request_span['end']), (100, 107))
+        self.assertEqual(request_span['attributes'], {'request_id': trace.request_id, 'status': 200})
+        self.assertEqual(
+            [(span['name'], span['start'], span['end']) for span in spans[1:]],
+            [
+                ('accept', 100, 101),
+                ('headers', 101, 102),
+                ('body', 102, 103),
+                ('app', 104, 105),
+                ('first_byte', 104, 106),
+                ('last_byte', 106, 107),
+            ],
+        )
+        for span in spans[1:]:
+            self.assertEqual(span['trace_id'], trace.trace_id)
+            self.assertEqual(span['parent_id'], trace.span_id)
+
+    def test_spans_of_keepalive_request(self):
+        trace = RequestTrace(101)
+        trace.set_context({})
+        trace.last_byte_at = 102
+
+        spans = trace.get_spans()
+
+        self.assertEqual([span['name'] for span in spans], ['request'])
+        self.assertEqual(spans[0]['start'], 101)
+
+class NullExporter(SpanExporter):
+    def send(self, lines):
+        pass
+
+class TestSpanExporter(unittest.TestCase):
+    def _trace(self):
+        trace = RequestTrace(100)
+        trace.set_context({})
+        trace.last_byte_at = 101
+        return trace
+
+    def test_batches(self):
+        exporter = NullExporter(batch_size=2)
+        exporter.send = Mock()
+
+        exporter.export(self._trace())
+        exporter.send.assert_not_called()
+        exporter.export(self._trace())
+        exporter.send.assert_called_once()
+
+        lines = exporter.send.call_args[0][0]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])['name'], 'request')
+        self.assertEqual(exporter.batch, [])
+        self.assertEqual(exporter.exported, 2)
+
+    def test_send_required(self):
+        with self.assertRaises(TypeError):
+            SpanExporter()
+
+    def test_send_failure_dropped(self):
+        exporter = NullExporter()
+        exporter.send = Mock(side_effect=OSError("unreachable"))
+
+        exporter.export(self._trace())
+        exporter.flush()
+
+        self.assertEqual(exporter.batch, [])
+        self.assertEqual(exporter.exported, 0)
+
+    def test_file_exporter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spans.jsonl')
+            exporter = FileExporter(path)
+            trace = self._trace()
+            exporter.export(trace, {'path': '/'})
+            exporter.close()
+
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]['trace_id'], trace.trace_id)
+        self.assertEqual(spans[0]['attributes']['path'], '/')
+
+    def test_udp_exporter(self):
+        collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        collector.bind(('127.0.0.1', 0))
+        collector.settimeout(1)
+        try:
+            exporter = UdpExporter(*collector.getsockname())
+            # Enough spans for more than one datagram
+            for _ in range(20):
+                exporter.export(self._trace())
+            exporter.close()
+
+            lines = []
+            while len(lines) < 20:
+                datagram = collector.recv(65536)
+                self.assertLessEqual(len(datagram), 1472)
+                lines.extend(datagram.splitlines())
+        finally:
+            collector.close()
+
+        self.assertEqual(len(lines), 20)
+
+    def test_get_span_exporter(self):
+        exporter = get_span_exporter('file:/tmp/spans.jsonl')
+        self.assertIsInstance(exporter, FileExporter)
+        self.assertEqual(exporter.path, '/tmp/spans.jsonl')
+
+        exporter = get_span_exporter('udp:localhost:4000')
+        self.assertIsInstance(exporter, UdpExporter)
+        self.assertEqual(exporter.address, ('localhost', 4000))
+
+        for spec in ('file:', 'udp:localhost', 'http://localhost'):
+            with self.assertRaises(ValueError):
+                get_span_exporter(spec)
+
+class TestGenerateId(unittest.TestCase):
+    def test_length(self):
+        self.assertEqual(len(generate_id(128)), 32)
+        self.assertEqual(len(generate_id(64)), 16)
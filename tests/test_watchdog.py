@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import gevent.events
+
+from scotchwsgi.watchdog import EventLoopWatchdog, RequestTimer, log_slow_request
+
+class TestRequestTimer(unittest.TestCase):
+    def test_phases_accumulated(self):
+        with patch('scotchwsgi.watchdog.time.monotonic', side_effect=[0, 1, 3, 4, 7]):
+            timer = RequestTimer('read')
+            timer.phase('app')
+            timer.phase('write')
+            timer.phase('app')
+            total = timer.stop()
+
+        self.assertEqual(total, 7)
+        self.assertEqual(timer.durations['read'], 1)
+        self.assertEqual(timer.durations['app'], 5)
+        self.assertEqual(timer.durations['write'], 1)
+
+class TestSlowRequestLog(unittest.TestCase):
+    def test_slow_request_logged(self):
+        with patch('scotchwsgi.watchdog.time.monotonic', side_effect=[0, 1, 5]):
+            timer = RequestTimer('read')
+            timer.phase('app')
+
+            with self.assertLogs('scotchwsgi.slow') as logs:
+                log_slow_request('GET / HTTP/1.1', timer, 2)
+
+        self.assertIn('GET / HTTP/1.1', logs.output[0])
+        self.assertIn('read=1.000s', logs.output[0])
+        self.assertIn('app=4.000s', logs.output[0])
+
+    def test_fast_request_not_logged(self):
+        with patch('scotchwsgi.watchdog.time.monotonic', side_effect=[0, 1]):
+            timer = RequestTimer('read')
+
+            with patch('scotchwsgi.watchdog.slow_request_logger') as mock_logger:
+                log_slow_request('GET / HTTP/1.1', timer, 2)
+
+        mock_logger.warning.assert_not_called()
+
+class TestEventLoopWatchdog(unittest.TestCase):
+    def test_blocked_greenlet_request_logged(self):
+        greenlet = Mock()
+        watchdog = EventLoopWatchdog(0.1, {greenlet: 'GET /blocking HTTP/1.1'})
+        event = gevent.events.EventLoopBlocked(greenlet, 0.1, ['File "app.py", line 1'])
+
+        with self.assertLogs('scotchwsgi.watchdog') as logs:
+            watchdog.handle_event(event)
+
+        self.assertIn('GET /blocking HTTP/1.1', logs.output[0])
+        self.assertIn('File "app.py", line 1', logs.output[0])
+
+    def test_other_events_ignored(self):
+        watchdog = EventLoopWatchdog(0.1, {})
+
+        with patch('scotchwsgi.watchdog.logger') as mock_logger:
+            watchdog.handle_event(Mock())
+
+        mock_logger.warning.assert_not_called()
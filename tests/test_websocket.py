@@ -0,0 +1,162 @@
+import os
+import struct
+import unittest
+from io import BytesIO
+from unittest.mock import Mock
+
+import gevent
+
+from scotchwsgi.response import SendTimeout
+from scotchwsgi.timeouts import PHASE_BODY, RequestTimeout
+from scotchwsgi.websocket import (
+    OPCODE_BINARY,
+    OPCODE_CLOSE,
+    OPCODE_CONTINUATION,
+    OPCODE_PING,
+    OPCODE_PONG,
+    OPCODE_TEXT,
+    WebSocket,
+    accept_websocket,
+    encode_frame,
+    is_websocket_request,
+    mask,
+)
+
+def client_frame(opcode, payload, fin=True):
+    masking_key = os.urandom(4)
+    frame = encode_frame(opcode, mask(payload, masking_key), fin)
+    # Set the mask bit and insert the masking key after the length
+    header_length = len(frame) - len(payload)
+    return (
+        frame[:1] + bytes([frame[1] | 0x80]) + frame[2:header_length] +
+        masking_key + frame[header_length:]
+    )
+
+def websocket_request(**headers):
+    request_headers = {
+        'upgrade': 'websocket',
+        'connection': 'keep-alive, Upgrade',
+        'sec-websocket-version': '13',
+        'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ==',
+    }
+    request_headers.update(headers)
+    return Mock(method='GET', http_version='HTTP/1.1', headers=request_headers)
+
+class TestWebSocketHandshake(unittest.TestCase):
+    def test_is_websocket_request(self):
+        self.assertTrue(is_websocket_request(websocket_request()))
+
+    def test_is_not_websocket_request(self):
+        self.assertFalse(is_websocket_request(websocket_request(upgrade='h2c')))
+
+    def test_accept(self):
+        writer = BytesIO()
+        accept_websocket(websocket_request(), writer)
+
+        # Example from RFC 6455 section 1.3
+        self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n', writer.getvalue())
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 101 Switching Protocols\r\n'))
+
+    def test_unsupported_version(self):
+        self.assertRaises(
+            ValueError,
+            accept_websocket,
+            websocket_request(**{'sec-websocket-version': '8'}),
+            BytesIO(),
+        )
+
+    def test_invalid_key(self):
+        self.assertRaises(
+            ValueError,
+            accept_websocket,
+            websocket_request(**{'sec-websocket-key': 'not base64!'}),
+            BytesIO(),
+        )
+
+class TestWebSocketFraming(unittest.TestCase):
+    def test_mask_round_trip(self):
+        payload = os.urandom(1001)
+        masking_key = os.urandom(4)
+        self.assertNotEqual(mask(payload, masking_key), payload)
+        self.assertEqual(mask(mask(payload, masking_key), masking_key), payload)
+
+    def test_mask_matches_bytewise(self):
+        payload = b'Hello, websocket!'
+        masking_key = b'\x01\x02\x03\x04'
+        self.assertEqual(
+            mask(payload, masking_key),
+            bytes(b ^ masking_key[i % 4] for i, b in enumerate(payload))
+        )
+
+    def test_encode_frame_lengths(self):
+        self.assertEqual(encode_frame(OPCODE_TEXT, b'a' * 125)[:2], b'\x81\x7d')
+        self.assertEqual(encode_frame(OPCODE_TEXT, b'a' * 126)[:4], b'\x81\x7e\x00\x7e')
+        self.assertEqual(encode_frame(OPCODE_BINARY, b'a' * 65536)[:10], b'\x82\x7f' + struct.pack('!Q', 65536))
+
+class TestWebSocketMessages(unittest.TestCase):
+    def _websocket(self, *frames, **kwargs):
+        self.writer = BytesIO()
+        return WebSocket(BytesIO(b''.join(frames)), self.writer, **kwargs)
+
+    def test_receive_text(self):
+        websocket = self._websocket(client_frame(OPCODE_TEXT, 'héllo'.encode('utf-8')))
+        self.assertEqual(websocket.receive(), 'héllo')
+
+    def test_receive_binary(self):
+        websocket = self._websocket(client_frame(OPCODE_BINARY, b'\x00\x01'))
+        self.assertEqual(websocket.receive(), b'\x00\x01')
+
+    def test_receive_fragmented(self):
+        websocket = self._websocket(
+            client_frame(OPCODE_TEXT, b'hel', fin=False),
+            client_frame(OPCODE_PING, b'ping'),
+            client_frame(OPCODE_CONTINUATION, b'lo'),
+        )
+        self.assertEqual(websocket.receive(), 'hello')
+        self.assertEqual(self.writer.getvalue(), encode_frame(OPCODE_PONG, b'ping'))
+
+    def test_receive_close(self):
+        websocket = self._websocket(client_frame(OPCODE_CLOSE, struct.pack('!H', 1000)))
+        self.assertIsNone(websocket.receive())
+        self.assertTrue(websocket.closed)
+        self.assertEqual(self.writer.getvalue(), encode_frame(OPCODE_CLOSE, struct.pack('!H', 1000)))
+
+    def test_receive_unmasked_frame(self):
+        websocket = self._websocket(encode_frame(OPCODE_TEXT, b'hello'))
+        self.assertIsNone(websocket.receive())
+        self.assertEqual(self.writer.getvalue(), encode_frame(OPCODE_CLOSE, struct.pack('!H', 1002)))
+
+    def test_receive_too_large(self):
+        websocket = self._websocket(client_frame(OPCODE_BINARY, b'a' * 100), max_message_size=10)
+        self.assertIsNone(websocket.receive())
+        self.assertEqual(self.writer.getvalue(), encode_frame(OPCODE_CLOSE, struct.pack('!H', 1009)))
+
+    def test_receive_eof(self):
+        websocket = self._websocket()
+        self.assertIsNone(websocket.receive())
+        self.assertTrue(websocket.closed)
+
+    def test_receive_timeout(self):
+        reader = Mock(read=Mock(side_effect=RequestTimeout(PHASE_BODY, 0)))
+        websocket = WebSocket(reader, BytesIO())
+        self.assertIsNone(websocket.receive())
+        self.assertTrue(websocket.closed)
+
+    def test_send_timeout(self):
+        class SlowWriter(BytesIO):
+            def write(self, data):
+                gevent.sleep(1)
+
+        websocket = WebSocket(BytesIO(), SlowWriter(), send_timeout=0.01)
+        with self.assertRaises(SendTimeout):
+            websocket.send('hi')
+        self.assertTrue(websocket.closed)
+
+    def test_send(self):
+        websocket = self._websocket()
+        websocket.send('hi')
+        websocket.send(b'\x00')
+        self.assertEqual(
+            self.writer.getvalue(),
+            encode_frame(OPCODE_TEXT, b'hi') + encode_frame(OPCODE_BINARY, b'\x00')
+        )
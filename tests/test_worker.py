@@ -1,16 +1,28 @@
+import json
+import multiprocessing
 import os
+import socket
+import ssl
+import tempfile
 import unittest
-from io import BytesIO
-from unittest.mock import MagicMock, Mock, patch
+from io import BufferedReader, BytesIO
+from unittest.mock import ANY, MagicMock, Mock, patch
+
+import gevent
+import gevent.event
 
 from scotchwsgi.request import WSGIRequest
-from scotchwsgi.worker import WSGIWorker
+from scotchwsgi.response import FileWrapper
+from scotchwsgi.scoreboard import STATE_IDLE, Scoreboard
+from scotchwsgi.streaming import ClientDisconnected
+from scotchwsgi.websocket import OPCODE_CLOSE, OPCODE_TEXT, encode_frame
+from scotchwsgi.worker import CONTROL_DRAIN, ENVIRON_KEYS, WSGIWorker, get_rss
 
 TEST_HOST = 'localhost'
 TEST_PORT = 0
 REQUEST_TIMEOUT = 10
 
-def stub_worker(app=None):
+def stub_worker(app=None, **kwargs):
     if app is None:
         app = Mock()
 
@@ -18,7 +30,7 @@ def stub_worker(app=None):
 
     mock_import_module = patch('scotchwsgi.worker.importlib.import_module', Mock(return_value=Mock(app=app)))
     mock_import_module.start()
-    worker = WSGIWorker('.', mock_sock, TEST_HOST, os.getpid(), REQUEST_TIMEOUT)
+    worker = WSGIWorker('.', mock_sock, TEST_HOST, os.getpid(), REQUEST_TIMEOUT, **kwargs)
     mock_import_module.stop()
 
     return worker
@@ -68,13 +80,55 @@ class TestWorkerEnviron(unittest.TestCase):
         self.assertTrue(environ['wsgi.multiprocess'])
         self.assertFalse(environ['wsgi.run_once'])
 
+    def test_environ_server_name_of_listener(self):
+        worker = stub_worker(server_names=['api.example.com'])
+        environ = worker._get_environ(WSGIRequest('GET', '/', '', 'HTTP/1.1', {}, b''))
+
+        self.assertEqual(environ['SERVER_NAME'], 'api.example.com')
+
+    def test_environ_unix_socket(self):
+        request = WSGIRequest('GET', '/', '', 'HTTP/1.1', {'host': 'example.com:8000'}, b'')
+        environ = self.worker._get_environ(request, ('localhost', ''))
+
+        self.assertEqual(environ['SERVER_NAME'], 'example.com')
+        self.assertEqual(environ['SERVER_PORT'], '8000')
+
+    def test_environ_unix_socket_without_port(self):
+        request = WSGIRequest('GET', '/', '', 'HTTP/1.1', {'host': 'example.com'}, b'')
+        environ = self.worker._get_environ(request, ('localhost', ''))
+
+        self.assertEqual(environ['SERVER_NAME'], 'example.com')
+        self.assertEqual(environ['SERVER_PORT'], '80')
+
+    def test_environ_is_dict(self):
+        # PEP 3333: "a builtin Python dictionary (not a subclass...)"
+        environ = self.worker._get_environ(WSGIRequest('GET', '/', None, 'HTTP/1.1', {}, b''))
+
+        self.assertIs(type(environ), dict)
+        self.assertEqual(environ['QUERY_STRING'], '')
+
+    def test_environ_keys_remembered(self):
+        request = WSGIRequest('GET', '/', '', 'HTTP/1.1', {'x-remembered-header': 'a'}, b'')
+        self.worker._get_environ(request)
+
+        self.assertEqual(ENVIRON_KEYS['x-remembered-header'], 'HTTP_X_REMEMBERED_HEADER')
+
+    def test_environ_keys_limited(self):
+        with patch('scotchwsgi.worker.ENVIRON_KEYS', {}) as environ_keys, \
+             patch('scotchwsgi.worker.MAX_ENVIRON_KEYS', 1):
+            request = WSGIRequest('GET', '/', '', 'HTTP/1.1', {'x-first': 'a', 'x-second': 'b'}, b'')
+            environ = self.worker._get_environ(request)
+
+        self.assertEqual(environ_keys, {'x-first': 'HTTP_X_FIRST'})
+        self.assertEqual(environ['HTTP_X_SECOND'], 'b')
+
 class TestWorkerRequestHandling(unittest.TestCase):
     """A worker should only respond to valid requests"""
 
     def _mock_makefile(self, request_bytes):
-        def mock_makefile(mode):
+        def mock_makefile(mode, buffering=None):
             if mode == 'rb':
-                return BytesIO(request_bytes)
+                return BufferedReader(BytesIO(request_bytes))
             else:
                 return Mock()
 
@@ -89,6 +143,14 @@ class TestWorkerRequestHandling(unittest.TestCase):
             worker._handle_connection(mock_conn, mock_addr)
             mock_send_response.assert_called_once()
 
+    def test_tcp_nodelay(self):
+        mock_conn = Mock(makefile = self._mock_makefile(b""))
+
+        worker = stub_worker()
+        worker._handle_connection(mock_conn, Mock())
+
+        mock_conn.setsockopt.assert_called_once_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def test_invalid_request(self):
         mock_conn = Mock(makefile = self._mock_makefile(b"junk\r\n"))
         mock_addr = Mock()
@@ -98,6 +160,51 @@ class TestWorkerRequestHandling(unittest.TestCase):
             worker._handle_connection(mock_conn, mock_addr)
             mock_send_error.assert_called_once()
 
+    def test_oversized_headers(self):
+        mock_conn = Mock(makefile = self._mock_makefile(b"GET / HTTP/1.1\r\nHeader: " + b"a" * 100 + b"\r\n\r\n"))
+        mock_addr = Mock()
+
+        with patch('scotchwsgi.worker.WSGIWorker._send_error') as mock_send_error:
+            worker = stub_worker(max_header_size=64)
+            worker._handle_connection(mock_conn, mock_addr)
+            mock_send_error.assert_called_once_with("431 Request Header Fields Too Large", ANY)
+
+    def test_oversized_body(self):
+        mock_conn = Mock(makefile = self._mock_makefile(b"POST / HTTP/1.1\r\nContent-Length: 100\r\n\r\n"))
+        mock_addr = Mock()
+
+        with patch('scotchwsgi.worker.WSGIWorker._send_error') as mock_send_error:
+            worker = stub_worker(max_body_size=10)
+            worker._handle_connection(mock_conn, mock_addr)
+            mock_send_error.assert_called_once_with("413 Request Entity Too Large", ANY)
+
+    def test_unread_continue_body_closes_connection(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        # The body looks like a second request, which must not be served
+        request_bytes = (
+            b"POST / HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 18\r\n\r\n"
+            b"GET /smuggled HTTP/1.1\r\n\r\n"
+        )
+        for slow_request_threshold in (None, 0):
+            writer = BytesIO()
+            writer.close = Mock()
+
+            def mock_makefile(mode, buffering=None):
+                if mode == 'rb':
+                    return BufferedReader(BytesIO(request_bytes))
+                else:
+                    return writer
+
+            worker = stub_worker(app, slow_request_threshold=slow_request_threshold)
+            with patch('scotchwsgi.worker.log_slow_request') as mock_log_slow_request:
+                worker._handle_connection(Mock(makefile=mock_makefile), ('1.2.3.4', 1234))
+
+            self.assertEqual(writer.getvalue().count(b'HTTP/1.1 200 OK\r\n'), 1, slow_request_threshold)
+            self.assertEqual(mock_log_slow_request.call_count, 0 if slow_request_threshold is None else 1)
+
 class TestWorkerClosesIterable(unittest.TestCase):
     """
     PEP 3333: If the iterable returned by the application has a
@@ -137,3 +244,762 @@ class TestWorkerClosesIterable(unittest.TestCase):
             worker._send_response(mock_request, mock_writer)
 
         mock_iter.close.assert_called_once()
+
+class TestWorkerStreaming(unittest.TestCase):
+    """A worker should limit the number of open streams"""
+
+    def test_stream_rejected_when_too_many_open(self):
+        def stream_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            return [b'data: 1\n\n']
+
+        mock_request = Mock(body=b'', headers={})
+        writer = BytesIO()
+
+        worker = stub_worker(stream_app, max_streams=0)
+        worker._send_response(mock_request, writer)
+
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+
+    def test_stream_detached_before_first_item(self):
+        waiting = gevent.event.Event()
+        disconnected = gevent.event.Event()
+
+        def long_poll_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            waiting.set()
+            try:
+                gevent.sleep(REQUEST_TIMEOUT)
+            except ClientDisconnected:
+                disconnected.set()
+                raise
+            yield b'data: 1\n\n'
+
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            client_conn.sendall(b"GET / HTTP/1.1\r\n\r\n")
+            worker = stub_worker(long_poll_app)
+            greenlet = gevent.spawn(worker._handle_connection, conn, ('1.2.3.4', 1234))
+            self.assertTrue(waiting.wait(timeout=2))
+
+            # Out of the pool while the application waits for its first item
+            self.assertIn(greenlet, worker.streams)
+
+            # And the client going away is noticed without waiting for it
+            client_conn.close()
+            self.assertTrue(disconnected.wait(timeout=2))
+            greenlet.join(timeout=2)
+
+            self.assertTrue(greenlet.dead)
+            self.assertNotIn(greenlet, worker.streams)
+        finally:
+            client_conn.close()
+
+class TestWorkerRecycling(unittest.TestCase):
+    """A worker should drain once it reaches its request or memory limit"""
+
+    def _mock_conn(self, request_bytes):
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return Mock()
+
+        return Mock(makefile=mock_makefile)
+
+    def test_drains_after_max_requests(self):
+        mock_conn = self._mock_conn(b"GET / HTTP/1.1\r\n\r\n" * 3)
+        sent_response_writer = Mock(wrote_connection_close=False, is_streaming=False)
+
+        with patch('scotchwsgi.worker.WSGIWorker._send_response', return_value=sent_response_writer) as mock_send_response:
+            worker = stub_worker(max_requests=2)
+            worker._handle_connection(mock_conn, Mock())
+
+        self.assertTrue(worker.draining)
+        self.assertEqual(mock_send_response.call_count, 2)
+
+    def test_max_requests_jitter(self):
+        with patch('scotchwsgi.worker.random.randint', return_value=3) as mock_randint:
+            worker = stub_worker(max_requests=10, max_requests_jitter=5)
+
+        mock_randint.assert_called_once_with(0, 5)
+        self.assertEqual(worker.max_requests, 13)
+
+    def test_connection_close_while_draining(self):
+        worker = stub_worker()
+        worker.start_draining("test")
+
+        server_headers = worker._get_server_headers(Mock(headers={}))
+
+        self.assertIn(('Connection', 'close'), server_headers)
+
+    def test_http_1_0_connection_headers(self):
+        worker = stub_worker()
+
+        def get_server_headers(http_version, connection=None):
+            headers = {'connection': connection} if connection else {}
+            return worker._get_server_headers(WSGIRequest('GET', '/', '', http_version, headers, b''))
+
+        self.assertEqual(get_server_headers('HTTP/1.0'), [('Connection', 'close')])
+        self.assertEqual(get_server_headers('HTTP/1.0', 'Keep-Alive'), [('Connection', 'keep-alive')])
+        self.assertEqual(get_server_headers('HTTP/1.1'), [])
+        self.assertEqual(get_server_headers('HTTP/1.1', 'keep-alive, close'), [('Connection', 'close')])
+
+        worker.start_draining("test")
+        self.assertEqual(get_server_headers('HTTP/1.0', 'keep-alive'), [('Connection', 'close')])
+
+    def test_drains_when_rss_exceeded(self):
+        worker = stub_worker(max_rss=1024)
+
+        with patch('scotchwsgi.worker.gevent.sleep'), \
+             patch('scotchwsgi.worker.get_rss', return_value=2048):
+            worker._check_memory()
+
+        self.assertTrue(worker.draining)
+
+    def test_drains_on_control_message(self):
+        control_pipe_r, control_pipe_w = multiprocessing.Pipe(duplex=False)
+        worker = stub_worker(control_pipe=control_pipe_r)
+        worker.stop_event = Mock()
+
+        control_pipe_w.send(CONTROL_DRAIN)
+        control_pipe_w.close()
+        worker._watch_control_pipe()
+
+        self.assertTrue(worker.draining)
+        # The master closing its end is seen as it exiting
+        self.assertTrue(worker.parent_exited)
+        worker.stop_event.set.assert_called()
+
+    def test_get_rss(self):
+        self.assertGreater(get_rss(), 0)
+
+class TestWorkerResponseCache(unittest.TestCase):
+    """A worker should serve cacheable responses from its cache"""
+
+    def test_cached_response_replayed(self):
+        def cacheable_app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3'), ('Cache-Control', 'max-age=10')])
+            return [b'abc']
+
+        mock_app = Mock(side_effect=cacheable_app)
+        worker = stub_worker(mock_app, cache_size=1024)
+
+        responses = []
+        for _ in range(2):
+            writer = BytesIO()
+            worker._send_response(WSGIRequest('GET', '/', '', 'HTTP/1.1', {}, b''), writer)
+            responses.append(writer.getvalue())
+
+        self.assertEqual(mock_app.call_count, 1)
+        self.assertTrue(responses[1].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Age: 0\r\n', responses[1])
+        self.assertTrue(responses[1].endswith(b'\r\n\r\nabc'))
+        self.assertEqual(worker.response_cache.hits, 1)
+
+class TestWorkerSingleFlight(unittest.TestCase):
+    """A worker should call the application once for concurrent identical requests"""
+
+    def test_concurrent_requests_coalesced(self):
+        def slow_app(environ, start_response):
+            gevent.sleep(0.01)
+            start_response('200 OK', [('Content-Length', '3'), ('Cache-Control', 'public')])
+            return [b'abc']
+
+        mock_app = Mock(side_effect=slow_app)
+        worker = stub_worker(mock_app, single_flight=True)
+
+        writers = [BytesIO() for _ in range(5)]
+        greenlets = [
+            gevent.spawn(worker._send_response, WSGIRequest('GET', '/', '', 'HTTP/1.1', {}, b''), writer)
+            for writer in writers
+        ]
+        gevent.joinall(greenlets)
+
+        self.assertEqual(mock_app.call_count, 1)
+        for writer in writers:
+            self.assertTrue(writer.getvalue().endswith(b'\r\n\r\nabc'))
+        self.assertEqual(worker.single_flight.coalesced, 4)
+
+    def test_requests_with_different_cookies_not_coalesced(self):
+        def personal_app(environ, start_response):
+            gevent.sleep(0.01)
+            user = environ['HTTP_COOKIE'].encode()
+            start_response('200 OK', [('Content-Length', str(len(user)))])
+            return [user]
+
+        mock_app = Mock(side_effect=personal_app)
+        worker = stub_worker(mock_app, single_flight=True)
+
+        writers = {'user=alice': BytesIO(), 'user=bob': BytesIO()}
+        greenlets = [
+            gevent.spawn(
+                worker._send_response,
+                WSGIRequest('GET', '/', '', 'HTTP/1.1', {'cookie': cookie}, b''),
+                writer,
+            )
+            for cookie, writer in writers.items()
+        ]
+        gevent.joinall(greenlets)
+
+        self.assertEqual(mock_app.call_count, 2)
+        for cookie, writer in writers.items():
+            self.assertTrue(writer.getvalue().endswith(b'\r\n\r\n' + cookie.encode()))
+        self.assertEqual(worker.single_flight.coalesced, 0)
+
+class TestWorkerRateLimiting(unittest.TestCase):
+    """A worker should reject clients over their limits with a 429"""
+
+    def _mock_conn(self, request_bytes):
+        writer = BytesIO()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return writer
+
+        return Mock(makefile=mock_makefile), writer
+
+    def test_request_rate_limited(self):
+        mock_conn, writer = self._mock_conn(b"GET / HTTP/1.1\r\n\r\n" * 3)
+        sent_response_writer = Mock(wrote_connection_close=False, is_streaming=False)
+
+        with patch('scotchwsgi.worker.WSGIWorker._send_response', return_value=sent_response_writer) as mock_send_response:
+            worker = stub_worker(rate_limit=1, rate_limit_burst=2)
+            worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        self.assertEqual(mock_send_response.call_count, 2)
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 429 Too Many Requests\r\n'))
+        self.assertIn(b'Retry-After: 1\r\n', writer.getvalue())
+
+    def test_connection_limited(self):
+        worker = stub_worker(max_connections_per_client=1)
+        worker.rate_limiter.acquire_connection('1.2.3.4')
+
+        mock_conn, writer = self._mock_conn(b"GET / HTTP/1.1\r\n\r\n")
+        with patch('scotchwsgi.worker.WSGIWorker._send_response') as mock_send_response:
+            worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        mock_send_response.assert_not_called()
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 429 Too Many Requests\r\n'))
+        self.assertEqual(worker.rate_limiter.connections, {'1.2.3.4': 1})
+
+class TestWorkerScoreboard(unittest.TestCase):
+    """A worker should keep its scoreboard slots up to date"""
+
+    def _mock_conn(self, request_bytes):
+        writer = BytesIO()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return writer
+
+        return Mock(makefile=mock_makefile), writer
+
+    def test_slot_updated_during_request(self):
+        scoreboard = Scoreboard(1, connections_per_worker=4)
+        states = []
+
+        def app(environ, start_response):
+            states.extend(scoreboard._read_worker(0)[-1])
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        worker = stub_worker(app, scoreboard=scoreboard)
+        worker.worker_scoreboard.start(os.getpid())
+        mock_conn, _ = self._mock_conn(b"GET /path HTTP/1.1\r\n\r\n")
+        worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        self.assertEqual(len(states), 1)
+        self.assertEqual(states[0][2:], ('1.2.3.4', 'GET /path HTTP/1.1'))
+        self.assertNotEqual(states[0][0], STATE_IDLE)
+
+        _, requests, connections, _, _, connection_slots = scoreboard._read_worker(0)
+        self.assertEqual((requests, connections, connection_slots), (1, 1, []))
+
+    def test_status_path(self):
+        worker = stub_worker(scoreboard=Scoreboard(1, connections_per_worker=4), status_path='/status')
+        worker.worker_scoreboard.start(os.getpid())
+
+        mock_conn, writer = self._mock_conn(b"GET /status HTTP/1.1\r\n\r\n")
+        worker._handle_connection(mock_conn, ('127.0.0.1', 1234))
+
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Worker 0 (PID %d)' % os.getpid(), writer.getvalue())
+        worker.application.assert_not_called()
+
+    def test_status_path_hidden_from_remote_clients(self):
+        worker = stub_worker(scoreboard=Scoreboard(1, connections_per_worker=4), status_path='/status')
+
+        mock_conn, writer = self._mock_conn(b"GET /status HTTP/1.1\r\n\r\n")
+        worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        self.assertTrue(writer.getvalue().startswith(b'HTTP/1.1 404 Not Found\r\n'))
+
+class TestWorkerSendTimeout(unittest.TestCase):
+    """A worker should drop clients that read responses too slowly"""
+
+    def test_slow_client_dropped(self):
+        class SlowWriter(BytesIO):
+            def write(self, data):
+                gevent.sleep(1)
+
+        writer = SlowWriter()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(b"GET / HTTP/1.1\r\n\r\n" * 2))
+            else:
+                return writer
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3')])
+            return [b'abc']
+
+        scoreboard = Scoreboard(1, connections_per_worker=4)
+        worker = stub_worker(app, send_timeout=0.01, scoreboard=scoreboard)
+        worker.worker_scoreboard.start(os.getpid())
+        mock_conn = Mock(makefile=mock_makefile)
+        worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        self.assertEqual(worker.slow_clients, 1)
+        self.assertEqual(scoreboard._read_worker(0)[3], 1)
+        mock_conn.close.assert_called_once()
+
+    def test_unsent_data_dropped_when_client_stops_reading(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            for _ in range(10000):
+                yield b'a' * 1000
+
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            # The client sends a request but never reads the response
+            client_conn.sendall(b"GET / HTTP/1.1\r\n\r\n")
+            worker = stub_worker(app, send_timeout=0.05)
+            greenlet = gevent.spawn(worker._handle_connection, conn, ('1.2.3.4', 1234))
+            greenlet.join(timeout=2)
+
+            self.assertTrue(greenlet.dead)
+            self.assertEqual(worker.slow_clients, 1)
+        finally:
+            client_conn.close()
+
+    def test_slow_websocket_client_dropped(self):
+        def flood_app(environ, start_response):
+            websocket = environ['wsgi.websocket']
+            while True:
+                websocket.send(b'a' * 65536)
+
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            # The client completes the handshake but never reads
+            client_conn.sendall(
+                b"GET / HTTP/1.1\r\n"
+                b"Upgrade: websocket\r\n"
+                b"Connection: Upgrade\r\n"
+                b"Sec-WebSocket-Version: 13\r\n"
+                b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                b"\r\n"
+            )
+            worker = stub_worker(flood_app, send_timeout=0.05)
+            greenlet = gevent.spawn(worker._handle_connection, conn, ('1.2.3.4', 1234))
+            greenlet.join(timeout=2)
+
+            self.assertTrue(greenlet.dead)
+            self.assertEqual(worker.slow_clients, 1)
+        finally:
+            client_conn.close()
+
+    def test_notsent_lowat(self):
+        mock_conn = Mock(makefile=lambda mode, buffering=None: BufferedReader(BytesIO(b"")) if mode == 'rb' else BytesIO())
+        worker = stub_worker(notsent_lowat=16384)
+        worker._handle_connection(mock_conn, ('1.2.3.4', 1234))
+
+        mock_conn.setsockopt.assert_any_call(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, 16384)
+
+class TestWorkerReadTimeouts(unittest.TestCase):
+    """A worker should drop clients that send requests too slowly"""
+
+    def _handle_connection(self, request_bytes, **kwargs):
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            client_conn.sendall(request_bytes)
+            worker = stub_worker(**kwargs)
+            worker._handle_connection(conn, ('1.2.3.4', 1234))
+            return client_conn.makefile('rb').read()
+        finally:
+            client_conn.close()
+
+    def test_slow_headers(self):
+        response = self._handle_connection(b"GET / HTTP/1.1\r\nHost: ", header_timeout=0.05)
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 408 Request Timeout\r\n'))
+
+    def test_slow_body(self):
+        response = self._handle_connection(
+            b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc",
+            body_timeout=0.05,
+        )
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 408 Request Timeout\r\n'))
+
+    def test_nothing_sent(self):
+        response = self._handle_connection(b"", header_timeout=0.05)
+
+        self.assertEqual(response, b"")
+
+    def test_websocket_outlives_body_timeout(self):
+        def client_frame(opcode, payload):
+            # Masked with a key of zeroes, which leaves the payload as is
+            return bytes([0x80 | opcode, 0x80 | len(payload)]) + b"\0\0\0\0" + payload
+
+        def echo_app(environ, start_response):
+            websocket = environ['wsgi.websocket']
+            while True:
+                message = websocket.receive()
+                if message is None:
+                    return []
+                websocket.send(message)
+
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            client_conn.sendall(
+                b"GET / HTTP/1.1\r\n"
+                b"Upgrade: websocket\r\n"
+                b"Connection: Upgrade\r\n"
+                b"Sec-WebSocket-Version: 13\r\n"
+                b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                b"\r\n"
+            )
+            worker = stub_worker(echo_app, body_timeout=0.05)
+            greenlet = gevent.spawn(worker._handle_connection, conn, ('1.2.3.4', 1234))
+            client_reader = client_conn.makefile('rb')
+            self.assertEqual(client_reader.readline(), b'HTTP/1.1 101 Switching Protocols\r\n')
+            while client_reader.readline() != b'\r\n':
+                pass
+
+            for message in (b'first', b'second'):
+                gevent.sleep(0.1)
+                client_conn.sendall(client_frame(OPCODE_TEXT, message))
+                self.assertEqual(client_reader.read(2 + len(message)), encode_frame(OPCODE_TEXT, message))
+
+            client_conn.sendall(client_frame(OPCODE_CLOSE, b""))
+            greenlet.join(timeout=1)
+            self.assertTrue(greenlet.dead)
+        finally:
+            client_conn.close()
+
+    def test_evicts_oldest_reading_headers(self):
+        worker = stub_worker()
+        first = gevent.spawn(gevent.sleep, 10)
+        second = gevent.spawn(gevent.sleep, 10)
+        idle = gevent.spawn(gevent.sleep, 10)
+        worker.reading_headers[first] = None
+        worker.reading_headers[second] = None
+        worker.idle_connections.add(idle)
+        gevent.sleep(0)
+
+        worker._evict_connection()
+        gevent.sleep(0)
+        self.assertTrue(first.dead)
+        self.assertFalse(second.dead)
+
+        worker._evict_connection()
+        worker._evict_connection()
+        gevent.sleep(0)
+        self.assertTrue(second.dead)
+        self.assertTrue(idle.dead)
+        self.assertEqual(worker.evicted_connections, 3)
+
+        # Nothing left to evict
+        worker._evict_connection()
+        self.assertEqual(worker.evicted_connections, 3)
+
+class TestWorkerHttp10(unittest.TestCase):
+    """A worker should keep HTTP/1.0 connections alive only when asked to"""
+
+    def _handle_connection(self, app, request_bytes):
+        writer = BytesIO()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return writer
+
+        worker = stub_worker(app)
+        worker._handle_connection(Mock(makefile=mock_makefile), ('1.2.3.4', 1234))
+        return writer.getvalue()
+
+    def test_keep_alive(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3')])
+            return [b'abc']
+
+        response = self._handle_connection(app, b"GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n" * 2)
+
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 2)
+        self.assertEqual(response.count(b'Connection: keep-alive\r\n'), 2)
+
+    def test_close_without_length(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'abc']
+
+        response = self._handle_connection(app, b"GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n" * 2)
+
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertIn(b'Connection: close\r\n', response)
+        self.assertNotIn(b'Transfer-Encoding', response)
+        self.assertTrue(response.endswith(b'\r\n\r\nabc'))
+
+class TestWorkerRanges(unittest.TestCase):
+    """A worker should send the byte ranges asked for"""
+
+    BODY = bytes(range(256)) * 1024
+
+    def _request(self, app, request_bytes):
+        conn, client_conn = gevent.socket.socketpair()
+        try:
+            client_conn.sendall(request_bytes)
+            worker = stub_worker(app)
+            handler = gevent.spawn(worker._handle_connection, conn, ('1.2.3.4', 1234))
+            response = client_conn.makefile('rb').read()
+            handler.get()
+            return response.split(b'\r\n\r\n', 1)
+        finally:
+            client_conn.close()
+
+    def test_file_range(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.BODY)
+            f.flush()
+
+            def app(environ, start_response):
+                f.seek(0)
+                start_response('200 OK', [])
+                return environ['wsgi.file_wrapper'](f)
+
+            head, body = self._request(app, b"GET / HTTP/1.1\r\nRange: bytes=1000-199999\r\nConnection: close\r\n\r\n")
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 206 Partial Content\r\n'))
+        self.assertIn(b'Content-Range: bytes 1000-199999/262144\r\n', head)
+        self.assertEqual(body, self.BODY[1000:200000])
+
+    def test_whole_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.BODY)
+            f.flush()
+
+            def app(environ, start_response):
+                f.seek(0)
+                start_response('200 OK', [('Content-Length', str(len(self.BODY)))])
+                return environ['wsgi.file_wrapper'](f)
+
+            with patch('scotchwsgi.response.os.sendfile', wraps=os.sendfile) as mock_sendfile:
+                head, body = self._request(app, b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(body, self.BODY)
+        mock_sendfile.assert_called()
+
+    def test_iterable_range(self):
+        chunks_generated = []
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', str(len(self.BODY)))])
+            for i in range(0, len(self.BODY), 1024):
+                chunks_generated.append(i)
+                yield self.BODY[i:i + 1024]
+
+        head, body = self._request(app, b"GET / HTTP/1.1\r\nRange: bytes=100-2047\r\nConnection: close\r\n\r\n")
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 206 Partial Content\r\n'))
+        self.assertEqual(body, self.BODY[100:2048])
+        # The rest of the body isn't generated
+        self.assertEqual(len(chunks_generated), 2)
+
+    def test_file_not_sent_with_sendfile_over_tls(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.BODY)
+            f.flush()
+
+            response_writer = Mock(content_length=len(self.BODY), is_streaming=False)
+            worker = stub_worker()
+            with patch('scotchwsgi.response.os.sendfile') as mock_sendfile:
+                sent_response_writer = worker._send_file(
+                    FileWrapper(f),
+                    response_writer,
+                    None,
+                    Mock(spec=ssl.SSLSocket),
+                    Mock(),
+                )
+
+        self.assertIsNone(sent_response_writer)
+        response_writer.send_file.assert_not_called()
+        mock_sendfile.assert_not_called()
+
+    def test_empty_piece_of_unknown_length_response(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'hello ', b'', b'world']
+
+        # Kept alive, so the first response is chunked
+        head, body = self._request(
+            app,
+            b"GET / HTTP/1.1\r\nRange: bytes=0-4\r\n\r\n"
+            b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n",
+        )
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(body.startswith(b'06\r\nhello \r\n05\r\nworld\r\n0\r\n\r\nHTTP/1.1 200 OK\r\n'))
+
+    def test_not_satisfiable(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3')])
+            return [b'abc']
+
+        head, body = self._request(app, b"GET / HTTP/1.1\r\nRange: bytes=5-\r\nConnection: close\r\n\r\n")
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 416 Range Not Satisfiable\r\n'))
+        self.assertIn(b'Content-Range: bytes */3\r\n', head)
+        self.assertEqual(body, b'')
+
+class TestWorkerProbes(unittest.TestCase):
+    """A worker should answer health and readiness probes itself"""
+
+    def _handle_connection(self, worker, request_bytes):
+        writer = BytesIO()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return writer
+
+        worker._handle_connection(Mock(makefile=mock_makefile), ('1.2.3.4', 1234))
+        return writer.getvalue()
+
+    def test_health(self):
+        mock_app = Mock()
+        worker = stub_worker(mock_app, health_path='/healthz')
+
+        response = self._handle_connection(worker, b"GET /healthz HTTP/1.1\r\n\r\n" * 2)
+
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 2)
+        self.assertTrue(response.endswith(b'\r\n\r\nOK\n'))
+        mock_app.assert_not_called()
+        self.assertEqual(worker.requests_handled, 0)
+
+    def test_head(self):
+        worker = stub_worker(health_path='/healthz')
+
+        response = self._handle_connection(worker, b"HEAD /healthz HTTP/1.1\r\n\r\n")
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Content-Length: 3\r\n', response)
+        self.assertTrue(response.endswith(b'\r\n\r\n'))
+
+    def test_ready(self):
+        worker = stub_worker(readiness_path='/ready')
+
+        response = self._handle_connection(worker, b"GET /ready HTTP/1.1\r\n\r\n")
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+
+    def test_not_ready_while_draining(self):
+        worker = stub_worker(health_path='/healthz', readiness_path='/ready')
+        worker.start_draining("test")
+
+        response = self._handle_connection(worker, b"GET /ready HTTP/1.1\r\n\r\nGET /ready HTTP/1.1\r\n\r\n")
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn(b'Connection: close\r\n', response)
+        self.assertEqual(response.count(b'HTTP/1.1'), 1)
+
+        # Still healthy
+        response = self._handle_connection(worker, b"GET /healthz HTTP/1.1\r\n\r\n")
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+
+    def test_not_ready_when_saturated(self):
+        worker = stub_worker(readiness_path='/ready')
+        worker.pool = Mock(free_count=Mock(return_value=20))
+        self.assertTrue(worker.is_ready())
+
+        worker.pool.free_count.return_value = 1
+        self.assertFalse(worker.is_ready())
+
+class TestWorkerTracing(unittest.TestCase):
+    """A worker should trace requests when asked to"""
+
+    def _handle_connection(self, worker, request_bytes):
+        writer = BytesIO()
+        writer.close = Mock()
+
+        def mock_makefile(mode, buffering=None):
+            if mode == 'rb':
+                return BufferedReader(BytesIO(request_bytes))
+            else:
+                return writer
+
+        worker._handle_connection(Mock(makefile=mock_makefile), ('1.2.3.4', 1234))
+        return writer.getvalue()
+
+    def test_environ(self):
+        environs = []
+
+        def app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        worker = stub_worker(app, tracing=True)
+        self._handle_connection(
+            worker,
+            b"GET / HTTP/1.1\r\ntraceparent: 00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01\r\n\r\n"
+            b"GET / HTTP/1.1\r\n\r\n",
+        )
+
+        self.assertEqual(environs[0]['scotchwsgi.trace_id'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertNotEqual(environs[1]['scotchwsgi.trace_id'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertNotEqual(environs[0]['scotchwsgi.request_id'], environs[1]['scotchwsgi.request_id'])
+
+    def test_not_traced_by_default(self):
+        environs = []
+
+        def app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        self._handle_connection(stub_worker(app), b"GET / HTTP/1.1\r\n\r\n")
+
+        self.assertNotIn('scotchwsgi.request_id', environs[0])
+
+    def test_spans_exported(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3')])
+            return [b'abc']
+
+        worker = stub_worker(app, trace_exporter='file:/dev/null')
+        worker.span_exporter.send = Mock()
+        self._handle_connection(worker, b"POST /path HTTP/1.1\r\nContent-Length: 1\r\n\r\na")
+        worker.span_exporter.flush()
+
+        spans = [json.loads(line) for line in worker.span_exporter.send.call_args[0][0]]
+        self.assertEqual(
+            [span['name'] for span in spans],
+            ['request', 'accept', 'headers', 'body', 'app', 'first_byte', 'last_byte'],
+        )
+        self.assertEqual(spans[0]['attributes']['status'], 200)
+        self.assertEqual(spans[0]['attributes']['method'], 'POST')
+        self.assertEqual(spans[0]['attributes']['path'], '/path')